@@ -1,20 +1,45 @@
 import os
+import sys
+import argparse
 import json
 import re
+import bisect
+import functools
+import heapq
+import importlib
+import math
+import random
+import asyncio
+import ipaddress
+import struct
 import shutil
-import copy
+import sqlite3
 from datetime import datetime, timezone
+import signal
 import subprocess
+import tempfile
+import time
+import uuid
+from array import array
+from collections import OrderedDict, deque
+import threading
+import queue
+import contextvars
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import requests
+from requests.adapters import HTTPAdapter
 import platform
 import socket
 import urllib3
+import xml.etree.ElementTree as ET
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 
 app = Flask(__name__)
-CORS(app, origins=["http://localhost:5173", "http://localhost:4173"])
+CORS_ORIGINS = ["http://localhost:5173", "http://localhost:4173"]
+CORS(app, origins=CORS_ORIGINS, expose_headers=["X-Request-ID", "Server-Timing"])
 
 # --- Configuration ---
 # Utilisation de variables d'environnement avec valeurs par défaut
@@ -24,11 +49,68 @@ OLLAMA_GENERATE_URL = f"{OLLAMA_BASE_URL}/api/generate"
 
 # Configuration de l'historique
 MAX_HISTORY_STORED = 50   # Nombre d'échanges gardés en mémoire
-MAX_HISTORY_CONTEXT = 3   # Nombre d'échanges envoyés à l'IA pour le contexte
-
-# Optimisation: Session persistante pour les requêtes HTTP (Keep-Alive)
+MAX_HISTORY_CONTEXT = 3   # Nombre d'échanges envoyés à l'IA pour le contexte (stratégie "window")
+
+# Contexte "stable" (défaut) : préfixe identique d'un tour à l'autre pour que
+# Ollama réutilise son cache KV. Les échanges s'ajoutent à la suite d'un résumé
+# figé ; tous les CONTEXT_CHECKPOINT_EVERY échanges, les plus anciens sont
+# repliés dans un nouveau résumé (seul moment où le préfixe change).
+CONTEXT_STRATEGY = os.getenv("CONTEXT_STRATEGY", "stable")   # "stable" ou "window"
+CONTEXT_CHECKPOINT_EVERY = 8     # Échanges accumulés avant un nouveau résumé
+CONTEXT_KEEP_RECENT = 2          # Échanges laissés en clair après un résumé
+CONTEXT_SUMMARY_MAX_CHARS = 2000
+# Durée pendant laquelle Ollama garde le modèle (et son cache KV) en mémoire
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Optimisation: Session persistante pour les requêtes HTTP (Keep-Alive) de
+# l'outil de sondage HTTP ; Ollama a son propre client (voir OllamaClient)
 http_session = requests.Session()
 
+# Exécution des outils : un pool partagé par toutes les requêtes
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "32"))
+DEFAULT_TOOL_TIMEOUT = 60   # Outils déclarés sans timeout (secondes)
+# Classes de concurrence des outils : exécutions simultanées, toutes requêtes
+# confondues (0 = illimité). Timeout et TTL de cache sont déclarés par outil
+# dans le registre (voir tool_registry).
+TOOL_CONCURRENCY = {
+    "light": int(os.getenv("TOOL_LIGHT_CONCURRENCY", "8")),        # Lectures locales rapides
+    "process": int(os.getenv("TOOL_PROCESS_CONCURRENCY", "16")),   # Sous-processus courts (ping)
+    "scan": int(os.getenv("TOOL_SCAN_CONCURRENCY", "4")),          # Scans réseau, en job avec async_tools
+}
+# Manifestes JSON d'outils supplémentaires (module importé au premier appel)
+TOOL_PLUGIN_DIR = os.getenv("TOOL_PLUGIN_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tools.d"))
+
+TOOL_CACHE_MAX_ENTRIES = 256
+
+# Budget de tokens des résultats d'outils dans l'appel de suivi (temps de prompt-eval)
+TOOL_RESULT_TOKEN_BUDGET = int(os.getenv("TOOL_RESULT_TOKEN_BUDGET", "1200"))    # par résultat
+TOOL_RESULTS_TOTAL_BUDGET = int(os.getenv("TOOL_RESULTS_TOTAL_BUDGET", "3000"))  # par tour
+CHARS_PER_TOKEN = 4
+
+# Jobs asynchrones (outils longs exécutés hors de la requête HTTP)
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "4"))
+MAX_JOBS_STORED = 200      # Jobs terminés conservés pour consultation
+MAX_CONCURRENT_NMAP = int(os.getenv("MAX_CONCURRENT_NMAP", "2"))
+JOB_PROGRESS_KEEP = 200    # Derniers événements de progression conservés par job
+SSE_KEEPALIVE_INTERVAL = 15
+
+# Découverte réseau : moteur natif (asyncio, sans nmap) ou "nmap" en option
+DISCOVERY_BACKEND = os.getenv("DISCOVERY_BACKEND", "native")
+DISCOVERY_PORTS = [int(p) for p in os.getenv("DISCOVERY_PORTS", "80,443,22,445,3389").split(",") if p]
+DISCOVERY_CONCURRENCY = int(os.getenv("DISCOVERY_CONCURRENCY", "512"))   # connexions simultanées
+DISCOVERY_RATE = float(os.getenv("DISCOVERY_RATE", "4000"))              # sondes/s (0 = illimité)
+DISCOVERY_PROBE_TIMEOUT = float(os.getenv("DISCOVERY_PROBE_TIMEOUT", "0.4"))
+DISCOVERY_MIN_PREFIX = 20   # au-delà (/16...), le balayage est réduit au /20 de l'IP locale
+DISCOVERY_DEADLINE = 45     # durée maximale d'un balayage natif (s)
+
+# Scan de ports : "auto" = pré-passe native puis nmap -sV sur les ports ouverts
+# (natif seul si nmap est absent), "native" ou "nmap" pour forcer un moteur
+SCAN_BACKEND = os.getenv("SCAN_BACKEND", "auto")
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", "256"))
+SCAN_RATE = float(os.getenv("SCAN_RATE", "2000"))                   # connexions/s (0 = illimité)
+SCAN_CONNECT_TIMEOUT = float(os.getenv("SCAN_CONNECT_TIMEOUT", "1.0"))
+SCAN_BANNER_TIMEOUT = float(os.getenv("SCAN_BANNER_TIMEOUT", "1.5"))
+
 DEFAULT_OPTIONS = {
     "temperature": 0.7,
     "top_p": 0.9,
@@ -62,6 +144,51 @@ MODELS = {
     },
 }
 
+# Gestion des modèles en mémoire : préchargement au démarrage et pings keep_alive
+MODEL_MANAGER_ENABLED = os.getenv("MODEL_MANAGER", "1").lower() in ("1", "true", "yes")
+MODEL_PRELOAD = [k.strip() for k in os.getenv("MODEL_PRELOAD", "llama3.1").split(",") if k.strip()]
+MODEL_PS_INTERVAL = 30           # Consultation de /api/ps (s)
+MODEL_KEEPALIVE_INTERVAL = 300   # Ping des modèles chauds (s), bien avant OLLAMA_KEEP_ALIVE
+MODEL_HOT_WINDOW = 3600          # Un modèle utilisé depuis moins d'une heure reste « chaud »
+MODEL_WARMUP_TIMEOUT = 120
+
+# Topologie réseau locale : recalculée à chaque changement (netlink, Linux) et
+# au plus tard toutes les NETWORK_REFRESH_INTERVAL s
+NETWORK_REFRESH_INTERVAL = float(os.getenv("NETWORK_REFRESH_INTERVAL", "60"))
+NETWORK_POLL_INTERVAL = 5        # Sondage quand netlink n'est pas disponible (s)
+
+# Télémétrie système : échantillon toutes les TELEMETRY_INTERVAL s, gardé dans un
+# anneau de TELEMETRY_SAMPLES (30 min par défaut), exposé sur /system/metrics
+TELEMETRY_ENABLED = os.getenv("TELEMETRY", "1").lower() in ("1", "true", "yes")
+TELEMETRY_INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", "2"))
+TELEMETRY_SAMPLES = int(os.getenv("TELEMETRY_SAMPLES", "900"))
+SYSTEM_DISK_PATH = "C:\\" if platform.system().lower() == "windows" else "/"
+
+# Ordonnanceur devant Ollama : au plus OLLAMA_NUM_PARALLEL générations par
+# modèle (même variable que côté Ollama), le reste attend dans une file
+# équitable entre clients. File pleine ou attente trop longue : 429.
+OLLAMA_NUM_PARALLEL = max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "16"))     # Par modèle
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "60"))     # Attente max en file (s)
+SCHEDULER_AGING = 10             # Une requête gagne une classe de priorité par 10 s d'attente
+
+# Client Ollama : pool de connexions dimensionné pour les threads du serveur,
+# timeouts (connexion, lecture) par type d'appel, nouvelles tentatives avec
+# jitter pour les requêtes qui n'ont pas atteint Ollama, disjoncteur et sonde.
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "32"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "3"))
+OLLAMA_TIMEOUTS = {
+    "chat": (OLLAMA_CONNECT_TIMEOUT, 120),     # En streaming : délai max entre deux chunks
+    "warmup": (OLLAMA_CONNECT_TIMEOUT, MODEL_WARMUP_TIMEOUT),
+    "ps": (OLLAMA_CONNECT_TIMEOUT, 5),
+    "health": (1, 3),
+}
+OLLAMA_RETRIES = 2               # Nouvelles tentatives (connexion refusée/expirée, 503)
+OLLAMA_RETRY_BACKOFF = 0.25      # Base du backoff exponentiel, tiré au hasard dans [0, base * 2^n] (s)
+OLLAMA_BREAKER_THRESHOLD = 3     # Échecs de connexion consécutifs avant ouverture du disjoncteur
+OLLAMA_BREAKER_RESET = 10        # Durée d'ouverture avant un appel d'essai (s)
+OLLAMA_HEALTH_INTERVAL = 15      # Sonde /api/version (toutes les 2 s tant que le disjoncteur est ouvert)
+
 # --- Prompts systèmes par défaut (fallback) ---
 DEFAULT_PROMPTS = {
     "general": {
@@ -94,10 +221,25 @@ DEFAULT_PROMPTS = {
     },
 }
 
-DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
-HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
-PROMPTS_FILE = os.path.join(DATA_DIR, "prompts.json")
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+HISTORY_FILE = os.path.join(DATA_DIR, "history.json")   # Ancien format (importé une fois)
+HISTORY_DB = os.path.join(DATA_DIR, "history.db")
+HISTORY_COMPACT_EVERY = 200   # Compaction après N ajouts
+PROMPTS_FILE = os.path.join(DATA_DIR, "prompts.json")   # Ancien format (importé une fois)
+PROMPTS_DB = os.path.join(DATA_DIR, "prompts.db")
 PROMPTS_BACKUP = os.path.join(DATA_DIR, "prompts.backup.json")
+# Métriques Prometheus (/metrics) : en multi-workers, chaque processus écrit son
+# cumul dans METRICS_DIR toutes les METRICS_FLUSH_INTERVAL s (fichiers d'un
+# lancement précédent supprimés au démarrage des workers)
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+METRICS_FLUSH_INTERVAL = 5
+# Traçage de /ask : spans imbriqués, en-tête Server-Timing, les TRACE_KEEP
+# requêtes les plus lentes sur /debug/traces ; profilage d'une requête avec
+# l'en-tête X-Profile: cprofile (ou pyinstrument) si TRACE_PROFILE
+TRACING_ENABLED = os.getenv("TRACING", "1").lower() in ("1", "true", "yes")
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "50"))
+TRACE_PROFILE = os.getenv("TRACE_PROFILE", "1").lower() in ("1", "true", "yes")
+TRACE_PROFILE_LINES = 40         # Lignes du rapport cProfile (tri par temps cumulé)
 
 
 # --- Utilitaire : écriture atomique avec backup ---
@@ -105,7 +247,8 @@ def _atomic_save(filepath, data, backup_path=None):
     """Sauvegarde atomique : écrit dans un fichier temporaire puis renomme.
     Crée un backup du fichier existant si backup_path est fourni."""
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    tmp_path = filepath + ".tmp"
+    # Fichier temporaire propre au processus (plusieurs workers peuvent écrire)
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
     try:
         # Écriture dans un fichier temporaire
         with open(tmp_path, "w", encoding="utf-8") as f:
@@ -122,235 +265,495 @@ def _atomic_save(filepath, data, backup_path=None):
         raise e
 
 
-# --- Gestion des prompts systèmes ---
-def load_prompts():
-    """Charge les prompts depuis le fichier JSON, avec fallback sur les défauts."""
-    prompts = copy.deepcopy(DEFAULT_PROMPTS)
-    if os.path.exists(PROMPTS_FILE):
+# --- Stockage SQLite partagé (historique, prompts) ---
+class SQLiteStore:
+    """Base des stockages SQLite : une connexion par thread, mode WAL.
+    Plusieurs processus (workers) peuvent ouvrir la même base."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write_transaction(self):
+        """Transaction qui prend le verrou d'écriture dès le début (BEGIN IMMEDIATE) :
+        les lecture-modification-écriture sont sérialisées entre processus."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            with open(PROMPTS_FILE, "r", encoding="utf-8") as f:
-                saved = json.load(f)
-            # Fusion : les prompts sauvegardés écrasent les défauts
-            for key, value in saved.items():
-                prompts[key] = value
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+# --- Gestion des prompts systèmes ---
+class PromptStore(SQLiteStore):
+    """Prompts systèmes dans SQLite, lus à chaque accès : tous les workers
+    voient immédiatement les modifications faites par les autres."""
+
+    _COLUMNS = ("name", "icon", "content", "is_default", "created_at", "updated_at")
+
+    def __init__(self, path, legacy_file=None, backup_path=None):
+        super().__init__(path)
+        self.legacy_file = legacy_file
+        self.backup_path = backup_path
+        with self._write_transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                " id TEXT PRIMARY KEY, name TEXT NOT NULL, icon TEXT NOT NULL,"
+                " content TEXT NOT NULL, is_default INTEGER NOT NULL,"
+                " created_at TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            imported = conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone()
+            if not imported:
+                # Fusion : les prompts de l'ancien fichier écrasent les défauts
+                for key, value in self._read_legacy().items():
+                    self._upsert_row(conn, key, value)
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)",
+                    (datetime.now(timezone.utc).isoformat(),),
+                )
             # S'assurer que les défauts existent toujours
             for key, default in DEFAULT_PROMPTS.items():
-                if key not in prompts:
-                    prompts[key] = copy.deepcopy(default)
+                if not conn.execute("SELECT 1 FROM prompts WHERE id = ?", (key,)).fetchone():
+                    self._upsert_row(conn, key, default)
+
+    def _read_legacy(self):
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return {}
+        try:
+            with open(self.legacy_file, "r", encoding="utf-8") as f:
+                return json.load(f)
         except Exception as e:
             print(f"⚠️ Erreur au chargement des prompts ({e}). Utilisation des défauts.")
-    return prompts
-
+            return {}
+
+    def _upsert_row(self, conn, prompt_id, entry):
+        conn.execute(
+            "INSERT OR REPLACE INTO prompts (id, name, icon, content, is_default, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (prompt_id, entry.get("name", prompt_id), entry.get("icon", "💬"),
+             entry.get("content", ""), int(bool(entry.get("is_default", False))),
+             entry.get("created_at", ""), entry.get("updated_at", "")),
+        )
 
-def save_prompts(prompts_data):
-    """Sauvegarde les prompts avec écriture atomique et backup."""
-    try:
-        _atomic_save(PROMPTS_FILE, prompts_data, backup_path=PROMPTS_BACKUP)
-    except Exception as e:
-        print(f"❌ Erreur à la sauvegarde des prompts : {e}")
-        raise
+    def _row_to_entry(self, row):
+        entry = dict(zip(self._COLUMNS, row))
+        entry["is_default"] = bool(entry["is_default"])
+        return entry
+
+    def _select(self, conn, prompt_id):
+        row = conn.execute(
+            f"SELECT {', '.join(self._COLUMNS)} FROM prompts WHERE id = ?", (prompt_id,)
+        ).fetchone()
+        return self._row_to_entry(row) if row else None
+
+    def _backup(self):
+        # Copie JSON lisible, comme l'ancien prompts.backup.json
+        if self.backup_path:
+            try:
+                _atomic_save(self.backup_path, self.all())
+            except Exception as e:
+                print(f"❌ Erreur à la sauvegarde des prompts : {e}")
+
+    def all(self):
+        rows = self._conn().execute(
+            f"SELECT id, {', '.join(self._COLUMNS)} FROM prompts ORDER BY rowid"
+        ).fetchall()
+        return {row[0]: self._row_to_entry(row[1:]) for row in rows}
+
+    def get(self, prompt_id):
+        return self._select(self._conn(), prompt_id)
+
+    def upsert(self, prompt_id, name, content, icon):
+        """Crée ou met à jour un prompt. Retourne (prompt, is_update)."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._write_transaction() as conn:
+            existing = self._select(conn, prompt_id)
+            if existing:
+                # Mise à jour : on conserve created_at et is_default
+                existing.update({"name": name, "content": content, "icon": icon, "updated_at": now})
+                entry = existing
+            else:
+                entry = {
+                    "name": name,
+                    "icon": icon,
+                    "content": content,
+                    "is_default": False,
+                    "created_at": now,
+                    "updated_at": now,
+                }
+            self._upsert_row(conn, prompt_id, entry)
+        self._backup()
+        return entry, existing is not None
+
+    def delete(self, prompt_id):
+        """Supprime un prompt et retourne son nom.
+        KeyError s'il n'existe pas, PermissionError si c'est un prompt par défaut."""
+        with self._write_transaction() as conn:
+            entry = self._select(conn, prompt_id)
+            if entry is None:
+                raise KeyError(prompt_id)
+            if entry.get("is_default"):
+                raise PermissionError(prompt_id)
+            conn.execute("DELETE FROM prompts WHERE id = ?", (prompt_id,))
+        self._backup()
+        return entry.get("name", prompt_id)
+
+    def duplicate(self, prompt_id):
+        """Duplique un prompt. Retourne (nouvel_id, prompt) ; KeyError s'il n'existe pas."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._write_transaction() as conn:
+            original = self._select(conn, prompt_id)
+            if original is None:
+                raise KeyError(prompt_id)
+
+            # Générer un nouvel ID
+            base_id = f"{prompt_id}-copy"
+            new_id = base_id
+            counter = 1
+            while conn.execute("SELECT 1 FROM prompts WHERE id = ?", (new_id,)).fetchone():
+                new_id = f"{base_id}-{counter}"
+                counter += 1
+
+            entry = {
+                "name": f"{original['name']} (copie)",
+                "icon": original.get("icon", "💬"),
+                "content": original["content"],
+                "is_default": False,
+                "created_at": now,
+                "updated_at": now,
+            }
+            self._upsert_row(conn, new_id, entry)
+        self._backup()
+        return new_id, entry
 
+    def replace_all(self, prompts_data):
+        with self._write_transaction() as conn:
+            conn.execute("DELETE FROM prompts")
+            for key, value in prompts_data.items():
+                self._upsert_row(conn, key, value)
+        self._backup()
 
-# Variable globale des prompts (chargée au démarrage)
-system_prompts = load_prompts()
 
+prompt_store = PromptStore(PROMPTS_DB, legacy_file=PROMPTS_FILE, backup_path=PROMPTS_BACKUP)
 
 
-# --- Gestion de l'historique de conversation ---
-def load_history():
-    history = {key: [] for key in MODELS.keys()}
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                saved = json.load(f)
-                for key in saved:
-                    if key in history:
-                        history[key] = saved[key]
-        except Exception as e:
-            print(f"Erreur au chargement de l'historique : {e}")
-    return history
+def load_prompts():
+    """Tous les prompts {id: prompt} (adaptateur sur prompt_store)."""
+    return prompt_store.all()
 
 
-def save_history(history_data):
-    """Sauvegarde l'historique avec écriture atomique et backup."""
+def save_prompts(prompts_data):
+    """Remplace tous les prompts (adaptateur sur prompt_store)."""
     try:
-        _atomic_save(HISTORY_FILE, history_data,
-                     backup_path=os.path.join(DATA_DIR, "history.backup.json"))
+        prompt_store.replace_all(prompts_data)
     except Exception as e:
-        print(f"Erreur à la sauvegarde de l'historique : {e}")
+        print(f"❌ Erreur à la sauvegarde des prompts : {e}")
+        raise
 
 
-conversation_history = load_history()
+# --- Gestion de l'historique de conversation ---
+DEFAULT_CONVERSATION = "default"   # Conversation partagée quand le client n'en précise pas
+HISTORY_CACHE_CONVERSATIONS = 1024  # Conversations gardées en cache mémoire (LRU, 0 = aucune)
+HISTORY_LOCK_STRIPES = 64           # Verrous répartis par hachage de (modèle, conversation)
+
+
+class HistoryStore(SQLiteStore):
+    """Historique en ajout seul dans SQLite (mode WAL) : une ligne par échange.
+
+    L'historique est découpé par (modèle, conversation) : chaque conversation
+    a son propre verrou (réparti sur HISTORY_LOCK_STRIPES verrous), si bien que
+    des utilisateurs différents n'attendent jamais les uns après les autres.
+    Les conversations sont chargées à la première lecture, et une compaction
+    périodique (en arrière-plan) supprime les lignes au-delà de
+    MAX_HISTORY_STORED. Avec cache_size=0 (plusieurs workers), chaque lecture
+    interroge la base pour voir les écritures des autres processus."""
+
+    def __init__(self, path, max_per_model, legacy_file=None,
+                 cache_size=HISTORY_CACHE_CONVERSATIONS):
+        super().__init__(path)
+        self.max_per_model = max_per_model
+        self.legacy_file = legacy_file
+        self.cache_size = cache_size
+        self._cache = OrderedDict()     # (modèle, conversation) → échanges
+        self._cache_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(HISTORY_LOCK_STRIPES)]
+        self._appends = 0
+        self._init_schema()
+
+    def _init_schema(self):
+        # Verrou d'écriture pris d'emblée : avec plusieurs workers qui démarrent
+        # ensemble, la colonne et l'import sont vérifiés une fois le verrou obtenu
+        with self._write_transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS exchanges ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " model TEXT NOT NULL,"
+                " question TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " created_at TEXT NOT NULL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(exchanges)")}
+            if "conversation" not in columns:
+                conn.execute(
+                    "ALTER TABLE exchanges ADD COLUMN conversation TEXT NOT NULL DEFAULT "
+                    f"'{DEFAULT_CONVERSATION}'"
+                )
+            conn.execute("DROP INDEX IF EXISTS idx_exchanges_model")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_exchanges_conversation"
+                " ON exchanges (model, conversation, id)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                " model TEXT NOT NULL,"
+                " conversation TEXT NOT NULL,"
+                " upto_id INTEGER NOT NULL,"
+                " summary TEXT NOT NULL,"
+                " created_at TEXT NOT NULL,"
+                " PRIMARY KEY (model, conversation))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._import_legacy(conn)
+
+    def _import_legacy(self, conn):
+        """Importe une fois l'ancien history.json (le fichier est laissé en place).
+        À appeler dans la transaction d'écriture de _init_schema."""
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return
+        saved = {}
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            try:
+                with open(self.legacy_file, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+            except Exception as e:
+                print(f"Erreur au chargement de l'historique : {e}")
+        now = datetime.now(timezone.utc).isoformat()
+        for model_key, items in saved.items():
+            self._insert_many(conn, model_key, DEFAULT_CONVERSATION, items, now)
+        conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)", (now,))
+
+    def _insert_many(self, conn, model_key, conversation_id, items, created_at):
+        conn.executemany(
+            "INSERT INTO exchanges (model, conversation, question, answer, created_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [(model_key, conversation_id, i.get("question", ""), i.get("answer", ""), created_at)
+             for i in items[-self.max_per_model:]],
+        )
 
-TOOL_INSTRUCTIONS = (
-    "Tu disposes de plusieurs outils (appels de fonctions) :\n"
-    "- 'run_nmap' : Scan réseau ciblé (ports, versions, etc.)\n"
-    "- 'run_ping' : Test de connectivité ICMP vers une machine\n"
-    "- 'get_network_interfaces' : Récupérer les interfaces réseau et l'IP locale de cette machine\n"
-    "- 'get_system_status' : État du système (OS, CPU, RAM, disque)\n"
-    "- 'run_reconnaissance_rapide' : Bundle métier qui effectue Ping + Nmap rapide + vérification HTTP en une seule commande\n"
-    "- 'run_local_discovery' : Bundle métier qui détecte l'IP locale, calcule le sous-réseau et découvre toutes les machines du réseau\n"
-    "- 'run_port_audit' : Bundle métier qui audite les ports d'administration sensibles (FTP, SSH, Telnet, RDP, SMB...) et génère des alertes de sécurité\n"
-    "Utilise ces outils quand l'utilisateur te le demande explicitement ou quand c'est pertinent. "
-    "Pour les bundles, fournis une synthèse claire et structurée du rapport retourné."
-)
+    def _lock_for(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
 
-NMAP_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "run_nmap",
-        "description": "Lance un scan nmap limité et retourne stdout/stderr.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "target": {
-                    "type": "string",
-                    "description": "Nom d'hôte ou IP à scanner (ex: 192.168.0.10 ou scanme.nmap.org).",
-                },
-                "ports": {
-                    "type": "string",
-                    "description": "Liste de ports optionnelle, ex: '22,80,443'.",
-                },
-                "fast_scan": {
-                    "type": "boolean",
-                    "description": "Activer le scan rapide (-F).",
-                },
-                "service_versions": {
-                    "type": "boolean",
-                    "description": "Détecter les versions des services (-sV).",
-                },
-                "skip_ping": {
-                    "type": "boolean",
-                    "description": "Ne pas ping avant le scan (-Pn).",
-                },
-            },
-            "required": ["target"],
-        },
-    },
-}
+    @contextmanager
+    def _locks_for(self, keys=None):
+        """Verrous des conversations `keys` (tous si None), pris dans l'ordre de
+        leur index pour qu'aucun get/append ne recharge des lignes en cours de
+        suppression, sans risque d'interblocage entre deux suppressions."""
+        if keys is None:
+            indexes = range(len(self._stripes))
+        else:
+            indexes = sorted({hash(key) % len(self._stripes) for key in keys})
+        acquired = []
+        try:
+            for index in indexes:
+                self._stripes[index].acquire()
+                acquired.append(self._stripes[index])
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def _load(self, key):
+        rows = self._conn().execute(
+            "SELECT id, question, answer FROM exchanges WHERE model = ? AND conversation = ?"
+            " ORDER BY id DESC LIMIT ?",
+            (*key, self.max_per_model),
+        ).fetchall()
+        return [{"id": i, "question": q, "answer": a} for i, q, a in reversed(rows)]
+
+    def _cached(self, key):
+        # Appelé sous le verrou de la conversation
+        if not self.cache_size:
+            return self._load(key)
+        with self._cache_lock:
+            history = self._cache.get(key)
+            if history is not None:
+                self._cache.move_to_end(key)
+                return history
+        history = self._load(key)
+        with self._cache_lock:
+            self._cache[key] = history
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return history
+
+    def _forget(self, model_key, conversation_id=None):
+        with self._cache_lock:
+            for key in [k for k in self._cache
+                        if k[0] == model_key and conversation_id in (None, k[1])]:
+                del self._cache[key]
+
+    def get(self, model_key, conversation_id=DEFAULT_CONVERSATION):
+        """Copie de l'historique d'une conversation (chargée à la première demande)."""
+        key = (model_key, conversation_id)
+        with self._lock_for(key):
+            return list(self._cached(key))
+
+    def append(self, model_key, exchange, conversation_id=DEFAULT_CONVERSATION):
+        """Ajoute un échange (une seule ligne écrite). Retourne la longueur."""
+        key = (model_key, conversation_id)
+        with self._lock_for(key):
+            history = self._cached(key)
+            with self._conn() as conn:
+                row_id = conn.execute(
+                    "INSERT INTO exchanges (model, conversation, question, answer, created_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (model_key, conversation_id, exchange["question"], exchange["answer"],
+                     datetime.now(timezone.utc).isoformat()),
+                ).lastrowid
+            history.append({"id": row_id, "question": exchange["question"], "answer": exchange["answer"]})
+            # On garde les X derniers en mémoire
+            del history[:-self.max_per_model]
+            length = len(history)
+        with self._cache_lock:
+            self._appends += 1
+            compact_due = self._appends % HISTORY_COMPACT_EVERY == 0
+        if compact_due:
+            threading.Thread(target=self.compact, name="history-compact", daemon=True).start()
+        return length
+
+    def clear(self, model_key, conversation_id=None):
+        """Efface une conversation, ou toutes celles du modèle si conversation_id est None."""
+        keys = None if conversation_id is None else [(model_key, conversation_id)]
+        with self._locks_for(keys):
+            with self._conn() as conn:
+                for table in ("exchanges", "checkpoints"):
+                    if conversation_id is None:
+                        conn.execute(f"DELETE FROM {table} WHERE model = ?", (model_key,))
+                    else:
+                        conn.execute(
+                            f"DELETE FROM {table} WHERE model = ? AND conversation = ?",
+                            (model_key, conversation_id),
+                        )
+            self._forget(model_key, conversation_id)
+
+    def checkpoint(self, model_key, conversation_id=DEFAULT_CONVERSATION):
+        """Dernier résumé de la conversation : {"upto_id", "summary"} ou None."""
+        row = self._conn().execute(
+            "SELECT upto_id, summary FROM checkpoints WHERE model = ? AND conversation = ?",
+            (model_key, conversation_id),
+        ).fetchone()
+        return {"upto_id": row[0], "summary": row[1]} if row else None
+
+    def set_checkpoint(self, model_key, conversation_id, upto_id, summary):
+        """Enregistre un résumé couvrant les échanges jusqu'à upto_id (jamais en arrière)."""
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO checkpoints (model, conversation, upto_id, summary, created_at)"
+                " VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (model, conversation) DO UPDATE SET"
+                " upto_id = excluded.upto_id, summary = excluded.summary,"
+                " created_at = excluded.created_at"
+                " WHERE excluded.upto_id > checkpoints.upto_id",
+                (model_key, conversation_id, upto_id, summary,
+                 datetime.now(timezone.utc).isoformat()),
+            )
+        return self.checkpoint(model_key, conversation_id)
+
+    def conversations(self, model_key):
+        """Conversations d'un modèle : identifiant, nombre d'échanges, dernière activité."""
+        rows = self._conn().execute(
+            "SELECT conversation, COUNT(*), MAX(created_at) FROM exchanges"
+            " WHERE model = ? GROUP BY conversation ORDER BY MAX(id) DESC",
+            (model_key,),
+        ).fetchall()
+        return [
+            {"conversation_id": c, "exchanges": min(n, self.max_per_model), "last_activity": t}
+            for c, n, t in rows
+        ]
+
+    def replace_all(self, history_data, conversation_id=DEFAULT_CONVERSATION):
+        """Remplace l'historique d'une conversation pour chaque modèle (utilisé par save_history)."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._locks_for(None):
+            with self._conn() as conn:
+                for model_key, items in history_data.items():
+                    for table in ("exchanges", "checkpoints"):
+                        conn.execute(
+                            f"DELETE FROM {table} WHERE model = ? AND conversation = ?",
+                            (model_key, conversation_id),
+                        )
+                    self._insert_many(conn, model_key, conversation_id, items, now)
+            for model_key in history_data:
+                self._forget(model_key, conversation_id)
 
-PING_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "run_ping",
-        "description": "Teste la connectivité vers une machine (Ping ICMP).",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "target": {
-                    "type": "string",
-                    "description": "Adresse IP ou nom de domaine à pinger.",
-                }
-            }, 
-            "required": ["target"],
-        },
-    },
-}
+    def compact(self):
+        """Supprime les échanges au-delà de max_per_model et tronque le WAL."""
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "DELETE FROM exchanges WHERE id IN ("
+                    " SELECT id FROM (SELECT id, ROW_NUMBER() OVER"
+                    " (PARTITION BY model, conversation ORDER BY id DESC) AS rank FROM exchanges)"
+                    " WHERE rank > ?)",
+                    (self.max_per_model,),
+                )
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print(f"Erreur lors de la compaction de l'historique : {e}")
 
-GET_NETWORK_INTERFACES_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "get_network_interfaces",
-        "description": "Récupère les interfaces réseau de la machine locale avec leurs adresses IP. Utile pour connaître l'IP locale et le sous-réseau.",
-        "parameters": {
-            "type": "object",
-            "properties": {},
-            "required": [],
-        },
-    },
-}
 
-GET_SYSTEM_STATUS_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "get_system_status",
-        "description": "Récupère l'état du système local : OS, CPU, RAM, espace disque. Utile pour diagnostiquer la machine.",
-        "parameters": {
-            "type": "object",
-            "properties": {},
-            "required": [],
-        },
-    },
-}
+history_store = HistoryStore(HISTORY_DB, MAX_HISTORY_STORED, legacy_file=HISTORY_FILE)
 
-RECON_RAPIDE_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "run_reconnaissance_rapide",
-        "description": (
-            "Bundle d'analyse complète : effectue un Ping, un scan Nmap rapide (-F), "
-            "et une vérification HTTP (headers serveur + titre de la page) sur une cible. "
-            "Renvoie une synthèse structurée en 3 étapes."
-        ),
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "target": {
-                    "type": "string",
-                    "description": "Adresse IP ou nom de domaine de la cible.",
-                },
-            },
-            "required": ["target"],
-        },
-    },
-}
 
-LOCAL_DISCOVERY_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "run_local_discovery",
-        "description": (
-            "Bundle de découverte réseau local : détecte automatiquement l'IP locale, "
-            "calcule le sous-réseau, et effectue un Ping Sweep (nmap -sn) pour lister "
-            "toutes les machines connectées au réseau local."
-        ),
-        "parameters": {
-            "type": "object",
-            "properties": {},
-            "required": [],
-        },
-    },
-}
+def load_history():
+    """Historique {modèle: [échanges]} de la conversation par défaut (adaptateur sur history_store)."""
+    return {key: history_store.get(key) for key in MODELS.keys()}
 
-PORT_AUDIT_TOOL = {
-    "type": "function",
-    "function": {
-        "name": "run_port_audit",
-        "description": (
-            "Bundle d'audit de sécurité : scanne les ports d'administration sensibles "
-            "(21 FTP, 22 SSH, 23 Telnet, 3389 RDP, 445 SMB, 3306 MySQL, 5432 PostgreSQL) "
-            "avec détection de versions (-sV). Signale les services dangereux exposés "
-            "avec des alertes de sécurité détaillées."
-        ),
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "target": {
-                    "type": "string",
-                    "description": "Adresse IP ou nom de domaine de la cible à auditer.",
-                },
-            },
-            "required": ["target"],
-        },
-    },
-}
 
-TOOLS = [
-    NMAP_TOOL, PING_TOOL,
-    GET_NETWORK_INTERFACES_TOOL, GET_SYSTEM_STATUS_TOOL,
-    RECON_RAPIDE_TOOL, LOCAL_DISCOVERY_TOOL, PORT_AUDIT_TOOL,
-]
+def save_history(history_data):
+    """Remplace l'historique de la conversation par défaut (adaptateur sur history_store).
+    Le chemin de /ask utilise history_store.append, qui n'écrit qu'une ligne."""
+    start = time.monotonic()
+    try:
+        history_store.replace_all(history_data)
+        history_save_seconds.observe(time.monotonic() - start, "replace")
+    except Exception as e:
+        print(f"Erreur à la sauvegarde de l'historique : {e}")
 
-def build_messages(model_key: str, question: str, system_mode: str, use_context: bool):
+
+def build_messages(model_key: str, question: str, system_mode: str, use_context: bool,
+                   conversation_id: str = DEFAULT_CONVERSATION):
     # Lecture dynamique depuis les prompts chargés en mémoire
-    prompt_entry = system_prompts.get(system_mode, system_prompts.get("general", {}))
+    prompt_entry = prompt_store.get(system_mode) or prompt_store.get("general") or {}
     system_prompt = prompt_entry.get("content", "") if isinstance(prompt_entry, dict) else str(prompt_entry)
-    system_with_tools = f"{system_prompt}\n\n{TOOL_INSTRUCTIONS}"
+    system_with_tools = f"{system_prompt}\n\n{tool_registry.instructions()}"
     messages = [{"role": "system", "content": system_with_tools}]
 
-    if use_context and conversation_history.get(model_key):
-        # On ne prend que les X derniers échanges pour le contexte
-        for item in conversation_history[model_key][-MAX_HISTORY_CONTEXT:]:
+    if use_context:
+        if CONTEXT_STRATEGY == "window":
+            # On ne prend que les X derniers échanges pour le contexte
+            summary, exchanges = "", history_store.get(model_key, conversation_id)[-MAX_HISTORY_CONTEXT:]
+        else:
+            summary, exchanges = stable_context(model_key, conversation_id)
+        if summary:
+            messages.append({"role": "system", "content": f"Résumé des échanges précédents :\n{summary}"})
+        for item in exchanges:
             messages.append({"role": "user", "content": item["question"]})
             messages.append({"role": "assistant", "content": item["answer"]})
 
@@ -358,15 +761,898 @@ def build_messages(model_key: str, question: str, system_mode: str, use_context:
     return messages
 
 
+def _clip(text, limit):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def summarize_exchanges(previous, exchanges):
+    """Résumé extractif et déterministe : une ligne par échange, les plus
+    anciennes lignes oubliées au-delà de CONTEXT_SUMMARY_MAX_CHARS. Déterministe
+    pour que deux workers produisant le même checkpoint obtiennent le même texte."""
+    lines = previous.splitlines() if previous else []
+    for item in exchanges:
+        lines.append(f"- Q : {_clip(item['question'], 160)} → R : {_clip(item['answer'], 240)}")
+    while len(lines) > 1 and len("\n".join(lines)) > CONTEXT_SUMMARY_MAX_CHARS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def stable_context(model_key, conversation_id=DEFAULT_CONVERSATION):
+    """(résumé, échanges) à placer avant la question, en ajout seul depuis le
+    dernier checkpoint : le préfixe envoyé à Ollama reste identique d'un tour
+    à l'autre, ce qui lui permet de réutiliser son cache KV."""
+    history = history_store.get(model_key, conversation_id)
+    checkpoint = history_store.checkpoint(model_key, conversation_id)
+    upto = checkpoint["upto_id"] if checkpoint else 0
+    recent = [item for item in history if item["id"] > upto]
+    if len(recent) > CONTEXT_CHECKPOINT_EVERY:
+        folded = recent[:-CONTEXT_KEEP_RECENT]
+        summary = summarize_exchanges(checkpoint["summary"] if checkpoint else "", folded)
+        checkpoint = history_store.set_checkpoint(
+            model_key, conversation_id, folded[-1]["id"], summary
+        )
+        recent = [item for item in history if item["id"] > checkpoint["upto_id"]]
+    return (checkpoint["summary"] if checkpoint else ""), recent
+
+
 def safe_json_loads(raw_arguments):
     if not raw_arguments:
         return {}
+    # Ollama transmet généralement les arguments déjà décodés
+    if isinstance(raw_arguments, dict):
+        return raw_arguments
     try:
         return json.loads(raw_arguments)
     except Exception:
         return {}
 
 
+# --- Exécution des sous-processus (annulables, nmap plafonné) ---
+# Limite le nombre de processus nmap simultanés, toutes requêtes et jobs confondus
+nmap_slots = threading.BoundedSemaphore(MAX_CONCURRENT_NMAP)
+# Job en cours d'exécution (None hors d'un worker de job). ContextVar plutôt
+# que threading.local pour suivre les sous-tâches lancées via submit_with_context.
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobCancelled(Exception):
+    """Levée quand le job courant a été annulé pendant l'exécution d'une commande."""
+
+
+def current_job():
+    return _current_job.get()
+
+
+# Destinataire de la progression de l'outil en cours : (nom de l'outil, callback)
+_progress = contextvars.ContextVar("tool_progress", default=None)
+
+
+def emit_progress(event, **data):
+    """Publie un événement de progression (host_found, port_open, stage, output...)
+    vers celui qui suit l'outil courant ; sans effet si personne ne suit."""
+    target = _progress.get()
+    if target is not None:
+        name, callback = target
+        callback({"tool": name, "event": event, **data})
+
+
+class ToolClock:
+    """Démarrage effectif d'un appel d'outil, une fois sa place de concurrence
+    obtenue : le timeout de l'outil court à partir de là. on_start(horodatage)
+    prévient un autre thread (boucle asyncio du chemin ASGI)."""
+
+    def __init__(self, timeout=None, on_start=None):
+        self.timeout = timeout
+        self.started_at = None
+        self._started = threading.Event()
+        self._on_start = on_start
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started.is_set():
+                return
+            self.started_at = time.monotonic()
+            self._started.set()
+        if self._on_start is not None:
+            self._on_start(self.started_at)
+
+    def wait(self, timeout=None):
+        """Horodatage du démarrage, None s'il n'a pas eu lieu dans `timeout`."""
+        self._started.wait(timeout)
+        return self.started_at
+
+    def time_left(self):
+        """Secondes avant l'échéance de l'appel, None sans échéance connue."""
+        if self.timeout is None or self.started_at is None:
+            return None
+        return self.started_at + self.timeout - time.monotonic()
+
+
+# Horloge de l'appel d'outil en cours (voir run_tool_calls)
+_tool_clock = contextvars.ContextVar("tool_clock", default=None)
+
+
+def mark_tool_started():
+    clock = _tool_clock.get()
+    if clock is not None:
+        clock.start()
+
+
+def bounded_timeout(timeout):
+    """timeout borné par le temps restant à l'appel d'outil courant : un outil
+    abandonné par run_tool_calls ne lance ni n'attend plus de sous-processus."""
+    clock = _tool_clock.get()
+    left = clock.time_left() if clock is not None else None
+    return timeout if left is None else max(0.0, min(timeout, left))
+
+
+def run_with_progress(name, callback, fn, *args):
+    """Exécute fn(*args) en envoyant sa progression à callback(événement)."""
+    if callback is None:
+        return fn(*args)
+    token = _progress.set((name, callback))
+    start = time.monotonic()
+    try:
+        return fn(*args)
+    finally:
+        emit_progress("done", duree_s=round(time.monotonic() - start, 2))
+        _progress.reset(token)
+
+
+def submit_with_context(executor, fn, *args):
+    """executor.submit en propageant le contexte courant (job, etc.) au worker."""
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, fn, *args)
+
+
+def kill_process(proc):
+    """Tue un processus enfant et ses descendants (groupe de processus sous POSIX)."""
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (OSError, ProcessLookupError):
+        pass
+
+
+@contextmanager
+def _child_process(cmd, timeout):
+    """Lance cmd en le rattachant au job courant, sous nmap_slots si besoin.
+    Le processus est tué s'il tourne encore à la sortie du bloc."""
+    job = current_job()
+    slot = nmap_slots if cmd[0] == "nmap" else None
+    if slot is not None and not slot.acquire(timeout=bounded_timeout(timeout)):
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    try:
+        if job is not None and job.cancel_requested:
+            raise JobCancelled()
+        if bounded_timeout(timeout) <= 0:
+            # Échéance de l'outil passée pendant l'attente : personne ne lira le résultat
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            start_new_session=(os.name == "posix"),
+        )
+        if job is not None:
+            job.attach(proc)
+        try:
+            yield proc
+        finally:
+            if proc.poll() is None:
+                kill_process(proc)
+                proc.wait()
+            if job is not None:
+                job.detach(proc)
+        if job is not None and job.cancel_requested:
+            raise JobCancelled()
+    finally:
+        if slot is not None:
+            slot.release()
+
+
+def run_command(cmd, timeout):
+    """Équivalent annulable de subprocess.run(cmd, capture_output=True, text=True).
+
+    Le processus est rattaché au job courant (s'il y en a un) pour pouvoir être
+    tué lors d'une annulation, et les appels à nmap passent par nmap_slots.
+    Chaque ligne de stdout est publiée comme progression ("output") dès sa sortie."""
+    def on_line(line):
+        line = line.rstrip()
+        if line:
+            emit_progress("output", line=line)
+
+    return stream_command(cmd, timeout, on_line)
+
+
+def stream_command(cmd, timeout, on_line):
+    """Comme run_command, mais chaque ligne de stdout est passée à on_line
+    dès que le processus l'écrit (sans attendre sa fin)."""
+    with _child_process(cmd, timeout) as proc:
+        timed_out = threading.Event()
+
+        def _expire():
+            timed_out.set()
+            kill_process(proc)
+
+        timer = threading.Timer(bounded_timeout(timeout), _expire)
+        timer.daemon = True
+        timer.start()
+        # stderr est vidé en parallèle pour ne pas bloquer le processus
+        stderr_chunks = []
+        drain = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+        drain.start()
+        lines = []
+        try:
+            for line in proc.stdout:
+                lines.append(line)
+                on_line(line)
+            proc.wait()
+            drain.join()
+        finally:
+            timer.cancel()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+    return subprocess.CompletedProcess(cmd, proc.returncode, "".join(lines), "".join(stderr_chunks))
+
+
+async def poll_acquire(semaphore, deadline):
+    """Acquiert un sémaphore partagé avec des threads sans bloquer la boucle
+    asyncio (attente par sondage). False si l'échéance passe avant."""
+    while not semaphore.acquire(blocking=False):
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True
+
+
+async def run_command_async(cmd, timeout):
+    """run_command pour le chemin ASGI : asyncio.create_subprocess_exec, aucune
+    thread bloquée pendant l'exécution. Même politique : groupe de processus tué
+    au timeout ou à l'annulation, nmap sous nmap_slots, lignes publiées en
+    progression ("output")."""
+    slot = nmap_slots if cmd[0] == "nmap" else None
+    deadline = time.monotonic() + timeout
+    if slot is not None and not await poll_acquire(slot, deadline):
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=(os.name == "posix"),
+        )
+        lines = []
+
+        async def read_stdout():
+            async for raw in proc.stdout:
+                line = raw.decode(errors="replace")
+                lines.append(line)
+                if line.strip():
+                    emit_progress("output", line=line.rstrip())
+
+        try:
+            _, stderr = await asyncio.wait_for(
+                asyncio.gather(read_stdout(), proc.stderr.read()),
+                max(0.0, deadline - time.monotonic()),
+            )
+            await proc.wait()
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(cmd, timeout) from None
+        finally:
+            if proc.returncode is None:
+                kill_process(proc)
+                await proc.wait()
+    finally:
+        if slot is not None:
+            slot.release()
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, "".join(lines), stderr.decode(errors="replace")
+    )
+
+
+# --- Moteur nmap : sortie XML parsée au fil de l'eau ---
+def _nmap_port_record(elem):
+    """Enregistrement compact d'un élément <port> du XML nmap."""
+    state = elem.find("state")
+    service = elem.find("service")
+    record = {
+        "port": int(elem.get("portid", 0)),
+        "protocol": elem.get("protocol", "tcp"),
+        "state": state.get("state", "") if state is not None else "",
+    }
+    if service is not None:
+        record["service"] = service.get("name", "")
+        version = " ".join(
+            v for v in (service.get("product"), service.get("version"), service.get("extrainfo")) if v
+        )
+        if version:
+            record["version"] = version
+    return record
+
+
+def _nmap_host_record(elem):
+    """Enregistrement compact d'un élément <host> du XML nmap."""
+    record = {"ip": "", "status": ""}
+    status = elem.find("status")
+    if status is not None:
+        record["status"] = status.get("state", "")
+    for address in elem.findall("address"):
+        addrtype = address.get("addrtype")
+        if addrtype in ("ipv4", "ipv6") and not record["ip"]:
+            record["ip"] = address.get("addr", "")
+        elif addrtype == "mac":
+            record["mac"] = address.get("addr", "")
+            if address.get("vendor"):
+                record["vendor"] = address.get("vendor")
+    hostname = elem.find("hostnames/hostname")
+    if hostname is not None:
+        record["hostname"] = hostname.get("name", "")
+    ports = [_nmap_port_record(p) for p in elem.findall("ports/port")]
+    if ports:
+        record["ports"] = ports
+    return record
+
+
+# Ligne de sortie normale (-v) émise dès qu'un port ouvert est trouvé,
+# "on <ip>" ou "on <nom> (<ip>)"
+_NMAP_DISCOVERED_RE = re.compile(r"Discovered open port (\d+)/(\w+) on (?:.* \()?([^\s()]+)\)?$")
+
+
+def run_nmap_scan(args, timeout, on_host=None, on_port=None):
+    """Lance nmap et parse son XML incrémentalement.
+
+    on_host(host_record) est appelé à chaque <host> complet. nmap n'écrit les
+    <port> d'un hôte qu'une fois celui-ci terminé : avec on_port, le XML part
+    dans un fichier temporaire et la sortie normale (-v) signale chaque port
+    ouvert dès sa découverte. on_port(ip, port_record) est appelé une fois par
+    port. Retourne {"command", "hosts", "returncode"} ou {"command", "error"} ;
+    aucune sortie brute n'est conservée."""
+    xml_path = None
+    if on_port is not None:
+        fd, xml_path = tempfile.mkstemp(prefix="nmap-", suffix=".xml")
+        os.close(fd)
+        cmd = ["nmap", "-v", *args, "-oX", xml_path]
+    else:
+        cmd = ["nmap", *args, "-oX", "-"]
+    try:
+        if shutil.which("nmap") is None:
+            return {"command": " ".join(cmd), "error": "nmap introuvable sur le serveur."}
+        return _run_nmap_xml(cmd, timeout, xml_path, on_host, on_port)
+    finally:
+        if xml_path is not None:
+            os.unlink(xml_path)
+
+
+def _run_nmap_xml(cmd, timeout, xml_path, on_host, on_port):
+    """Exécution de run_nmap_scan : XML sur stdout, ou dans xml_path lu à la fin."""
+    parser = ET.XMLPullParser(events=("end",))
+    hosts = []
+    current_ip = {"value": ""}
+    announced = set()
+
+    def announce(ip, port):
+        key = (ip, port["port"], port["protocol"])
+        if key in announced:
+            return
+        announced.add(key)
+        if port["state"] == "open":
+            emit_progress("port_open", ip=ip, port=port["port"], service=port.get("service", ""))
+        if on_port is not None:
+            on_port(ip, port)
+
+    def handle_events():
+        for _, elem in parser.read_events():
+            if elem.tag == "address" and elem.get("addrtype") in ("ipv4", "ipv6"):
+                current_ip["value"] = elem.get("addr", "")
+            elif elem.tag == "port":
+                announce(current_ip["value"], _nmap_port_record(elem))
+            elif elem.tag == "host":
+                host = _nmap_host_record(elem)
+                hosts.append(host)
+                if host.get("status") == "up":
+                    emit_progress("host_found", ip=host["ip"])
+                if on_host is not None:
+                    on_host(host)
+                elem.clear()
+
+    def on_line(line):
+        if xml_path is None:
+            parser.feed(line)
+            handle_events()
+            return
+        match = _NMAP_DISCOVERED_RE.search(line.strip())
+        if match:
+            port = int(match.group(1))
+            announce(match.group(3), {"port": port, "protocol": match.group(2),
+                                      "state": "open", "service": _service_name(port)})
+
+    def parse_xml_file():
+        # Hôtes complets (versions, ports fermés) : lus une fois nmap terminé
+        if xml_path is None:
+            return
+        with open(xml_path, encoding="utf-8", errors="replace") as xml_file:
+            parser.feed(xml_file.read())
+        handle_events()
+
+    error = None
+    try:
+        result = stream_command(cmd, timeout=timeout, on_line=on_line)
+    except subprocess.TimeoutExpired:
+        error = f"nmap a dépassé le délai autorisé ({timeout}s)."
+    except Exception as exc:
+        error = f"Erreur lors de l'exécution de nmap: {exc}"
+
+    try:
+        parse_xml_file()
+        parser.close()
+        handle_events()
+    except ET.ParseError:
+        # Sortie tronquée (nmap interrompu) : on garde les hôtes déjà parsés
+        pass
+
+    if error is not None:
+        return {"command": " ".join(cmd), "hosts": hosts, "error": error}
+    scan = {"command": " ".join(cmd), "hosts": hosts, "returncode": result.returncode}
+    if result.returncode != 0 and not hosts:
+        scan["error"] = (result.stderr or "").strip() or f"nmap a échoué (code {result.returncode})."
+    return scan
+
+
+# ---------------------------------------------------------------------------
+# Découverte d'hôtes native (sans nmap) : sondes TCP connect asyncio, plus
+# ICMP echo quand une socket ICMP est disponible (root/CAP_NET_RAW ou
+# net.ipv4.ping_group_range). Les hôtes sont produits dès qu'ils répondent.
+# ---------------------------------------------------------------------------
+
+class _RateLimiter:
+    """Espace régulièrement les sondes (rate sondes/s, <= 0 = illimité).
+    Utilisé depuis une seule boucle asyncio : pas de verrou nécessaire."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _fd_budget(wanted):
+    """Borne la concurrence sous la limite de descripteurs du processus."""
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError, OSError):
+        return wanted
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(16, min(wanted, soft - 64))
+
+
+async def _tcp_probe(ip, port, timeout):
+    """True si l'hôte répond sur ce port : connexion acceptée ou refusée (RST)."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except ConnectionRefusedError:
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.transport.abort()
+    return True
+
+
+async def _probe_host(ip, ports, timeout, limiter, slots):
+    """Sonde les ports en parallèle ; (méthode, rtt_ms) à la première réponse."""
+    async def attempt(port):
+        async with slots:
+            await limiter.wait()
+            start = time.monotonic()
+            if await _tcp_probe(ip, port, timeout):
+                return f"tcp/{port}", (time.monotonic() - start) * 1000
+        return None
+
+    tasks = [asyncio.ensure_future(attempt(port)) for port in ports]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            hit = await next_done
+            if hit:
+                return hit
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _open_icmp_socket():
+    """Socket ICMP brute (privilégiée) ou datagramme (Linux), sinon (None, False)."""
+    for kind in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+        except (OSError, AttributeError):
+            continue
+        sock.setblocking(False)
+        return sock, kind == socket.SOCK_RAW
+    return None, False
+
+
+def _icmp_echo_packet(ident, seq):
+    def checksum(data):
+        total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+    payload = b"ialocal-sweep..."
+    header = struct.pack("!BBHHH", 8, 0, 0, ident, seq)
+    return struct.pack("!BBHHH", 8, 0, checksum(header + payload), ident, seq) + payload
+
+
+async def _icmp_sweep(sock, raw, targets, limiter, found, wait):
+    """Envoie un echo à chaque cible puis attend `wait` s les réponses tardives."""
+    loop = asyncio.get_running_loop()
+    sent = {}
+
+    def on_readable():
+        while True:
+            try:
+                data, (src, _) = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError, OSError):
+                return
+            if raw:
+                data = data[(data[0] & 0x0F) * 4:]   # en-tête IP présent en mode brut
+            if data and data[0] == 0 and src in sent:  # type 0 = echo reply
+                found(src, "icmp", (time.monotonic() - sent.pop(src)) * 1000)
+
+    loop.add_reader(sock.fileno(), on_readable)
+    try:
+        ident = os.getpid() & 0xFFFF
+        for seq, ip in enumerate(targets):
+            await limiter.wait()
+            sent[ip] = time.monotonic()
+            try:
+                sock.sendto(_icmp_echo_packet(ident, seq & 0xFFFF), (ip, 0))
+            except OSError:
+                sent.pop(ip, None)
+        await asyncio.sleep(wait)
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def sweep_network_async(network, ports=None, concurrency=None, rate=None,
+                              timeout=None, icmp=True, deadline=None, should_stop=None):
+    """Générateur asynchrone des hôtes actifs de `network`, dans l'ordre des réponses.
+
+    Chaque hôte produit est {"ip", "method", "rtt_ms"}. deadline (s) borne la durée
+    totale ; should_stop() est interrogé régulièrement pour interrompre le balayage."""
+    ports = ports or DISCOVERY_PORTS
+    timeout = timeout or DISCOVERY_PROBE_TIMEOUT
+    slots = asyncio.Semaphore(_fd_budget(concurrency or DISCOVERY_CONCURRENCY))
+    limiter = _RateLimiter(DISCOVERY_RATE if rate is None else rate)
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + deadline if deadline else None
+    targets = [str(ip) for ip in network.hosts()]
+    queue = asyncio.Queue()
+    seen = set()
+    host_tasks = {}
+
+    def found(ip, method, rtt):
+        if ip in seen:
+            return
+        seen.add(ip)
+        queue.put_nowait({"ip": ip, "method": method, "rtt_ms": round(rtt, 1)})
+        task = host_tasks.get(ip)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()   # déjà trouvé par ICMP : inutile de continuer en TCP
+
+    async def probe(ip):
+        hit = await _probe_host(ip, ports, timeout, limiter, slots)
+        if hit:
+            found(ip, *hit)
+
+    sock, raw = _open_icmp_socket() if icmp else (None, False)
+    workers = []
+    if sock is not None:
+        workers.append(asyncio.ensure_future(
+            _icmp_sweep(sock, raw, targets, _RateLimiter(DISCOVERY_RATE if rate is None else rate),
+                        found, wait=min(1.0, timeout * 2))
+        ))
+    for ip in targets:
+        host_tasks[ip] = asyncio.ensure_future(probe(ip))
+    workers.extend(host_tasks.values())
+    finished = asyncio.gather(*workers, return_exceptions=True)
+    finished.add_done_callback(lambda _: queue.put_nowait(None))
+
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), 0.25)
+            except asyncio.TimeoutError:
+                if (stop_at is not None and loop.time() >= stop_at) or (should_stop and should_stop()):
+                    return
+                continue
+            if item is None:
+                return
+            yield item
+    finally:
+        for task in workers:
+            task.cancel()
+        finished.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if sock is not None:
+            sock.close()
+
+
+def sweep_network(network, on_host=None, **options):
+    """Version synchrone pour les threads d'outils : liste des hôtes actifs.
+
+    on_host(host) est appelé à chaque découverte. Respecte l'annulation du job courant."""
+    job = current_job()
+
+    async def collect():
+        hosts = []
+        async for host in sweep_network_async(
+            network, should_stop=lambda: job is not None and job.cancel_requested, **options
+        ):
+            hosts.append(host)
+            emit_progress("host_found", ip=host["ip"], method=host["method"])
+            if on_host is not None:
+                on_host(host)
+        return hosts
+
+    hosts = asyncio.run(collect())
+    if job is not None and job.cancel_requested:
+        raise JobCancelled()
+    return sorted(hosts, key=lambda h: ipaddress.ip_address(h["ip"]))
+
+
+def _arp_table():
+    """Adresses MAC connues du noyau (Linux, /proc/net/arp), remplies par le balayage."""
+    table = {}
+    try:
+        with open("/proc/net/arp", encoding="utf-8") as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 4 and fields[3] != "00:00:00:00:00:00":
+                    table[fields[0]] = fields[3].upper()
+    except OSError:
+        pass
+    return table
+
+
+# ---------------------------------------------------------------------------
+# Scanner de ports natif : connect() TCP asyncio + capture de bannière.
+# Sert de moteur quand nmap est absent, et de pré-passe rapide qui ne
+# transmet à nmap -sV que les ports réellement ouverts.
+# ---------------------------------------------------------------------------
+
+# Ports de nmap -F (top 100 TCP), pour le scan rapide natif
+FAST_SCAN_PORTS = [
+    7, 9, 13, 21, 22, 23, 25, 26, 37, 53, 79, 80, 81, 88, 106, 110, 111, 113, 119, 135,
+    139, 143, 144, 179, 199, 389, 427, 443, 444, 445, 465, 513, 514, 515, 543, 544, 548,
+    554, 587, 631, 646, 873, 990, 993, 995, 1025, 1026, 1027, 1028, 1029, 1110, 1433,
+    1720, 1723, 1755, 1900, 2000, 2001, 2049, 2121, 2717, 3000, 3128, 3306, 3389, 3986,
+    4899, 5000, 5009, 5051, 5060, 5101, 5190, 5357, 5432, 5631, 5666, 5800, 5900, 6000,
+    6001, 6646, 7070, 8000, 8008, 8009, 8080, 8081, 8443, 8888, 9100, 9999, 10000, 32768,
+    49152, 49153, 49154, 49155, 49156, 49157,
+]
+# Ports où le serveur attend la requête du client avant de parler
+HTTP_BANNER_PORTS = {80, 81, 3000, 5000, 8000, 8008, 8080, 8081, 8888}
+# Au-delà de ce nombre de ports, seuls les ports ouverts sont détaillés (comme nmap)
+SCAN_DETAIL_MAX_PORTS = 32
+# Nombre maximal de sondes (hôtes × ports) d'un scan natif
+SCAN_MAX_PROBES = int(os.getenv("SCAN_MAX_PROBES", "262144"))
+
+
+def _too_many_probes(hosts, ports):
+    return (f"Scan trop large ({hosts} hôte(s) × {ports} port(s)) : "
+            f"{SCAN_MAX_PROBES} sondes au maximum, réduisez la plage de ports ou de cibles.")
+
+
+def parse_port_spec(spec):
+    """"22,80,1-1024" → liste triée de ports ; ValueError si hors limites."""
+    ports = set()
+    for part in spec.split(","):
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        low, high = int(low), int(high or low)
+        if not 1 <= low <= high <= 65535:
+            raise ValueError(f"Plage de ports invalide : {part}")
+        ports.update(range(low, high + 1))
+    return sorted(ports)
+
+
+def expand_scan_targets(target, max_prefix=DISCOVERY_MIN_PREFIX):
+    """Cible (IP, nom ou CIDR) → liste d'IPv4 à scanner.
+
+    ValueError pour les syntaxes propres à nmap (plages 10.0.0.1-20...) ou un
+    réseau plus large que /max_prefix ; OSError si le nom ne se résout pas."""
+    if "/" in target:
+        network = ipaddress.ip_network(target, strict=False)
+        if network.version != 4 or network.prefixlen < max_prefix:
+            raise ValueError(f"Réseau trop large pour le scanner natif (/{max_prefix} minimum).")
+        return [str(ip) for ip in network.hosts()]
+    try:
+        return [str(ipaddress.IPv4Address(target))]
+    except ValueError:
+        pass
+    if not re.fullmatch(r"[A-Za-z0-9.-]+", target):
+        raise ValueError("Syntaxe de cible non supportée par le scanner natif.")
+    return [socket.getaddrinfo(target, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]]
+
+
+def _service_name(port):
+    try:
+        return socket.getservbyport(port, "tcp")
+    except OSError:
+        return "unknown"
+
+
+async def _grab_banner(reader, writer, port, timeout):
+    """Première ligne envoyée par le service (requête HEAD pour les ports HTTP)."""
+    try:
+        if port in HTTP_BANNER_PORTS:
+            writer.write(b"HEAD / HTTP/1.0\r\n\r\n")
+        data = await asyncio.wait_for(reader.read(256), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return ""
+    line = data.split(b"\n", 1)[0].decode("utf-8", "replace").strip()
+    return "".join(c for c in line if c.isprintable())[:120]
+
+
+async def _connect_scan_port(ip, port, limiter, timeout, banner_timeout):
+    """Enregistrement au format _nmap_port_record : open / closed / filtered."""
+    record = {"port": port, "protocol": "tcp", "state": "filtered", "service": _service_name(port)}
+    await limiter.wait()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except ConnectionRefusedError:
+        record["state"] = "closed"
+        return record
+    except (OSError, asyncio.TimeoutError):
+        return record
+    record["state"] = "open"
+    try:
+        if banner_timeout:
+            banner = await _grab_banner(reader, writer, port, banner_timeout)
+            if banner:
+                record["banner"] = banner
+    finally:
+        writer.transport.abort()
+    return record
+
+
+async def connect_scan_async(targets, ports, on_port=None, concurrency=None, rate=None,
+                             timeout=None, banner_timeout=None, deadline=None, should_stop=None):
+    """Scan connect() de targets × ports par un nombre fixe de coroutines.
+
+    Les couples (ip, port) sont produits à la demande : la mémoire ne dépend
+    que de la concurrence, pas de la taille du scan. Au-delà de
+    SCAN_DETAIL_MAX_PORTS ports, seuls les ports ouverts sont gardés.
+    on_port(ip, record) est appelé pour chaque port ouvert dès sa détection.
+    Retourne ({ip: [records]}, {ip ayant répondu}) ; un arrêt (deadline,
+    should_stop) rend le partiel."""
+    limiter = _RateLimiter(SCAN_RATE if rate is None else rate)
+    timeout = timeout or SCAN_CONNECT_TIMEOUT
+    banner_timeout = SCAN_BANNER_TIMEOUT if banner_timeout is None else banner_timeout
+    keep_all = len(ports) <= SCAN_DETAIL_MAX_PORTS
+    results = {ip: [] for ip in targets}
+    answered = set()
+    pairs = ((ip, port) for ip in targets for port in ports)
+
+    async def worker():
+        for ip, port in pairs:
+            record = await _connect_scan_port(ip, port, limiter, timeout, banner_timeout)
+            if record["state"] != "filtered":
+                answered.add(ip)
+            if record["state"] == "open":
+                emit_progress("port_open", ip=ip, port=port, service=record["service"])
+                if on_port is not None:
+                    on_port(ip, record)
+            if keep_all or record["state"] == "open":
+                results[ip].append(record)
+
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + deadline if deadline else None
+    workers = min(_fd_budget(concurrency or SCAN_CONCURRENCY), len(targets) * len(ports))
+    tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+    pending = set(tasks)
+    try:
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=0.25)
+            if (stop_at is not None and loop.time() >= stop_at) or (should_stop and should_stop()):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for records in results.values():
+        records.sort(key=lambda r: r["port"])
+    return results, answered
+
+
+def connect_scan(target, ports, on_port=None, timeout=60, **options):
+    """Version synchrone au format de run_nmap_scan : {"command", "hosts", "returncode"}.
+
+    target est une cible (IP, nom, CIDR) ou une liste d'IP déjà résolues. Un hôte
+    est retenu s'il a répondu sur au moins un port (cible unique : toujours)."""
+    if isinstance(target, str):
+        command = f"connect-scan natif -p {len(ports)} port(s) {target}"
+        try:
+            targets = expand_scan_targets(target)
+        except (ValueError, OSError) as exc:
+            return {"command": command, "error": f"Cible non scannable nativement : {exc}"}
+    else:
+        targets = list(target)
+        command = f"connect-scan natif -p {len(ports)} port(s) {len(targets)} hôte(s)"
+
+    if len(targets) * len(ports) > SCAN_MAX_PROBES:
+        return {"command": command, "error": _too_many_probes(len(targets), len(ports))}
+
+    job = current_job()
+    results, answered_ips = asyncio.run(connect_scan_async(
+        targets, ports, on_port=on_port, deadline=timeout,
+        should_stop=lambda: job is not None and job.cancel_requested, **options
+    ))
+    if job is not None and job.cancel_requested:
+        raise JobCancelled()
+
+    hosts = []
+    for ip, records in results.items():
+        answered = ip in answered_ips
+        if not answered and len(targets) > 1:
+            continue
+        hosts.append({"ip": ip, "status": "up" if answered else "unknown", "ports": records})
+    return {"command": command, "hosts": hosts, "returncode": 0}
+
+
+def _merge_versions(records, nmap_hosts):
+    """Reporte service/version de nmap -sV sur les enregistrements du scan natif."""
+    detected = {p["port"]: p for host in nmap_hosts for p in host.get("ports", [])}
+    for record in records:
+        found = detected.get(record["port"])
+        if found:
+            record["service"] = found.get("service") or record["service"]
+            if found.get("version"):
+                record["version"] = found["version"]
+    return records
+
+
+def _scan_backend(arguments):
+    """Moteur de scan demandé (argument "backend" ou SCAN_BACKEND), natif si nmap manque."""
+    backend = (arguments.get("backend") or SCAN_BACKEND).strip().lower()
+    if backend not in ("auto", "native", "nmap"):
+        backend = "auto"
+    if backend != "native" and shutil.which("nmap") is None:
+        return "native"
+    return backend
+
+
+def _open_ports_by_host(hosts):
+    return {
+        host["ip"]: [p["port"] for p in host.get("ports", []) if p["state"] == "open"]
+        for host in hosts
+        if any(p["state"] == "open" for p in host.get("ports", []))
+    }
+
+
+def _scan_host_count(target):
+    """Nombre d'hôtes d'une cible sans résolution DNS (CIDR, plage nmap, hôte)."""
+    if "/" not in target:
+        return _nmap_target_count(target)
+    try:
+        return ipaddress.ip_network(target, strict=False).num_addresses
+    except ValueError:
+        return 1
+
+
 def run_nmap_tool(arguments: dict):
     target = (arguments.get("target") or "").strip()
     ports = (arguments.get("ports") or "").strip()
@@ -383,11 +1669,46 @@ def run_nmap_tool(arguments: dict):
     if ports and not re.fullmatch(r"[0-9,\-]+", ports):
         return {"error": "Format de ports invalide. Ex: 22,80,443 ou 1-1024."}
 
-    if shutil.which("nmap") is None:
-        return {"error": "nmap introuvable sur le serveur."}
+    backend = _scan_backend(arguments)
+    target_args, prepass = [target], None
+    if backend == "native" or (backend == "auto" and service_versions):
+        try:
+            port_list = parse_port_spec(ports) if ports else (
+                FAST_SCAN_PORTS if fast_scan else list(range(1, 1025))
+            )
+        except ValueError as exc:
+            return {"error": str(exc)}
+        host_count = _scan_host_count(target)
+        if host_count * len(port_list) > SCAN_MAX_PROBES:
+            return {"error": _too_many_probes(host_count, len(port_list))}
+
+    if backend == "native":
+        scan = connect_scan(target, port_list, timeout=40)
+        result = {"moteur": "natif", **scan}
+        if shutil.which("nmap") is None:
+            result["note"] = "nmap introuvable : scan connect() natif (bannières à la place de -sV)."
+        return result
+
+    if backend == "auto" and service_versions:
+        # Pré-passe native : nmap -sV ne reçoit que les ports réellement ouverts
+        start = time.monotonic()
+        scan = connect_scan(target, port_list, timeout=20, banner_timeout=0)
+        if not scan.get("error"):
+            open_ports = _open_ports_by_host(scan["hosts"])
+            prepass = {
+                "command": scan["command"],
+                "open_ports": open_ports,
+                "duree_s": round(time.monotonic() - start, 2),
+            }
+            if not open_ports:
+                return {"moteur": "hybride", **scan, "note": "Aucun port ouvert : détection de versions inutile."}
+            ports = ",".join(str(p) for p in sorted({p for found in open_ports.values() for p in found}))
+            fast_scan, skip_ping = False, True
+            target_args = list(open_ports)
+        # En cas d'erreur (syntaxe propre à nmap, 10.0.0.1-20...) : scan nmap complet
 
     cmd = ["nmap"]
-    if fast_scan:
+    if fast_scan and not ports:
         cmd.append("-F")
     if service_versions:
         cmd.append("-sV")
@@ -395,136 +1716,483 @@ def run_nmap_tool(arguments: dict):
         cmd.append("-Pn")
     if ports:
         cmd.extend(["-p", ports])
-    cmd.append(target)
+    cmd.extend(target_args)
 
     try:
-        # Note: subprocess.run est bloquant. 
-        # Pour une V2, envisager Celery ou un Threading asynchrone.
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=40,
-            check=False,
-        )
-        return {
+        # Bloquant : pour libérer /ask, lancer l'outil en job (voir JobManager)
+        result = run_command(cmd, timeout=40)
+        output = {
             "command": " ".join(cmd),
             "returncode": result.returncode,
             "stdout": result.stdout,
             "stderr": result.stderr,
         }
+        if prepass is not None:
+            output["prepass"] = prepass
+        return output
     except subprocess.TimeoutExpired:
         return {"error": "nmap a dépassé le délai autorisé (timeout)."}
     except Exception as exc:
         return {"error": f"Erreur lors de l'exécution de nmap: {exc}"}
 
-def run_ping_tool(arguments: dict):
+def _ping_command(arguments):
+    """Valide la cible du ping ; retourne (commande, None) ou (None, erreur)."""
     target = (arguments.get("target") or "").strip()
 
     if not target:
-        return {"error": "Cible manquante pour ping."}
+        return None, {"error": "Cible manquante pour ping."}
 
     if not re.fullmatch(r"[A-Za-z0-9_.:/-]+", target):
-        return {"error": "Cible invalide (caracteres non autorises)."}
+        return None, {"error": "Cible invalide (caracteres non autorises)."}
 
     param = "-n" if platform.system().lower() == "windows" else "-c"
-    cmd = ["ping", param, "4", target]
+    return ["ping", param, "4", target], None
+
+
+def _ping_result(cmd, result):
+    return {
+        "command": " ".join(cmd),
+        "returncode": result.returncode,
+        "stdout": result.stdout,
+        "stderr": result.stderr,
+    }
+
+
+def run_ping_tool(arguments: dict):
+    cmd, error = _ping_command(arguments)
+    if error:
+        return error
 
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout= 10,
-            check=False,
-        )
-        return {
-            "command": " ".join(cmd),
-            "returncode": result.returncode,
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-        }
+        return _ping_result(cmd, run_command(cmd, timeout=10))
     except subprocess.TimeoutExpired:
         return {"error": "Le ping a dépassé le delai autorise (timeout)."}
     except Exception as exc:  # noqa: BLE001
         return {"error": f"Erreur lors de l'execution de ping: {exc}"}
 
 
-def get_network_interfaces_tool():
-    """Récupère les interfaces réseau de la machine locale."""
+async def run_ping_tool_async(arguments: dict):
+    """run_ping_tool pour le chemin ASGI (sous-processus asyncio, sans thread)."""
+    cmd, error = _ping_command(arguments)
+    if error:
+        return error
+
     try:
-        import psutil
+        return _ping_result(cmd, await run_command_async(cmd, timeout=10))
+    except subprocess.TimeoutExpired:
+        return {"error": "Le ping a dépassé le delai autorise (timeout)."}
+    except Exception as exc:  # noqa: BLE001
+        return {"error": f"Erreur lors de l'execution de ping: {exc}"}
+
+
+# --- Topologie réseau locale (interfaces, IP principale, route par défaut) ---
+def _default_route():
+    """Route IPv4 par défaut lue dans /proc/net/route (Linux) : (passerelle, interface) ou None."""
+    try:
+        with open("/proc/net/route", encoding="utf-8") as f:
+            next(f, None)
+            routes = [line.split() for line in f]
+    except OSError:
+        return None
+    best = None
+    for fields in routes:
+        if len(fields) < 8 or fields[1] != "00000000" or fields[7] != "00000000":
+            continue
+        flags, metric = int(fields[3], 16), int(fields[6])
+        if not flags & 0x1:   # RTF_UP
+            continue
+        gateway = socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+        if best is None or metric < best[2]:
+            best = (gateway, fields[0], metric)
+    return best[:2] if best else None
+
+
+def _outbound_ip():
+    """IP source choisie par le noyau pour sortir : connect() UDP, aucun paquet envoyé."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+class NetworkTopology:
+    """Vue en mémoire du réseau local, partagée par les outils réseau.
+
+    Calculée une fois, puis rafraîchie par un thread : à chaque notification
+    netlink (adresse, lien ou route modifiés, Linux) et au plus tard toutes
+    les `refresh_interval` secondes ; sans netlink, par sondage périodique.
+    L'IP principale vient de la route par défaut, sans résolution DNS."""
+
+    # Groupes netlink : RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+    NETLINK_GROUPS = 0x1 | 0x10 | 0x40
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._computed_at = 0.0
+        self._thread = None
+        self.refreshes = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.refresh()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="network-topology")
+        self._thread.start()
+
+    def _netlink_socket(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, self.NETLINK_GROUPS))
+            return sock
+        except (AttributeError, OSError):
+            return None
+
+    def _loop(self):
+        sock = self._netlink_socket()
+        if sock is None:
+            while True:
+                time.sleep(min(self.refresh_interval, NETWORK_POLL_INTERVAL))
+                self._refresh_quietly()
+        sock.settimeout(self.refresh_interval)
+        while True:
+            try:
+                sock.recv(65536)
+                # Un changement arrive souvent en rafale (lien, adresse, route) : on regroupe
+                sock.settimeout(0.2)
+                try:
+                    while True:
+                        sock.recv(65536)
+                except socket.timeout:
+                    pass
+                finally:
+                    sock.settimeout(self.refresh_interval)
+            except socket.timeout:
+                pass
+            except OSError:
+                time.sleep(1)
+            self._refresh_quietly()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as exc:  # noqa: BLE001 - le thread ne doit pas mourir
+            print(f"Rafraîchissement de la topologie réseau en échec : {exc}")
+
+    def refresh(self):
+        snapshot = self._compute()
+        with self._lock:
+            self._snapshot = snapshot
+            self._computed_at = time.monotonic()
+            self.refreshes += 1
+        return snapshot
+
+    def get(self):
+        """Dernière topologie connue ; recalculée si périmée (thread non démarré)."""
+        with self._lock:
+            snapshot, age = self._snapshot, time.monotonic() - self._computed_at
+        if snapshot is None or (self._thread is None and age > self.refresh_interval):
+            snapshot = self.refresh()
+        return snapshot
+
+    @staticmethod
+    def _compute():
         interfaces = {}
-        for name, addrs in psutil.net_if_addrs().items():
-            iface_info = []
-            for addr in addrs:
-                if addr.family == socket.AF_INET:
-                    iface_info.append({
-                        "ip": addr.address,
-                        "netmask": addr.netmask,
-                        "broadcast": addr.broadcast,
-                    })
-            if iface_info:
-                interfaces[name] = iface_info
-
-        hostname = socket.gethostname()
-        # IP principale (celle utilisée pour sortir vers Internet)
+        psutil_available = True
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            main_ip = s.getsockname()[0]
-            s.close()
-        except Exception:
-            main_ip = socket.gethostbyname(hostname)
+            import psutil
+
+            for name, addrs in psutil.net_if_addrs().items():
+                iface_info = []
+                for addr in addrs:
+                    if addr.family == socket.AF_INET:
+                        entry = {
+                            "ip": addr.address,
+                            "netmask": addr.netmask,
+                            "broadcast": addr.broadcast,
+                        }
+                        if addr.netmask:
+                            entry["prefix"] = ipaddress.ip_network(
+                                f"0.0.0.0/{addr.netmask}"
+                            ).prefixlen
+                        iface_info.append(entry)
+                if iface_info:
+                    interfaces[name] = iface_info
+        except ImportError:
+            psutil_available = False
+
+        route = _default_route()
+        main_ip, main_iface, prefix = None, None, None
+        # IP principale : adresse de l'interface de la route par défaut
+        if route and route[1] in interfaces:
+            main_iface = route[1]
+            main_ip = interfaces[main_iface][0]["ip"]
+        if main_ip is None:
+            main_ip = _outbound_ip()
+        if main_ip is None:
+            # Hôte hors ligne sans route : première adresse hors boucle locale
+            main_ip = next(
+                (a["ip"] for addrs in interfaces.values() for a in addrs
+                 if not a["ip"].startswith("127.")),
+                "127.0.0.1",
+            )
+        for name, addrs in interfaces.items():
+            for addr in addrs:
+                if addr["ip"] == main_ip:
+                    main_iface, prefix = name, addr.get("prefix")
 
+        network = None
+        if prefix is not None:
+            network = ipaddress.ip_network(f"{main_ip}/{prefix}", strict=False)
         return {
-            "hostname": hostname,
+            "hostname": socket.gethostname(),
             "main_ip": main_ip,
+            "main_interface": main_iface,
+            "subnet": str(network) if network else None,
+            "prefix": prefix,
+            "default_gateway": route[0] if route else None,
+            "default_interface": route[1] if route else None,
             "interfaces": interfaces,
+            "psutil": psutil_available,
         }
-    except ImportError:
-        hostname = socket.gethostname()
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            main_ip = s.getsockname()[0]
-            s.close()
-        except Exception:
-            main_ip = socket.gethostbyname(hostname)
-        return {
-            "hostname": hostname,
-            "main_ip": main_ip,
-            "note": "Module psutil non installé — informations limitées. pip install psutil",
-        }
+
+    def primary_network(self):
+        """(IP principale, sous-réseau réel) ; /24 si le masque est inconnu."""
+        snapshot = self.get()
+        main_ip = snapshot["main_ip"]
+        if snapshot["subnet"]:
+            return main_ip, ipaddress.ip_network(snapshot["subnet"])
+        return main_ip, ipaddress.ip_network(f"{main_ip}/24", strict=False)
+
+
+network_topology = NetworkTopology(NETWORK_REFRESH_INTERVAL)
+
+
+def get_network_interfaces_tool(arguments=None):
+    """Interfaces réseau de la machine locale, IP principale, sous-réseau et
+    route par défaut, servis depuis network_topology."""
+    try:
+        snapshot = network_topology.get()
     except Exception as e:
         return {"error": f"Erreur lors de la récupération des interfaces : {e}"}
+    result = {key: value for key, value in snapshot.items() if key != "psutil"}
+    if not snapshot["psutil"]:
+        del result["interfaces"]
+        result["note"] = "Module psutil non installé — informations limitées. pip install psutil"
+    return result
+
+
+# --- Télémétrie système : échantillonneur en arrière-plan ---
+class SystemSampler:
+    """Mesure CPU (par cœur), mémoire, disque, E/S disque et réseau et charge
+    moyenne toutes les `interval` secondes, dans un anneau de `capacity`
+    échantillons (une array('d') par métrique, NaN = non disponible).
+
+    get_system_status répond ainsi instantanément depuis le dernier échantillon,
+    au lieu de bloquer une seconde sur psutil.cpu_percent(interval=1)."""
+
+    METRICS = (
+        "cpu_percent", "mem_percent", "mem_used_gb", "mem_available_gb", "swap_percent",
+        "disk_percent", "disk_read_kbps", "disk_write_kbps", "net_recv_kbps", "net_sent_kbps",
+        "load_1", "load_5", "load_15",
+    )
+
+    def __init__(self, interval, capacity):
+        self.interval = interval
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._timestamps = array("d", [math.nan]) * capacity
+        self._series = {}
+        self._head = 0        # Prochaine case écrite
+        self._count = 0
+        self._counters = None  # (horodatage, E/S disque, E/S réseau) de la mesure précédente
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Démarre le thread d'échantillonnage (sans effet sans psutil)."""
+        if self._thread is not None:
+            return
+        try:
+            import psutil
+        except ImportError:
+            return
+        # Première mesure, enregistrée tout de suite : latest() n'est jamais vide
+        # une fois démarré. Elle amorce cpu_percent(interval=None) et les compteurs
+        # d'E/S ; CPU et débits n'ont pas encore d'intervalle de référence (NaN).
+        psutil.cpu_percent(interval=None, percpu=True)
+        sample = self.measure()
+        for name in sample:
+            if name.startswith("cpu_"):
+                sample[name] = math.nan
+        self.record(sample)
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="system-sampler")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.record(self.measure())
+            except Exception as exc:  # noqa: BLE001 - ne jamais tuer l'échantillonneur
+                print(f"Échantillonnage système en échec : {exc}")
+
+    def measure(self, cpu_interval=None):
+        """Une mesure (dict métrique -> valeur). cpu_interval=None : CPU depuis
+        la mesure précédente, sans bloquer ; les débits d'E/S aussi."""
+        import psutil
+
+        now = time.time()
+        per_core = psutil.cpu_percent(interval=cpu_interval, percpu=True)
+        mem = psutil.virtual_memory()
+        sample = {
+            "cpu_percent": sum(per_core) / len(per_core) if per_core else math.nan,
+            "mem_percent": mem.percent,
+            "mem_used_gb": mem.used / 1024**3,
+            "mem_available_gb": mem.available / 1024**3,
+            "swap_percent": psutil.swap_memory().percent,
+            "disk_percent": psutil.disk_usage(SYSTEM_DISK_PATH).percent,
+        }
+        for index, value in enumerate(per_core):
+            sample[f"cpu_core_{index}"] = value
+
+        disk_io = psutil.disk_io_counters()
+        net_io = psutil.net_io_counters()
+        with self._lock:
+            previous, self._counters = self._counters, (now, disk_io, net_io)
+        for key in ("disk_read_kbps", "disk_write_kbps", "net_recv_kbps", "net_sent_kbps"):
+            sample[key] = math.nan
+        if previous is not None and now > previous[0]:
+            elapsed = now - previous[0]
+            if disk_io is not None and previous[1] is not None:
+                sample["disk_read_kbps"] = (disk_io.read_bytes - previous[1].read_bytes) / 1024 / elapsed
+                sample["disk_write_kbps"] = (disk_io.write_bytes - previous[1].write_bytes) / 1024 / elapsed
+            if net_io is not None and previous[2] is not None:
+                sample["net_recv_kbps"] = (net_io.bytes_recv - previous[2].bytes_recv) / 1024 / elapsed
+                sample["net_sent_kbps"] = (net_io.bytes_sent - previous[2].bytes_sent) / 1024 / elapsed
+
+        try:
+            sample["load_1"], sample["load_5"], sample["load_15"] = os.getloadavg()
+        except (AttributeError, OSError):  # Windows
+            sample["load_1"] = sample["load_5"] = sample["load_15"] = math.nan
+        sample["timestamp"] = now
+        return sample
+
+    def record(self, sample):
+        with self._lock:
+            slot = self._head
+            self._timestamps[slot] = sample["timestamp"]
+            for name, value in sample.items():
+                if name == "timestamp":
+                    continue
+                series = self._series.get(name)
+                if series is None:
+                    series = self._series[name] = array("d", [math.nan]) * self.capacity
+                series[slot] = value
+            self._head = (slot + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def _indices(self, seconds=None):
+        """Cases de l'anneau de la plus ancienne à la plus récente (sous self._lock)."""
+        start = self._head - self._count
+        indices = [(start + i) % self.capacity for i in range(self._count)]
+        if seconds:
+            since = time.time() - seconds
+            indices = [i for i in indices if self._timestamps[i] >= since]
+        return indices
+
+    def latest(self):
+        """Dernier échantillon (dict), ou None si aucun n'a encore été pris."""
+        with self._lock:
+            if not self._count:
+                return None
+            slot = (self._head - 1) % self.capacity
+            sample = {name: series[slot] for name, series in self._series.items()}
+            sample["timestamp"] = self._timestamps[slot]
+            return sample
+
+    def window_stats(self, seconds, metrics=METRICS):
+        """min / moyenne / max de chaque métrique sur les `seconds` dernières secondes."""
+        with self._lock:
+            indices = self._indices(seconds)
+            result = {"samples": len(indices)}
+            for name in metrics:
+                series = self._series.get(name)
+                values = [series[i] for i in indices if not math.isnan(series[i])] if series else []
+                if values:
+                    result[name] = {
+                        "min": round(min(values), 2),
+                        "avg": round(sum(values) / len(values), 2),
+                        "max": round(max(values), 2),
+                    }
+            return result
+
+    def series(self, seconds=None, metrics=None):
+        """Séries temporelles (ordre chronologique), NaN rendus en None pour le JSON."""
+        with self._lock:
+            indices = self._indices(seconds)
+            names = [m for m in (metrics or self._series) if m in self._series]
+            return {
+                "interval_s": self.interval,
+                "capacity": self.capacity,
+                "timestamps": [round(self._timestamps[i], 3) for i in indices],
+                "series": {
+                    name: [
+                        None if math.isnan(self._series[name][i]) else round(self._series[name][i], 2)
+                        for i in indices
+                    ]
+                    for name in names
+                },
+            }
 
 
-def get_system_status_tool():
-    """Récupère l'état du système (OS, CPU, RAM, disque)."""
+system_sampler = SystemSampler(TELEMETRY_INTERVAL, TELEMETRY_SAMPLES)
+
+
+def _optional(value, digits=2):
+    return None if value is None or math.isnan(value) else round(value, digits)
+
+
+def get_system_status_tool(arguments=None):
+    """Récupère l'état du système (OS, CPU, RAM, disque, E/S, charge) depuis le
+    dernier échantillon de system_sampler ; window_s ajoute min/moy/max récents."""
+    arguments = arguments or {}
     try:
         import psutil
 
-        cpu_percent = psutil.cpu_percent(interval=1)
+        sample = system_sampler.latest()
+        if sample is None:
+            # Échantillonneur désactivé (TELEMETRY=0 ou psutil absent au
+            # démarrage) : mesure directe, bloquante
+            sample = system_sampler.measure(cpu_interval=1)
         mem = psutil.virtual_memory()
-        disk_path = "C:\\" if platform.system().lower() == "windows" else "/"
-        disk = psutil.disk_usage(disk_path)
+        disk = psutil.disk_usage(SYSTEM_DISK_PATH)
+        cores = sorted(
+            (int(name.rsplit("_", 1)[1]), value)
+            for name, value in sample.items() if name.startswith("cpu_core_")
+        )
 
-        return {
+        status = {
             "os": platform.system(),
             "os_version": platform.version(),
             "architecture": platform.machine(),
             "hostname": socket.gethostname(),
             "cpu": {
-                "usage_percent": cpu_percent,
+                "usage_percent": _optional(sample["cpu_percent"], 1),
+                "per_core_percent": [_optional(value, 1) for _, value in cores],
                 "cores_physical": psutil.cpu_count(logical=False),
                 "cores_logical": psutil.cpu_count(logical=True),
             },
             "ram": {
                 "total_gb": round(mem.total / (1024**3), 2),
-                "used_gb": round(mem.used / (1024**3), 2),
-                "available_gb": round(mem.available / (1024**3), 2),
-                "usage_percent": mem.percent,
+                "used_gb": _optional(sample["mem_used_gb"]),
+                "available_gb": _optional(sample["mem_available_gb"]),
+                "usage_percent": _optional(sample["mem_percent"], 1),
             },
             "disk": {
                 "total_gb": round(disk.total / (1024**3), 2),
@@ -532,7 +2200,26 @@ def get_system_status_tool():
                 "free_gb": round(disk.free / (1024**3), 2),
                 "usage_percent": round(disk.percent, 1),
             },
+            "load_average": {
+                "1m": _optional(sample["load_1"]),
+                "5m": _optional(sample["load_5"]),
+                "15m": _optional(sample["load_15"]),
+            },
+            "io_kbps": {
+                "disk_read": _optional(sample["disk_read_kbps"], 1),
+                "disk_write": _optional(sample["disk_write_kbps"], 1),
+                "net_recv": _optional(sample["net_recv_kbps"], 1),
+                "net_sent": _optional(sample["net_sent_kbps"], 1),
+            },
+            "sample_age_s": round(time.time() - sample["timestamp"], 1),
         }
+        window = arguments.get("window_s")
+        if window:
+            status["window"] = {
+                "seconds": int(window),
+                **system_sampler.window_stats(int(window)),
+            }
+        return status
     except ImportError:
         return {
             "os": platform.system(),
@@ -545,8 +2232,32 @@ def get_system_status_tool():
         return {"error": f"Erreur : {e}"}
 
 
+# Ports déclenchant une vérification HTTP dans la reconnaissance rapide
+HTTP_PROBE_PORTS = {80: "http", 443: "https"}
+
+
+def probe_http(target, port):
+    """Vérification HTTP(S) : code retour, headers serveur et titre de la page."""
+    url = f"{HTTP_PROBE_PORTS[port]}://{target}"
+    http_info = {"url": url}
+    try:
+        resp = http_session.get(url, timeout=5, verify=False, allow_redirects=True)
+        http_info["status_code"] = resp.status_code
+        http_info["server_header"] = resp.headers.get("Server", "Non renseigné")
+        http_info["x_powered_by"] = resp.headers.get("X-Powered-By", "Non renseigné")
+        title_match = re.search(r"<title[^>]*>(.*?)</title>", resp.text, re.IGNORECASE | re.DOTALL)
+        http_info["page_title"] = title_match.group(1).strip() if title_match else "Aucun titre"
+    except Exception as e:
+        http_info["error"] = str(e)
+    return http_info
+
+
 def run_reconnaissance_rapide_tool(arguments: dict):
-    """Bundle métier : Ping + Nmap rapide + vérification HTTP."""
+    """Bundle métier : Ping + Nmap rapide + vérification HTTP.
+
+    Les étapes tournent en pipeline : ping et nmap démarrent ensemble, et la
+    sonde HTTP d'un port 80/443 part dès que nmap le signale ouvert (sortie
+    -v, voir run_nmap_scan), sans attendre la fin du scan de l'hôte."""
     target = (arguments.get("target") or "").strip()
 
     if not target:
@@ -560,154 +2271,256 @@ def run_reconnaissance_rapide_tool(arguments: dict):
         "etape_2_nmap": {},
         "etape_3_http": {},
         "synthese": "",
+        "timings": {},
     }
+    started = time.monotonic()
+    timings = report["timings"]
+
+    def timed(stage, fn, *args):
+        stage_start = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            timings[stage] = round(time.monotonic() - stage_start, 2)
+            emit_progress("stage", stage=stage, duree_s=timings[stage])
+
+    http_futures = {}
+    http_lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=2 + len(HTTP_PROBE_PORTS), thread_name_prefix="recon") as pool:
+
+        def on_port(_ip, port):
+            # Chaque port est traité dès que nmap annonce sa découverte
+            if port["state"] != "open" or port["port"] not in HTTP_PROBE_PORTS:
+                return
+            with http_lock:
+                if port["port"] not in http_futures:
+                    http_futures[port["port"]] = submit_with_context(
+                        pool, timed, f"http_{port['port']}", probe_http, target, port["port"]
+                    )
+
+        # --- Étapes 1 et 2 en parallèle : Ping + Nmap rapide ---
+        ping_future = submit_with_context(pool, timed, "ping", run_ping_tool, {"target": target})
+        nmap_future = submit_with_context(
+            pool, timed, "nmap", run_nmap_scan, ["-F", "-Pn", target], 40, None, on_port
+        )
+        ping_result = ping_future.result()
+        nmap_result = nmap_future.result()
+
+        # --- Étape 3 : sondes HTTP lancées pendant le scan ---
+        with http_lock:
+            probes = {port: future.result() for port, future in sorted(http_futures.items())}
 
-    # --- Étape 1 : Ping ---
-    ping_result = run_ping_tool({"target": target})
     is_up = ping_result.get("returncode", 1) == 0
     report["etape_1_ping"] = {
         "status": "UP" if is_up else "DOWN / Filtre ICMP",
         "detail": ping_result.get("stdout", ping_result.get("error", "")),
     }
 
-    # --- Étape 2 : Nmap rapide ---
-    nmap_result = run_nmap_tool({"target": target, "fast_scan": True, "skip_ping": True})
+    open_ports = [
+        port
+        for host in nmap_result.get("hosts", [])
+        for port in host.get("ports", [])
+        if port["state"] == "open"
+    ]
     report["etape_2_nmap"] = {
         "command": nmap_result.get("command", ""),
-        "stdout": nmap_result.get("stdout", ""),
+        "open_ports": open_ports,
         "error": nmap_result.get("error", ""),
     }
+    if nmap_result.get("error"):
+        # Échec partiel : signalé au niveau racine pour que le cache l'ignore
+        report["failed"] = True
 
-    # Extraire les ports ouverts du résultat nmap
-    open_ports = []
-    nmap_stdout = nmap_result.get("stdout", "")
-    for line in nmap_stdout.splitlines():
-        if "/tcp" in line and "open" in line:
-            open_ports.append(line.strip())
-
-    # --- Étape 3 : Vérification HTTP si ports 80 ou 443 ouverts ---
-    http_info = {"checked": False}
-    has_http = any("80/tcp" in p for p in open_ports)
-    has_https = any("443/tcp" in p for p in open_ports)
-
-    if has_http or has_https:
-        protocol = "https" if has_https else "http"
-        url = f"{protocol}://{target}"
-        http_info["checked"] = True
-        http_info["url"] = url
-        try:
-            resp = http_session.get(url, timeout=5, verify=False, allow_redirects=True)
-            http_info["status_code"] = resp.status_code
-            http_info["server_header"] = resp.headers.get("Server", "Non renseigné")
-            http_info["x_powered_by"] = resp.headers.get("X-Powered-By", "Non renseigné")
-            title_match = re.search(r"<title[^>]*>(.*?)</title>", resp.text, re.IGNORECASE | re.DOTALL)
-            http_info["page_title"] = title_match.group(1).strip() if title_match else "Aucun titre"
-        except Exception as e:
-            http_info["error"] = str(e)
-
-    report["etape_3_http"] = http_info
+    report["etape_3_http"] = {
+        "checked": bool(probes),
+        "probes": list(probes.values()),
+    }
+    timings["total"] = round(time.monotonic() - started, 2)
 
     report["synthese"] = (
         f"Hôte {target} : {'UP' if is_up else 'DOWN/Filtré'}. "
         f"{len(open_ports)} port(s) ouvert(s) détecté(s). "
-        f"{'Service web détecté.' if http_info.get('checked') else 'Aucun service web standard détecté.'}"
+        f"{'Service web détecté.' if probes else 'Aucun service web standard détecté.'}"
     )
 
     return report
 
 
-def run_local_discovery_tool():
+def run_local_discovery_tool(arguments=None):
     """Bundle métier : Découverte automatique du réseau local."""
+    backend = ((arguments or {}).get("backend") or DISCOVERY_BACKEND).strip().lower()
     report = {
         "etape_1_detection_ip": {},
         "etape_2_ping_sweep": {},
         "synthese": "",
     }
 
-    # --- Étape 1 : Détecter l'IP locale ---
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-    except Exception:
-        local_ip = socket.gethostbyname(socket.gethostname())
-
-    # Calculer le sous-réseau /24
-    parts = local_ip.rsplit(".", 1)
-    subnet = f"{parts[0]}.0/24"
-
+    # --- Étape 1 : IP locale et sous-réseau réel (topologie en mémoire) ---
+    local_ip, network = network_topology.primary_network()
     report["etape_1_detection_ip"] = {
         "ip_locale": local_ip,
-        "sous_reseau": subnet,
+        "sous_reseau": str(network),
     }
+    gateway = network_topology.get()["default_gateway"]
+    if gateway:
+        report["etape_1_detection_ip"]["passerelle"] = gateway
+    if network.prefixlen < DISCOVERY_MIN_PREFIX:
+        network = ipaddress.ip_network(f"{local_ip}/{DISCOVERY_MIN_PREFIX}", strict=False)
+        report["etape_1_detection_ip"]["note"] = (
+            f"Sous-réseau trop large : balayage limité à {network}."
+        )
+    subnet = str(network)
+    emit_progress("stage", stage="detection_ip", ip_locale=local_ip, sous_reseau=subnet)
+
+    # --- Étape 2 : Ping Sweep (moteur natif, nmap en option) ---
+    if backend == "nmap" and shutil.which("nmap") is None:
+        report["etape_2_ping_sweep"]["note"] = "nmap introuvable : moteur natif utilisé."
+        backend = "native"
+
+    if backend == "nmap":
+        scan = run_nmap_scan(["-sn", subnet], timeout=60)
+        if scan.get("error"):
+            report["etape_2_ping_sweep"] = {"command": scan["command"], "error": scan["error"]}
+            report["failed"] = True
+            report["synthese"] = f"IP locale : {local_ip}. Erreur lors du scan : {scan['error']}"
+            return report
+        hosts = [
+            {k: v for k, v in host.items() if k != "status"}
+            for host in scan["hosts"] if host.get("status") == "up"
+        ]
+        report["etape_2_ping_sweep"].update({"moteur": "nmap", "command": scan["command"]})
+    else:
+        start = time.monotonic()
+        hosts = sweep_network(network, deadline=DISCOVERY_DEADLINE)
+        arp = _arp_table()
+        for host in hosts:
+            if host["ip"] in arp:
+                host["mac"] = arp[host["ip"]]
+        report["etape_2_ping_sweep"].update({
+            "moteur": "natif",
+            "ports_sondes": DISCOVERY_PORTS,
+            "duree_s": round(time.monotonic() - start, 2),
+        })
 
-    # --- Étape 2 : Ping Sweep ---
-    if shutil.which("nmap") is None:
-        report["etape_2_ping_sweep"] = {"error": "nmap introuvable sur le serveur."}
-        report["synthese"] = f"IP locale : {local_ip}. Nmap non disponible pour le scan réseau."
-        return report
+    report["etape_2_ping_sweep"].update({"hosts_discovered": hosts, "total": len(hosts)})
+    report["synthese"] = (
+        f"IP locale : {local_ip} | Sous-réseau scanné : {subnet} | "
+        f"{len(hosts)} hôte(s) actif(s) détecté(s) sur le réseau."
+    )
+    return report
 
-    cmd = ["nmap", "-sn", subnet]
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60, check=False)
 
-        # Parser les hôtes découverts
-        hosts = []
-        current_host = {}
-        for line in result.stdout.splitlines():
-            if "Nmap scan report for" in line:
-                if current_host:
-                    hosts.append(current_host)
-                ip_match = re.search(r"(\d+\.\d+\.\d+\.\d+)", line)
-                hostname_match = re.search(r"for\s+(\S+)\s+\(", line)
-                current_host = {
-                    "ip": ip_match.group(1) if ip_match else line,
-                    "hostname": hostname_match.group(1) if hostname_match else "",
-                }
-            elif "MAC Address:" in line:
-                mac_match = re.search(r"MAC Address:\s+(\S+)\s+\((.+?)\)", line)
-                if mac_match:
-                    current_host["mac"] = mac_match.group(1)
-                    current_host["vendor"] = mac_match.group(2)
-        if current_host:
-            hosts.append(current_host)
-
-        report["etape_2_ping_sweep"] = {
-            "command": " ".join(cmd),
-            "hosts_discovered": hosts,
-            "total": len(hosts),
-            "raw_output": result.stdout,
-        }
+ADMIN_PORTS = [21, 22, 23, 25, 445, 1433, 3306, 3389, 5432, 5900, 8080, 8443]
 
-        report["synthese"] = (
-            f"IP locale : {local_ip} | Sous-réseau scanné : {subnet} | "
-            f"{len(hosts)} hôte(s) actif(s) détecté(s) sur le réseau."
-        )
-    except subprocess.TimeoutExpired:
-        report["etape_2_ping_sweep"] = {"error": "Le scan a dépassé le délai autorisé (60s)."}
-        report["synthese"] = f"IP locale : {local_ip}. Le Ping Sweep a expiré."
-    except Exception as e:
-        report["etape_2_ping_sweep"] = {"error": str(e)}
-        report["synthese"] = f"IP locale : {local_ip}. Erreur lors du scan : {e}"
+# Audit multi-cibles : hôtes répartis en lots, un nmap par lot (pool borné par MAX_CONCURRENT_NMAP)
+AUDIT_MAX_HOSTS = 1024
+AUDIT_SHARD_SIZE = 16
 
-    return report
+# Alertes de sécurité déclenchées quand le port correspondant est ouvert
+PORT_ALERTS = {
+    23: "⚠️ CRITIQUE : Telnet (port 23) est OUVERT ! Protocole non chiffré, à désactiver immédiatement.",
+    21: "⚠️ ATTENTION : FTP (port 21) est OUVERT. Préférer SFTP (port 22). Vérifier si l'accès anonyme est activé.",
+    3389: "🔒 INFO : RDP (port 3389) est OUVERT. S'assurer que NLA est activé et accès restreint par pare-feu/VPN.",
+    445: "🔒 INFO : SMB (port 445) est OUVERT. Vérifier que SMBv1 est désactivé (vulnérabilité EternalBlue).",
+    5900: "⚠️ ATTENTION : VNC (port 5900) est OUVERT. Le trafic VNC n'est souvent pas chiffré.",
+    25: "🔒 INFO : SMTP (port 25) est OUVERT. Vérifier que le relais ouvert (open relay) est désactivé.",
+}
+PORT_ALERT_SEVERITY = {23: "critique", 21: "attention", 5900: "attention", 3389: "info", 445: "info", 25: "info"}
+SEVERITY_ORDER = ("critique", "attention", "info")
 
 
-def run_port_audit_tool(arguments: dict):
-    """Bundle métier : Audit des ports d'administration sensibles."""
-    target = (arguments.get("target") or "").strip()
+def _audit_targets(arguments):
+    """Cibles de l'audit : "target" et/ou "targets" (liste, ou chaîne séparée par des virgules)."""
+    targets = arguments.get("targets") or []
+    if isinstance(targets, str):
+        targets = re.split(r"[\s,]+", targets)
+    if arguments.get("target"):
+        targets = [arguments["target"], *targets]
+    return list(dict.fromkeys(str(t).strip() for t in targets if str(t).strip()))
 
-    if not target:
-        return {"error": "Cible manquante."}
-    if not re.fullmatch(r"[A-Za-z0-9_.:/-]+", target):
-        return {"error": "Cible invalide (caractères non autorisés)."}
 
-    if shutil.which("nmap") is None:
-        return {"error": "nmap introuvable sur le serveur."}
+def _ip_sort_key(ip):
+    """Tri des hôtes : IPv4 puis IPv6 dans l'ordre numérique, le reste à la fin."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return (7, 0, ip)
+    return (address.version, int(address), "")
+
+
+def _nmap_target_count(target):
+    """Nombre d'hôtes d'une cible nmap : produit des plages d'octets (10.0.0-1.1-20), 1 sinon."""
+    octets = target.split(".")
+    if len(octets) != 4 or not all(re.fullmatch(r"[0-9,-]+", octet) for octet in octets):
+        return 1
+    count = 1
+    for octet in octets:
+        size = 0
+        for part in octet.split(","):
+            low, _, high = part.partition("-")
+            try:
+                size += int(high or 255) - int(low or 0) + 1 if "-" in part else 1
+            except ValueError:
+                return 1
+        count *= max(size, 1)
+    return count
+
+
+def run_nmap_sharded(hosts, ports_of, args, timeout=90):
+    """Un nmap par lot de AUDIT_SHARD_SIZE hôtes, au plus MAX_CONCURRENT_NMAP à la fois.
+
+    ports_of(lot) donne les ports à scanner pour ce lot. Retourne la liste des
+    scans (format run_nmap_scan), dans l'ordre des lots."""
+    shards = [hosts[i:i + AUDIT_SHARD_SIZE] for i in range(0, len(hosts), AUDIT_SHARD_SIZE)]
+
+    def scan(shard):
+        return run_nmap_scan([*args, "-p", ",".join(map(str, ports_of(shard))), *shard], timeout=timeout)
+
+    if len(shards) == 1:
+        return [scan(shards[0])]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_NMAP, thread_name_prefix="nmap-shard") as pool:
+        futures = [submit_with_context(pool, scan, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+
+def run_port_audit_tool(arguments: dict):
+    """Bundle métier : Audit des ports d'administration sensibles.
+
+    Une cible unique donne le rapport détaillé ; une liste ou un CIDR donne un
+    rapport agrégé par sévérité (voir _port_audit_batch)."""
+    targets = _audit_targets(arguments)
 
+    if not targets:
+        return {"error": "Cible manquante."}
+    for target in targets:
+        if not re.fullmatch(r"[A-Za-z0-9_.:/-]+", target):
+            return {"error": f"Cible invalide (caractères non autorisés) : {target}"}
+
+    backend = _scan_backend(arguments)
+    if len(targets) > 1 or "/" in targets[0]:
+        return _port_audit_batch(targets, backend)
+    return _port_audit_host(targets[0], backend)
+
+
+def _port_audit_timeout(arguments):
+    """Timeout de run_port_audit : pré-passe native, puis au pire deux séries de
+    lots nmap (cibles nmap, puis -sV), chaque vague de MAX_CONCURRENT_NMAP lots
+    pouvant prendre 90 s."""
+    count = 0
+    for target in _audit_targets(arguments):
+        count += _scan_host_count(target)
+    if count <= 1:
+        return 100
+    shards = -(-min(count, AUDIT_MAX_HOSTS) // AUDIT_SHARD_SIZE)
+    waves = -(-shards // MAX_CONCURRENT_NMAP)
+    return 70 + 2 * 90 * waves
+
+
+def _port_audit_host(target, backend):
+    """Audit détaillé d'une cible unique."""
     # Ports d'administration sensibles
-    admin_ports = "21,22,23,25,445,1433,3306,3389,5432,5900,8080,8443"
+    admin_ports = ",".join(str(p) for p in ADMIN_PORTS)
 
     report = {
         "target": target,
@@ -717,94 +2530,1218 @@ def run_port_audit_tool(arguments: dict):
         "synthese": "",
     }
 
-    cmd = ["nmap", "-sV", "-Pn", "-p", admin_ports, target]
+    note = None
+    if backend == "auto":
+        try:
+            expand_scan_targets(target)
+        except (ValueError, OSError):
+            # Syntaxe propre à nmap (10.0.0.1-20, IPv6...) : audit nmap complet
+            backend, note = "nmap", "Cible non supportée par le scanner natif : audit nmap complet."
+
+    if backend == "nmap":
+        scan = run_nmap_scan(["-sV", "-Pn", "-p", admin_ports, target], timeout=90)
+        scan_result = {"moteur": "nmap", "command": scan.get("command")}
+        if note:
+            scan_result["note"] = note
+    else:
+        # Pré-passe native sur les 12 ports, puis -sV uniquement sur les ports ouverts
+        start = time.monotonic()
+        scan = connect_scan(
+            target, ADMIN_PORTS, timeout=30,
+            banner_timeout=SCAN_BANNER_TIMEOUT if backend == "native" else 0,
+        )
+        scan_result = {
+            "moteur": "natif" if backend == "native" else "hybride",
+            "command": scan.get("command"),
+            "prepass_s": round(time.monotonic() - start, 2),
+        }
+        open_ports = {} if scan.get("error") else _open_ports_by_host(scan["hosts"])
+        emit_progress("stage", stage="prepass", duree_s=scan_result["prepass_s"],
+                      ports_ouverts=sum(len(p) for p in open_ports.values()))
+        if backend == "auto" and open_ports:
+            ports = sorted({p for found in open_ports.values() for p in found})
+            versions = run_nmap_scan(
+                ["-sV", "-Pn", "-p", ",".join(map(str, ports)), *open_ports], timeout=90
+            )
+            scan_result["command_versions"] = versions["command"]
+            if versions.get("error"):
+                scan_result["note"] = f"Détection de versions échouée : {versions['error']}"
+                report["failed"] = True
+            nmap_by_ip = {host["ip"]: host for host in versions.get("hosts", [])}
+            for host in scan["hosts"]:
+                if host["ip"] in nmap_by_ip:
+                    _merge_versions(host["ports"], [nmap_by_ip[host["ip"]]])
+
+    if scan.get("error"):
+        report["scan_result"] = {**scan_result, "error": scan["error"]}
+        report["synthese"] = f"Erreur lors de l'audit : {scan['error']}"
+        report["failed"] = True
+        return report
+
+    services = [port for host in scan["hosts"] for port in host.get("ports", [])]
+    for service in services:
+        # Détecter les alertes de sécurité
+        if service["state"] == "open" and service["port"] in PORT_ALERTS:
+            report["alertes"].append(PORT_ALERTS[service["port"]])
+
+    report["scan_result"] = {
+        **scan_result,
+        "services": services,
+    }
+
+    nb_open = sum(1 for s in services if s["state"] == "open")
+    nb_alertes = len(report["alertes"])
+
+    report["synthese"] = (
+        f"Audit de {target} : {nb_open} port(s) d'administration ouvert(s) "
+        f"sur {len(services)} scannés. "
+        f"{nb_alertes} alerte(s) de sécurité générée(s)."
+    )
+
+    return report
+
+
+def _port_audit_batch(targets, backend):
+    """Audit de plusieurs hôtes en un seul appel : pré-passe native sur tous les
+    hôtes, -sV par lots sur les ports ouverts, alertes fusionnées par sévérité."""
+    admin_ports = ",".join(str(p) for p in ADMIN_PORTS)
+    report = {
+        "targets": targets,
+        "ports_audites": admin_ports,
+        "scan_result": {},
+        "hotes": [],
+        "alertes_par_severite": dict.fromkeys(SEVERITY_ORDER, 0),
+        "alertes": [],
+        "synthese": "",
+    }
+
+    hosts, ignored, nmap_targets = [], [], []
+    for target in targets:
+        try:
+            hosts.extend(expand_scan_targets(target))
+        except (ValueError, OSError) as exc:
+            if backend != "native" and "/" not in target:
+                # Syntaxe propre à nmap (10.0.0.1-20, IPv6...) : passée telle quelle à nmap
+                nmap_targets.append(target)
+            else:
+                ignored.append({"cible": target, "erreur": str(exc)})
+    hosts = list(dict.fromkeys(hosts))
+    if ignored:
+        report["cibles_ignorees"] = ignored
+    total = len(hosts) + sum(_nmap_target_count(t) for t in nmap_targets)
+    if not total or total > AUDIT_MAX_HOSTS:
+        error = "Aucune cible valide." if not total else (
+            f"Trop d'hôtes ({total}) : {AUDIT_MAX_HOSTS} au maximum par audit."
+        )
+        report["scan_result"] = {"error": error}
+        report["synthese"] = f"Erreur lors de l'audit : {error}"
+        report["failed"] = True
+        return report
+
+    start = time.monotonic()
+    if backend == "nmap":
+        scans = run_nmap_sharded([*hosts, *nmap_targets], lambda shard: ADMIN_PORTS, ["-sV", "-Pn"])
+        results = {h["ip"]: h.get("ports", []) for scan in scans for h in scan.get("hosts", [])}
+        scan_result = {"moteur": "nmap", "lots": len(scans)}
+    else:
+        scan = connect_scan(
+            hosts, ADMIN_PORTS, timeout=60,
+            banner_timeout=SCAN_BANNER_TIMEOUT if backend == "native" else 0,
+        ) if hosts else {"hosts": []}
+        results = {h["ip"]: h["ports"] for h in scan["hosts"]}
+        scan_result = {
+            "moteur": "natif" if backend == "native" else "hybride",
+            "prepass_s": round(time.monotonic() - start, 2),
+        }
+        scans = []
+        if nmap_targets:
+            # Cibles hors scanner natif : audit nmap complet, en lots comme le reste
+            scans = run_nmap_sharded(nmap_targets, lambda shard: ADMIN_PORTS, ["-sV", "-Pn"])
+            for full in scans:
+                for host in full.get("hosts", []):
+                    results.setdefault(host["ip"], host.get("ports", []))
+            scan_result["lots_nmap"] = len(scans)
+        open_ports = _open_ports_by_host(scan["hosts"])
+        emit_progress("stage", stage="prepass", duree_s=scan_result["prepass_s"],
+                      hotes_exposes=len(open_ports))
+        if backend == "auto" and open_ports:
+            version_scans = run_nmap_sharded(
+                list(open_ports),
+                lambda shard: sorted({p for ip in shard for p in open_ports[ip]}),
+                ["-sV", "-Pn"],
+            )
+            scans += version_scans
+            for versions in version_scans:
+                for host in versions.get("hosts", []):
+                    if host["ip"] in results:
+                        _merge_versions(results[host["ip"]], [host])
+            scan_result["lots_versions"] = len(version_scans)
+    errors = [scan["error"] for scan in scans if scan.get("error")]
+    if errors:
+        scan_result["erreurs"] = errors
+        report["failed"] = True
+    scan_result["hotes_scannes"] = max(len(results), len(hosts))
+    scan_result["duree_s"] = round(time.monotonic() - start, 2)
+    report["scan_result"] = scan_result
+
+    # Fusion des alertes : une entrée par port, avec la liste des hôtes concernés
+    alerts = {}
+    for ip in sorted(results, key=_ip_sort_key):
+        services = [r for r in results[ip] if r["state"] == "open"]
+        if not services:
+            continue
+        entry = {"ip": ip, "services": services}
+        for service in services:
+            if service["port"] in PORT_ALERTS:
+                alerts.setdefault(service["port"], []).append(ip)
+        severities = [PORT_ALERT_SEVERITY[p] for p in (s["port"] for s in services) if p in PORT_ALERT_SEVERITY]
+        if severities:
+            entry["severite_max"] = min(severities, key=SEVERITY_ORDER.index)
+        report["hotes"].append(entry)
+
+    for port, ips in sorted(alerts.items(), key=lambda item: SEVERITY_ORDER.index(PORT_ALERT_SEVERITY[item[0]])):
+        severity = PORT_ALERT_SEVERITY[port]
+        report["alertes_par_severite"][severity] += len(ips)
+        report["alertes"].append({"severite": severity, "message": PORT_ALERTS[port], "hotes": ips})
+
+    counts = report["alertes_par_severite"]
+    nb_open = sum(len(h["services"]) for h in report["hotes"])
+    report["synthese"] = (
+        f"Audit de {scan_result['hotes_scannes']} hôte(s) : {len(report['hotes'])} exposent des ports d'administration "
+        f"({nb_open} port(s) ouvert(s)). Alertes : {counts['critique']} critique(s), "
+        f"{counts['attention']} attention, {counts['info']} info."
+    )
+    return report
+
+
+# --- Métriques Prometheus (/metrics) ---
+def _label_text(names, values, extra=""):
+    """{a="x",b="y"} au format d'exposition Prometheus (valeurs échappées)."""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, registry, name):
+        self._registry = registry
+        self.name = name
+
+    def inc(self, *labels, amount=1):
+        self._registry._add((self.name, labels), 1, 0, amount)
+
+
+class Histogram:
+    def __init__(self, registry, name, buckets):
+        self._registry = registry
+        self.name = name
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        # Compteurs par intervalle (non cumulés) puis la somme en dernière case
+        size = len(self.buckets) + 2
+        self._registry._add((self.name, labels), size, bisect.bisect_left(self.buckets, value), 1)
+        self._registry._add((self.name, labels), size, -1, value)
+
+
+class MetricsRegistry:
+    """Compteurs et histogrammes exposés au format texte de Prometheus.
+
+    Chaque thread écrit dans son propre fragment (threading.local) : observer une
+    valeur ne prend aucun verrou, seule la création du fragment d'un nouveau
+    thread en prend un. La collecte additionne les fragments ; ceux des threads
+    terminés sont repliés dans un cumul commun.
+
+    En multi-processus (enable_multiprocess), chaque worker réécrit son cumul
+    dans <directory>/<pid>.json et /metrics additionne les fichiers de tous les
+    workers, y compris ceux des workers terminés (les compteurs ne reculent pas).
+    Le répertoire est vidé au lancement du serveur (run_production, run_asgi),
+    ou par le premier worker qui n'y trouve aucun worker vivant (gunicorn ou
+    uvicorn lancés directement, voir _reset_stale)."""
+
+    MAX_SHARDS = 256    # Au-delà, les fragments des threads terminés sont repliés
+
+    def __init__(self):
+        self._metrics = {}      # nom -> (type, aide, labels, bornes)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []       # (thread, fragment)
+        self._retired = {}
+        self.directory = None
+        self._thread = None
+
+    def counter(self, name, help_text, labels=()):
+        self._metrics[name] = ("counter", help_text, tuple(labels), None)
+        return Counter(self, name)
+
+    def histogram(self, name, help_text, labels=(), buckets=()):
+        buckets = tuple(sorted(buckets))
+        self._metrics[name] = ("histogram", help_text, tuple(labels), buckets)
+        return Histogram(self, name, buckets)
+
+    def _add(self, key, size, index, amount):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                if len(self._shards) >= self.MAX_SHARDS:
+                    self._fold_dead()
+                self._shards.append((threading.current_thread(), shard))
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0] * size
+        values[index] += amount
+
+    @staticmethod
+    def _merge(target, source):
+        # copy() est atomique : un thread peut ajouter une série pendant la collecte
+        for key, values in source.copy().items():
+            current = target.get(key)
+            if current is None:
+                target[key] = list(values)
+            elif len(current) == len(values):
+                for i, value in enumerate(values):
+                    current[i] += value
+
+    def _fold_dead(self):
+        """Replie les fragments des threads terminés. À appeler sous self._lock."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def _process_totals(self):
+        with self._lock:
+            self._fold_dead()
+            totals = {}
+            self._merge(totals, self._retired)
+            for _, shard in self._shards:
+                self._merge(totals, shard)
+        return totals
+
+    def enable_multiprocess(self, directory, interval=METRICS_FLUSH_INTERVAL):
+        """Publie le cumul de ce processus dans `directory` (idempotent)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(directory, exist_ok=True)
+            self._reset_stale(directory, interval)
+            self.directory = directory
+            self._thread = threading.Thread(target=self._flush_loop, args=(interval,),
+                                            name="metrics-flush", daemon=True)
+        # Fichier publié tout de suite : les workers suivants voient celui-ci vivant
+        self.flush()
+        self._thread.start()
+
+    @staticmethod
+    def _reset_stale(directory, interval):
+        """Au démarrage d'un worker : sans autre worker vivant (PID existant et
+        fichier réécrit depuis moins de 3 intervalles), les fichiers viennent
+        d'un lancement précédent et sont supprimés. Sinon, un fichier au PID de
+        ce processus (PID réutilisé d'un worker terminé) est gardé sous un autre
+        nom pour ne pas écraser son cumul."""
+        own = os.getpid()
+        files = [entry for entry in os.scandir(directory) if entry.name.endswith((".json", ".tmp"))]
+
+        def alive(entry):
+            pid = entry.name[:-len(".json")]
+            if not entry.name.endswith(".json") or not pid.isdigit() or int(pid) == own:
+                return False
+            try:
+                if time.time() - entry.stat().st_mtime > 3 * interval:
+                    return False
+            except OSError:
+                return False
+            if os.name != "posix":
+                return True
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+            return True
+
+        if not any(alive(entry) for entry in files):
+            for entry in files:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            return
+        own_path = os.path.join(directory, f"{own}.json")
+        try:
+            os.replace(own_path, os.path.join(directory, f"{own}-{time.time_ns()}.json"))
+        except FileNotFoundError:
+            pass
+
+    def _flush_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def flush(self):
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        series = [[name, list(labels), values] for (name, labels), values in self._process_totals().items()]
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(series, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Erreur à l'écriture des métriques : {e}")
+
+    def totals(self):
+        """{(nom, labels): valeurs} pour ce processus, ou tous les workers."""
+        if self.directory is None:
+            return self._process_totals()
+        self.flush()
+        totals = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    series = json.load(f)
+            except (OSError, ValueError):
+                continue    # Fichier d'un worker en cours de remplacement
+            self._merge(totals, {(name, tuple(labels)): values for name, labels, values in series})
+        return totals
+
+    def render(self):
+        """Exposition au format texte de Prometheus (version 0.0.4)."""
+        by_name = {}
+        for (name, labels), values in sorted(self.totals().items()):
+            by_name.setdefault(name, []).append((labels, values))
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self._metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, values in by_name.get(name, ()):
+                if kind == "counter":
+                    lines.append(f"{name}{_label_text(label_names, labels)} {_number(values[0])}")
+                    continue
+                if len(values) != len(buckets) + 2:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, "+Inf"), values[:-1]):
+                    cumulative += count
+                    le = f'le="{bound if bound == "+Inf" else _number(bound)}"'
+                    lines.append(f"{name}_bucket{_label_text(label_names, labels, le)} {_number(cumulative)}")
+                lines.append(f"{name}_sum{_label_text(label_names, labels)} {_number(values[-1])}")
+                lines.append(f"{name}_count{_label_text(label_names, labels)} {_number(cumulative)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+ollama_call_seconds = metrics.histogram(
+    "ollama_call_duration_seconds",
+    "Durée d'un appel à Ollama, hors attente en file (call=first : question, follow_up : suivi d'outils)",
+    ("model", "call"), (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+)
+ollama_queue_seconds = metrics.histogram(
+    "ollama_queue_wait_seconds", "Attente d'un créneau de l'ordonnanceur avant l'appel à Ollama",
+    ("model",), (0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+ollama_eval_tokens = metrics.histogram(
+    "ollama_eval_count", "Tokens générés par réponse d'Ollama (eval_count)",
+    ("model",), (16, 32, 64, 128, 256, 512, 1024, 2048, 4096),
+)
+ollama_prompt_eval_seconds = metrics.histogram(
+    "ollama_prompt_eval_duration_seconds",
+    "Évaluation du prompt par Ollama (prompt_eval_duration) : faible quand le cache KV sert",
+    ("model",), (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+tool_seconds = metrics.histogram(
+    "tool_duration_seconds", "Durée d'exécution d'un outil", ("tool",),
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+tool_errors = metrics.counter("tool_errors_total", "Exécutions d'outil terminées en erreur", ("tool",))
+tool_timeouts = metrics.counter("tool_timeouts_total", "Outils abandonnés après leur timeout", ("tool",))
+history_save_seconds = metrics.histogram(
+    "history_save_duration_seconds",
+    "Écriture de l'historique (operation=append : /ask, replace : save_history)",
+    ("operation",), (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+
+
+# --- Traçage des requêtes (spans, Server-Timing, /debug/traces) ---
+# Span courant de la requête tracée (None : pas de trace, les spans ne coûtent rien)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """Intervalle chronométré d'une requête. Les enfants peuvent être ajoutés
+    depuis les threads des outils (list.append est atomique)."""
+
+    __slots__ = ("name", "attrs", "start", "end", "children")
+
+    def __init__(self, name, attrs=None, start=None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.children = []
+
+    @property
+    def duration_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def walk(self):
+        for child in list(self.children):
+            yield child
+            yield from child.walk()
+
+    def to_dict(self, origin):
+        result = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 2),
+            "duration_ms": round(self.duration_ms, 2),
+        }
+        if self.attrs:
+            result["attrs"] = dict(self.attrs)
+        if self.children:
+            result["children"] = [child.to_dict(origin) for child in list(self.children)]
+        return result
+
 
+_NO_SPAN = nullcontext()
+
+
+def span(name, **attrs):
+    """Span enfant du span courant, qui devient le courant le temps du bloc.
+    Hors requête tracée, coûte une lecture de ContextVar."""
+    parent = _current_span.get()
+    if parent is None:
+        return _NO_SPAN
+    return _child_span(parent, name, attrs)
+
+
+@contextmanager
+def _child_span(parent, name, attrs):
+    child = Span(name, attrs)
+    parent.children.append(child)
+    token = _current_span.set(child)
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=90, check=False)
-
-        # Parser les services détectés
-        services = []
-        for line in result.stdout.splitlines():
-            if "/tcp" in line:
-                parts_line = line.split()
-                port_proto = parts_line[0] if len(parts_line) > 0 else ""
-                state = parts_line[1] if len(parts_line) > 1 else ""
-                service_name = parts_line[2] if len(parts_line) > 2 else ""
-                version_info = " ".join(parts_line[3:]) if len(parts_line) > 3 else ""
-
-                service_entry = {
-                    "port": port_proto,
-                    "state": state,
-                    "service": service_name,
-                    "version": version_info,
-                }
-                services.append(service_entry)
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            pass    # Générateur refermé depuis un autre contexte
+
+
+def record_span(name, start, **attrs):
+    """Ajoute au span courant un span déjà écoulé (de start, perf_counter, à maintenant)."""
+    parent = _current_span.get()
+    if parent is not None:
+        child = Span(name, attrs, start)
+        child.end = time.perf_counter()
+        parent.children.append(child)
+
+
+def annotate(**attrs):
+    """Ajoute des attributs au span courant."""
+    current = _current_span.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+class Tracer:
+    """Traces des requêtes : garde les `keep` plus lentes (tas sur la durée) et
+    les dernières requêtes profilées, consultables sur /debug/traces."""
+
+    SERVER_TIMING_MAX = 30      # Entrées de l'en-tête Server-Timing
+
+    def __init__(self, enabled=TRACING_ENABLED, keep=TRACE_KEEP):
+        self.enabled = enabled
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._slowest = []      # (durée ms, n°, trace)
+        self._profiled = deque(maxlen=10)
+        self._seq = 0
+
+    def start(self, name, request_id=None):
+        """Span racine d'une requête (None si le traçage est désactivé)."""
+        if not self.enabled:
+            return None
+        if not request_id or not re.fullmatch(r"[A-Za-z0-9_.-]{1,64}", request_id):
+            request_id = uuid.uuid4().hex
+        return Span(name, {"request_id": request_id,
+                           "started_at": datetime.now(timezone.utc).isoformat()})
+
+    def finish(self, root, profile=None, **attrs):
+        if root.end is not None:
+            return None     # Déjà close (réponse en erreur après l'envoi)
+        root.end = time.perf_counter()
+        root.attrs.update(attrs)
+        trace = root.to_dict(root.start)
+        if profile:
+            trace["profile"] = profile
+        with self._lock:
+            self._seq += 1
+            entry = (root.duration_ms, self._seq, trace)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+            if profile:
+                self._profiled.append(trace)
+        return trace
+
+    def headers(self, root):
+        """X-Request-ID et Server-Timing (spans terminés ou en cours, à plat)."""
+        entries = []
+        for child in root.walk():
+            if len(entries) >= self.SERVER_TIMING_MAX:
+                break
+            entries.append(f"{re.sub(r'[^A-Za-z0-9_.-]', '_', child.name)};dur={child.duration_ms:.1f}")
+        entries.append(f"total;dur={root.duration_ms:.1f}")
+        return {
+            "X-Request-ID": root.attrs["request_id"],
+            "Server-Timing": ", ".join(entries),
+            # Lisible aussi par le frontend servi par Vite (autre origine)
+            "Timing-Allow-Origin": ", ".join(CORS_ORIGINS),
+        }
 
-                # Détecter les alertes de sécurité
-                if state == "open":
-                    if "23/tcp" in port_proto:
-                        report["alertes"].append(
-                            "⚠️ CRITIQUE : Telnet (port 23) est OUVERT ! Protocole non chiffré, à désactiver immédiatement."
-                        )
-                    if "21/tcp" in port_proto:
-                        report["alertes"].append(
-                            "⚠️ ATTENTION : FTP (port 21) est OUVERT. Préférer SFTP (port 22). Vérifier si l'accès anonyme est activé."
-                        )
-                    if "3389/tcp" in port_proto:
-                        report["alertes"].append(
-                            "🔒 INFO : RDP (port 3389) est OUVERT. S'assurer que NLA est activé et accès restreint par pare-feu/VPN."
-                        )
-                    if "445/tcp" in port_proto:
-                        report["alertes"].append(
-                            "🔒 INFO : SMB (port 445) est OUVERT. Vérifier que SMBv1 est désactivé (vulnérabilité EternalBlue)."
-                        )
-                    if "5900/tcp" in port_proto:
-                        report["alertes"].append(
-                            "⚠️ ATTENTION : VNC (port 5900) est OUVERT. Le trafic VNC n'est souvent pas chiffré."
-                        )
-                    if "25/tcp" in port_proto:
-                        report["alertes"].append(
-                            "🔒 INFO : SMTP (port 25) est OUVERT. Vérifier que le relais ouvert (open relay) est désactivé."
-                        )
+    @staticmethod
+    def _summary(trace):
+        if "profile" not in trace:
+            return trace
+        return {**trace, "profile": {"kind": trace["profile"].get("kind"), "available": True}}
 
-        report["scan_result"] = {
-            "command": " ".join(cmd),
-            "services": services,
-            "raw_output": result.stdout,
+    def traces(self):
+        with self._lock:
+            slowest = [trace for _, _, trace in sorted(self._slowest, reverse=True)]
+            profiled = [trace["attrs"]["request_id"] for trace in self._profiled]
+        return {
+            "enabled": self.enabled,
+            "keep": self.keep,
+            "slowest": [self._summary(trace) for trace in slowest],
+            "profiled": profiled,
         }
 
-        nb_open = sum(1 for s in services if s["state"] == "open")
-        nb_alertes = len(report["alertes"])
+    def get(self, request_id):
+        with self._lock:
+            candidates = [*self._profiled, *(trace for _, _, trace in self._slowest)]
+        for trace in reversed(candidates):
+            if trace["attrs"]["request_id"] == request_id:
+                return trace
+        return None
+
+
+tracer = Tracer()
+_profile_lock = threading.Lock()    # Un seul profilage à la fois
+
+
+@contextmanager
+def profile_request(kind):
+    """Profile le thread courant le temps du bloc (cprofile ou pyinstrument).
+    Le dict produit reçoit le rapport texte, ou une erreur."""
+    result = {"kind": kind}
+    if kind not in ("cprofile", "pyinstrument"):
+        result["error"] = "Profileur inconnu (cprofile ou pyinstrument)"
+        yield result
+        return
+    if not _profile_lock.acquire(blocking=False):
+        result["error"] = "Un autre profilage est en cours"
+        yield result
+        return
+    try:
+        if kind == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                result["error"] = "pyinstrument n'est pas installé : pip install pyinstrument"
+                yield result
+                return
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield result
+            finally:
+                profiler.stop()
+                result["report"] = profiler.output_text(unicode=True)
+        else:
+            import cProfile
+            import io
+            import pstats
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield result
+            finally:
+                profiler.disable()
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(TRACE_PROFILE_LINES)
+                result["report"] = report.getvalue()
+    finally:
+        _profile_lock.release()
+
+
+def _traced_events(root, events, profile=None):
+    """Itère un flux SSE dans le contexte de la trace : les spans du streaming
+    (Ollama, outils, historique) s'y rattachent ; la trace est close à la fin."""
+    ctx = contextvars.copy_context()
+    ctx.run(_current_span.set, root)
+    try:
+        while True:
+            try:
+                event = ctx.run(next, events)
+            except StopIteration:
+                return
+            yield event
+    finally:
+        if hasattr(events, "close"):
+            ctx.run(events.close)
+        tracer.finish(root, profile)
+
+
+def traced(name):
+    """Décorateur de vue Flask : trace la requête (spans, en-têtes X-Request-ID et
+    Server-Timing, /debug/traces) et la profile si l'en-tête X-Profile le demande."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return view(*args, **kwargs)
+            root = tracer.start(name, request.headers.get("X-Request-ID"))
+            profile_kind = request.headers.get("X-Profile") if TRACE_PROFILE else None
+            token = _current_span.set(root)
+            try:
+                if profile_kind:
+                    with profile_request(profile_kind.strip().lower()) as profile:
+                        response = app.make_response(view(*args, **kwargs))
+                else:
+                    profile = None
+                    response = app.make_response(view(*args, **kwargs))
+            finally:
+                _current_span.reset(token)
+            if response.is_streamed:
+                # En-têtes envoyés avant le flux : seuls les spans de préparation y figurent
+                if profile:
+                    profile["note"] = "streaming : seule la préparation avant le premier événement est profilée"
+                response.headers.update(tracer.headers(root))
+                response.response = _traced_events(root, response.response, profile)
+            else:
+                tracer.finish(root, profile, status=response.status_code)
+                response.headers.update(tracer.headers(root))
+            return response
+        return wrapper
+    return decorator
+
+
+# --- Compteurs d'évaluation renvoyés par Ollama ---
+# Appels Ollama de la requête /ask en cours (liste de compteurs, ou None)
+_ollama_calls = contextvars.ContextVar("ollama_calls", default=None)
+
+
+def _eval_stats(data):
+    """Compteurs d'une réponse Ollama, durées converties en ms. prompt_eval_count
+    ne compte que les tokens réellement évalués : il baisse quand le cache KV sert."""
+    stats = {key: data[key] for key in ("prompt_eval_count", "eval_count") if key in data}
+    for key in ("prompt_eval_duration", "eval_duration", "load_duration", "total_duration"):
+        if key in data:
+            stats[key.replace("_duration", "_ms")] = round(data[key] / 1e6, 1)
+    return stats
+
+
+class OllamaStats:
+    """Cumul par modèle des compteurs d'évaluation (exposé sur /models/stats)."""
+
+    FIELDS = ("prompt_eval_count", "prompt_eval_ms", "eval_count", "eval_ms", "load_ms", "total_ms")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model_id, stats):
+        with self._lock:
+            totals = self._models.setdefault(model_id, dict.fromkeys(("calls", *self.FIELDS), 0))
+            totals["calls"] += 1
+            for field in self.FIELDS:
+                totals[field] += stats.get(field, 0)
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for model_id, totals in self._models.items():
+                calls = totals["calls"] or 1
+                result[model_id] = {
+                    **{k: round(v, 1) for k, v in totals.items()},
+                    "avg_prompt_eval_count": round(totals["prompt_eval_count"] / calls, 1),
+                    "avg_prompt_eval_ms": round(totals["prompt_eval_ms"] / calls, 1),
+                }
+            return result
 
-        report["synthese"] = (
-            f"Audit de {target} : {nb_open} port(s) d'administration ouvert(s) "
-            f"sur {len(services)} scannés. "
-            f"{nb_alertes} alerte(s) de sécurité générée(s)."
-        )
 
-    except subprocess.TimeoutExpired:
-        report["scan_result"] = {"error": "Le scan a dépassé le délai autorisé (90s)."}
-        report["synthese"] = "Le scan a expiré avant de terminer."
-    except Exception as e:
-        report["scan_result"] = {"error": str(e)}
-        report["synthese"] = f"Erreur lors de l'audit : {e}"
+ollama_stats = OllamaStats()
 
-    return report
 
+def record_eval_stats(model_info, data):
+    """Enregistre les compteurs d'une réponse finale d'Ollama ; les retourne."""
+    stats = _eval_stats(data)
+    if stats:
+        ollama_stats.record(model_info["model_id"], stats)
+        annotate(**stats)
+        if "eval_count" in data:
+            ollama_eval_tokens.observe(data["eval_count"], model_info["model_id"])
+        if "prompt_eval_duration" in data:
+            ollama_prompt_eval_seconds.observe(data["prompt_eval_duration"] / 1e9, model_info["model_id"])
+        calls = _ollama_calls.get()
+        if calls is not None:
+            calls.append(stats)
+    return stats
 
-def call_ollama_chat(model_info, messages, include_tools=True):
+
+def _ollama_payload(model_info, messages, include_tools, stream):
     payload = {
         "model": model_info["model_id"],
         "messages": messages,
-        "stream": False,
+        "stream": stream,
         "options": DEFAULT_OPTIONS,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
     }
     if include_tools and model_info.get("supports_tools", True):
-        payload["tools"] = TOOLS
+        payload["tools"] = tool_registry.schemas()
+    return payload
 
-    # Utilisation de la session persistante
-    response = http_session.post(OLLAMA_CHAT_URL, json=payload, timeout=120)
-    
+
+# --- Ordonnancement des appels à Ollama ---
+PRIORITY_INTERACTIVE = 0   # Premier appel d'une question : l'utilisateur attend
+PRIORITY_FOLLOW_UP = 1     # Suivi après exécution d'outils
+
+# Client à l'origine de la requête /ask en cours (clé d'équité de la file)
+_scheduler_client = contextvars.ContextVar("scheduler_client", default="local")
+
+
+class OllamaOverloaded(Exception):
+    """File d'attente d'un modèle saturée : la requête est refusée (429)."""
+
+    def __init__(self, model_id, retry_after):
+        super().__init__(f"Modèle {model_id} surchargé, réessayez dans {retry_after} s")
+        self.retry_after = retry_after
+
+
+class OllamaScheduler:
+    """Limite les générations simultanées par modèle et ordonne la file d'attente.
+
+    Un créneau libéré va à la requête de plus petite classe de priorité (un
+    suivi d'outils attendant depuis SCHEDULER_AGING s remonte d'une classe),
+    puis au client servi le moins récemment, puis à la plus ancienne."""
+
+    CLIENTS_KEPT = 4096
+
+    def __init__(self, slots=OLLAMA_NUM_PARALLEL, max_queue=SCHEDULER_MAX_QUEUE,
+                 max_wait=SCHEDULER_MAX_WAIT):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._models = {}
+        self._served = OrderedDict()   # client -> numéro du dernier service
+        self._tick = 0
+        self._seq = 0
+
+    def _model(self, model_id):
+        state = self._models.get(model_id)
+        if state is None:
+            state = self._models[model_id] = {
+                "active": 0, "queue": [], "admitted": 0, "rejected": 0, "timeouts": 0,
+                "wait_ms": 0.0, "service_ms": None,
+            }
+        return state
+
+    def _retry_after(self, state):
+        """Estimation du délai avant qu'un créneau se libère pour un nouveau venu."""
+        service_s = (state["service_ms"] or 5000) / 1000
+        rounds = (len(state["queue"]) + 1) / self.slots
+        return max(1, round(service_s * rounds))
+
+    def _rank(self, waiter, now):
+        priority = max(0, waiter["priority"] - int((now - waiter["since"]) / SCHEDULER_AGING))
+        return priority, self._served.get(waiter["client"], 0), waiter["seq"]
+
+    def _reject(self, model_id, state, key):
+        state[key] += 1
+        raise OllamaOverloaded(model_id, self._retry_after(state))
+
+    def admit(self, model_id):
+        """Refuse d'emblée une requête si la file du modèle est déjà pleine."""
+        with self._cond:
+            state = self._model(model_id)
+            if state["active"] >= self.slots and len(state["queue"]) >= self.max_queue:
+                self._reject(model_id, state, "rejected")
+
+    def acquire(self, model_id, priority=PRIORITY_INTERACTIVE, client=None):
+        client = client or _scheduler_client.get()
+        start = time.monotonic()
+        with self._cond:
+            state = self._model(model_id)
+            if state["active"] < self.slots and not state["queue"]:
+                self._grant(model_id, state, client, start)
+                return
+            if len(state["queue"]) >= self.max_queue:
+                self._reject(model_id, state, "rejected")
+
+            waiter = self._enqueue(state, priority, client, start)
+            deadline = start + self.max_wait
+            while not self._take_turn(model_id, state, waiter, deadline):
+                self._cond.wait(deadline - time.monotonic())
+
+    async def acquire_async(self, model_id, priority=PRIORITY_INTERACTIVE, client=None):
+        """acquire pour le chemin asyncio : l'attente en file ne bloque pas la boucle."""
+        client = client or _scheduler_client.get()
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        with self._cond:
+            state = self._model(model_id)
+            if state["active"] < self.slots and not state["queue"]:
+                self._grant(model_id, state, client, start)
+                return
+            if len(state["queue"]) >= self.max_queue:
+                self._reject(model_id, state, "rejected")
+            waiter = self._enqueue(state, priority, client, start)
+            waiter["wake"] = lambda: loop.call_soon_threadsafe(woken.set)
+        deadline = start + self.max_wait
+        try:
+            while True:
+                with self._cond:
+                    if self._take_turn(model_id, state, waiter, deadline):
+                        return
+                    woken.clear()
+                try:
+                    await asyncio.wait_for(woken.wait(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # Client parti pendant l'attente : la place est rendue aux suivants
+            with self._cond:
+                if waiter in state["queue"]:
+                    state["queue"].remove(waiter)
+                    self._notify()
+            raise
+
+    def _enqueue(self, state, priority, client, start):
+        self._seq += 1
+        waiter = {"priority": priority, "client": client, "since": start, "seq": self._seq}
+        state["queue"].append(waiter)
+        return waiter
+
+    def _take_turn(self, model_id, state, waiter, deadline):
+        """Attribue le créneau si c'est au tour de waiter ; lève OllamaOverloaded
+        une fois l'échéance passée. À appeler sous self._cond."""
+        now = time.monotonic()
+        if state["active"] < self.slots and min(
+            state["queue"], key=lambda w: self._rank(w, now)
+        ) is waiter:
+            state["queue"].remove(waiter)
+            self._grant(model_id, state, waiter["client"], waiter["since"])
+            # D'autres créneaux peuvent rester libres pour les suivants
+            self._notify()
+            return True
+        if now >= deadline:
+            state["queue"].remove(waiter)
+            self._notify()
+            self._reject(model_id, state, "timeouts")
+        return False
+
+    def _notify(self):
+        """Réveille les attentes bloquantes et asyncio. À appeler sous self._cond."""
+        self._cond.notify_all()
+        for state in self._models.values():
+            for waiter in state["queue"]:
+                if "wake" in waiter:
+                    waiter["wake"]()
+
+    def _grant(self, model_id, state, client, start):
+        wait_s = time.monotonic() - start
+        ollama_queue_seconds.observe(wait_s, model_id)
+        state["active"] += 1
+        state["admitted"] += 1
+        state["wait_ms"] += wait_s * 1000
+        self._tick += 1
+        self._served[client] = self._tick
+        self._served.move_to_end(client)
+        while len(self._served) > self.CLIENTS_KEPT:
+            self._served.popitem(last=False)
+
+    def release(self, model_id, service_s):
+        with self._cond:
+            state = self._model(model_id)
+            state["active"] -= 1
+            service_ms = service_s * 1000
+            # Moyenne glissante de la durée d'une génération (pour Retry-After)
+            previous = state["service_ms"]
+            state["service_ms"] = service_ms if previous is None else 0.8 * previous + 0.2 * service_ms
+            self._notify()
+
+    @contextmanager
+    def slot(self, model_id, priority=PRIORITY_INTERACTIVE, client=None):
+        self.acquire(model_id, priority, client)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(model_id, time.monotonic() - start)
+
+    @asynccontextmanager
+    async def slot_async(self, model_id, priority=PRIORITY_INTERACTIVE, client=None):
+        await self.acquire_async(model_id, priority, client)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(model_id, time.monotonic() - start)
+
+    def stats(self):
+        with self._cond:
+            result = {}
+            for model_id, state in self._models.items():
+                by_priority = {"interactive": 0, "follow_up": 0}
+                for waiter in state["queue"]:
+                    by_priority["interactive" if waiter["priority"] == PRIORITY_INTERACTIVE else "follow_up"] += 1
+                result[model_id] = {
+                    "slots": self.slots,
+                    "active": state["active"],
+                    "queued": len(state["queue"]),
+                    "queued_by_priority": by_priority,
+                    "max_queue": self.max_queue,
+                    "admitted": state["admitted"],
+                    "rejected": state["rejected"],
+                    "timeouts": state["timeouts"],
+                    "avg_wait_ms": round(state["wait_ms"] / (state["admitted"] or 1), 1),
+                    "avg_service_ms": round(state["service_ms"] or 0, 1),
+                }
+            return result
+
+
+ollama_scheduler = OllamaScheduler()
+
+
+class OllamaUnavailable(requests.exceptions.ConnectionError):
+    """Disjoncteur ouvert : Ollama ne répond plus, l'appel échoue sans attendre (503)."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Ollama indisponible, réessayez dans {retry_after} s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Disjoncteur devant Ollama : ouvert après `threshold` échecs de connexion
+    consécutifs, il fait échouer les appels immédiatement. Après `reset_after` s
+    (état semi-ouvert), un seul appel d'essai passe ; son succès, ou celui de la
+    sonde de santé, le referme."""
+
+    def __init__(self, threshold=OLLAMA_BREAKER_THRESHOLD, reset_after=OLLAMA_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self.openings = 0
+        self.rejected = 0
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_after:
+            return "half_open"
+        return "open"
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _reject(self):
+        self.rejected += 1
+        remaining = self.reset_after - (time.monotonic() - self._opened_at)
+        raise OllamaUnavailable(max(1, math.ceil(remaining)))
+
+    def raise_if_open(self):
+        """Échec immédiat si le disjoncteur est ouvert (sans consommer l'essai du
+        semi-ouvert) : évite d'attendre un créneau pour rien."""
+        with self._lock:
+            if self._state() == "open":
+                self._reject()
+
+    def check(self):
+        """Autorise un appel, ou lève OllamaUnavailable."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return
+            self._reject()
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._opened_at is not None or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    self.openings += 1
+                self._opened_at = time.monotonic()    # (Ré)ouverture
+
+    def stats(self):
+        with self._lock:
+            retry_in = None
+            if self._opened_at is not None:
+                retry_in = max(0.0, round(self.reset_after - (time.monotonic() - self._opened_at), 1))
+            return {
+                "state": self._state(),
+                "consecutive_failures": self._failures,
+                "retry_in_s": retry_in,
+                "openings": self.openings,
+                "rejected": self.rejected,
+            }
+
+
+def _not_delivered(exc):
+    """Vrai si la requête n'a pas atteint Ollama (connexion refusée ou expirée) :
+    la rejouer est sans risque, même pour un POST /api/chat."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class OllamaClient:
+    """Client HTTP partagé par tous les threads pour parler à Ollama.
+
+    Le pool de connexions keep-alive est dimensionné (OLLAMA_POOL_SIZE) pour ne
+    pas rouvrir de connexion sous charge ; chaque type d'appel a ses timeouts
+    (connexion, lecture). Seuls les échecs sans effet côté Ollama sont rejoués
+    (connexion refusée ou expirée, 503 « occupé »), avec backoff exponentiel et
+    jitter ; un délai de lecture dépassé ne l'est jamais. Le disjoncteur et la
+    sonde de fond font échouer vite les appels tant qu'Ollama est tombé."""
+
+    def __init__(self, base_url=OLLAMA_BASE_URL, pool_size=OLLAMA_POOL_SIZE, timeouts=OLLAMA_TIMEOUTS,
+                 retries=OLLAMA_RETRIES, backoff=OLLAMA_RETRY_BACKOFF, health_interval=OLLAMA_HEALTH_INTERVAL):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeouts = timeouts
+        self.retries = retries
+        self.backoff = backoff
+        self.health_interval = health_interval
+        self.breaker = CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.retried = 0
+        self._probe = {}
+        self._thread = None
+
+    def _sleep_before_retry(self, attempt):
+        self.retried += 1
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def request(self, method, path, call_type="chat", **kwargs):
+        """Requête vers Ollama avec les timeouts de `call_type` ; retourne la réponse
+        (y compris en erreur HTTP, à vérifier par l'appelant)."""
+        self.breaker.check()
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, timeout=self.timeouts[call_type], **kwargs)
+            except requests.exceptions.ConnectionError as exc:
+                if attempt == self.retries or not _not_delivered(exc):
+                    self.breaker.failure()
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+            except requests.RequestException:
+                # Délai de lecture dépassé : Ollama est joignable, seulement lent
+                self.breaker.success()
+                raise
+            if response.status_code == 503 and attempt < self.retries:
+                # File d'Ollama pleine (OLLAMA_MAX_QUEUE) ou serveur qui démarre
+                response.close()
+                self._sleep_before_retry(attempt)
+                continue
+            self.breaker.success()
+            return response
+
+    def probe(self):
+        """Interroge /api/version et met à jour le disjoncteur."""
+        start = time.monotonic()
+        ok, version, error = False, None, None
+        try:
+            response = self.session.get(f"{self.base_url}/api/version", timeout=self.timeouts["health"])
+            if response.status_code == 200:
+                ok, version = True, response.json().get("version")
+            else:
+                error = f"HTTP {response.status_code}"
+        except (requests.RequestException, ValueError) as exc:
+            error = str(exc)
+        if ok:
+            self.breaker.success()
+        else:
+            self.breaker.failure()
+        self._probe = {
+            "ok": ok,
+            "version": version,
+            "error": error,
+            "latency_ms": round((time.monotonic() - start) * 1000, 1),
+            "at": datetime.now(timezone.utc).isoformat(),
+        }
+        return ok
+
+    def start(self):
+        """Démarre la sonde de santé (idempotent)."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="ollama-health", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            self.probe()
+            time.sleep(self.health_interval if self.breaker.state == "closed" else 2)
+
+    def stats(self):
+        result = self.breaker.stats()
+        result.update(
+            base_url=self.base_url,
+            pool_size=self.pool_size,
+            retries=self.retried,
+            timeouts={kind: {"connect": connect, "read": read}
+                      for kind, (connect, read) in self.timeouts.items()},
+            last_probe=self._probe or None,
+        )
+        return result
+
+
+ollama_client = OllamaClient()
+
+
+def _check_ollama_response(model_info, response):
     if response.status_code == 404:
         raise ValueError(
             f"Modèle {model_info['model_id']} introuvable dans Ollama (404). "
@@ -813,11 +3750,1003 @@ def call_ollama_chat(model_info, messages, include_tools=True):
     if response.status_code != 200:
         raise ValueError(f"Erreur du modèle ({response.status_code}): {response.text}")
 
-    data = response.json()
+
+def _call_kind(priority):
+    """Label "call" des métriques : question de l'utilisateur ou suivi d'outils."""
+    return "first" if priority == PRIORITY_INTERACTIVE else "follow_up"
+
+
+def call_ollama_chat(model_info, messages, include_tools=True, priority=PRIORITY_INTERACTIVE):
+    payload = _ollama_payload(model_info, messages, include_tools, stream=False)
+    model_manager.touch(model_info["model_id"])
+
+    # Échec immédiat si Ollama est tombé ; l'attente en file ne compte pas
+    # dans le timeout HTTP
+    ollama_client.breaker.raise_if_open()
+    with span(f"ollama.{_call_kind(priority)}", model=model_info["model_id"]):
+        queued = time.perf_counter()
+        with ollama_scheduler.slot(model_info["model_id"], priority):
+            record_span("queue", queued)
+            start = time.monotonic()
+            response = ollama_client.request("POST", "/api/chat", "chat", json=payload)
+            ollama_call_seconds.observe(
+                time.monotonic() - start, model_info["model_id"], _call_kind(priority)
+            )
+        _check_ollama_response(model_info, response)
+
+        data = response.json()
+        model_manager.mark_loaded(model_info["model_id"])
+        record_eval_stats(model_info, data)
     return data.get("message", {})
 
 
-def handle_tool_calls(model_info, base_messages, assistant_message, tool_calls):
+def stream_ollama_chat(model_info, messages, include_tools=True,
+                       priority=PRIORITY_INTERACTIVE, client=None):
+    """Version streaming de call_ollama_chat : produit les chunks NDJSON
+    d'Ollama (dicts) au fur et à mesure de leur génération. Le créneau de
+    l'ordonnanceur est tenu jusqu'au dernier chunk."""
+    payload = _ollama_payload(model_info, messages, include_tools, stream=True)
+    model_manager.touch(model_info["model_id"])
+
+    # Le timeout de lecture s'applique entre deux chunks, pas à la réponse complète
+    ollama_client.breaker.raise_if_open()
+    queued = time.perf_counter()
+    with span(f"ollama.{_call_kind(priority)}", model=model_info["model_id"]), \
+            ollama_scheduler.slot(model_info["model_id"], priority, client):
+        record_span("queue", queued)
+        start = time.monotonic()
+        with ollama_client.request("POST", "/api/chat", "chat", json=payload, stream=True) as response:
+            _check_ollama_response(model_info, response)
+            # Le modèle est en mémoire dès que sa réponse arrive
+            model_manager.mark_loaded(model_info["model_id"])
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise ValueError(f"Erreur du modèle : {chunk['error']}")
+                yield chunk
+                if chunk.get("done"):
+                    ollama_call_seconds.observe(
+                        time.monotonic() - start, model_info["model_id"], _call_kind(priority)
+                    )
+                    record_eval_stats(model_info, chunk)
+                    break
+
+
+# --- Préchargement et maintien en mémoire des modèles ---
+class ModelManager:
+    """Thread de fond qui précharge les modèles configurés, suit ceux qu'Ollama
+    garde en mémoire (/api/ps) et prolonge les modèles « chauds » par des pings
+    keep_alive, pour éviter le chargement à froid (5 à 15 s) sur /ask.
+
+    Avec plusieurs workers, un seul processus (verrou fichier dans DATA_DIR)
+    précharge et pingue ; les autres se contentent de suivre /api/ps."""
+
+    def __init__(self, models, preload, interval, keepalive_interval, hot_window):
+        self._models = models
+        self._by_id = {info["model_id"]: key for key, info in models.items()}
+        self.preload = [key for key in preload if key in models]
+        self.interval = interval
+        self.keepalive_interval = keepalive_interval
+        self.hot_window = hot_window
+        self.leader = False
+        self._lock = threading.Lock()
+        self._last_used = {}    # clé → time.monotonic() du dernier appel
+        self._last_ping = {}    # clé → time.monotonic() du dernier chargement/ping
+        self._state = {
+            key: {
+                "state": "unloaded",   # unloaded → loading → loaded | error
+                "loaded": False,
+                "preload": key in self.preload,
+                "last_used": None,
+                "last_loaded": None,
+                "load_ms": None,
+                "expires_at": None,
+                "size_vram": None,
+                "evictions": 0,
+                "error": None,
+            }
+            for key in models
+        }
+        self._thread = None
+        self._lock_file = None
+
+    def start(self):
+        """Démarre le thread de fond (une seule fois par processus)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.leader = self._acquire_leadership()
+            self._thread = threading.Thread(target=self._loop, name="model-manager", daemon=True)
+        self._thread.start()
+
+    def _acquire_leadership(self):
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        os.makedirs(DATA_DIR, exist_ok=True)
+        lock_file = open(os.path.join(DATA_DIR, "model_manager.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file    # Gardé ouvert : le verrou vit avec le processus
+        return True
+
+    def touch(self, model_id):
+        """Appelé avant chaque requête de chat : le modèle devient « chaud ».
+        Son état chargé ne change qu'une fois la réponse reçue (mark_loaded)."""
+        key = self._by_id.get(model_id)
+        if key is None:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._last_used[key] = time.monotonic()
+            self._state[key]["last_used"] = now
+
+    def mark_loaded(self, model_id):
+        """Appelé après une réponse de chat réussie : Ollama a le modèle en
+        mémoire, et la requête vaut un ping keep_alive."""
+        key = self._by_id.get(model_id)
+        if key is None:
+            return
+        with self._lock:
+            self._last_ping[key] = time.monotonic()
+            self._state[key].update(loaded=True, state="loaded", error=None)
+
+    def warm(self, key):
+        """Charge (ou prolonge) un modèle via /api/generate sans prompt."""
+        model_id = self._models[key]["model_id"]
+        with self._lock:
+            if not self._state[key]["loaded"]:
+                self._state[key]["state"] = "loading"
+        start = time.monotonic()
+        try:
+            response = ollama_client.request(
+                "POST", "/api/generate", "warmup",
+                json={"model": model_id, "prompt": "", "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE},
+            )
+            if response.status_code != 200:
+                raise ValueError(f"Ollama a répondu {response.status_code} : {response.text[:200]}")
+        except (requests.RequestException, ValueError) as exc:
+            with self._lock:
+                self._state[key].update(state="error", error=str(exc))
+            return False
+        with self._lock:
+            self._last_ping[key] = time.monotonic()
+            state = self._state[key]
+            if not state["loaded"]:
+                state["load_ms"] = round((time.monotonic() - start) * 1000)
+                state["last_loaded"] = datetime.now(timezone.utc).isoformat()
+            state.update(state="loaded", loaded=True, error=None)
+        return True
+
+    def refresh(self):
+        """Met à jour l'état chargé/déchargé de chaque modèle depuis /api/ps."""
+        response = ollama_client.request("GET", "/api/ps", "ps")
+        response.raise_for_status()
+        running = {}
+        for entry in response.json().get("models", []):
+            for name in (entry.get("model"), entry.get("name")):
+                if name:
+                    running[name] = entry
+        with self._lock:
+            for key, info in self._models.items():
+                state = self._state[key]
+                entry = running.get(info["model_id"])
+                if entry is not None:
+                    state.update(loaded=True, state="loaded",
+                                 expires_at=entry.get("expires_at"), size_vram=entry.get("size_vram"))
+                    continue
+                if state["loaded"]:
+                    # Déchargé par Ollama (expiration ou place prise par un autre modèle)
+                    state["evictions"] += 1
+                    state["evicted_at"] = datetime.now(timezone.utc).isoformat()
+                state.update(loaded=False, expires_at=None, size_vram=None)
+                if state["state"] == "loaded":
+                    state["state"] = "unloaded"
+
+    def _due(self):
+        """Modèles à (re)charger ou à pinguer lors de ce tour."""
+        now = time.monotonic()
+        with self._lock:
+            due = []
+            for key, state in self._state.items():
+                hot = key in self.preload or now - self._last_used.get(key, -1e12) < self.hot_window
+                if not hot or state["state"] == "loading":
+                    continue
+                if not state["loaded"]:
+                    # Un modèle simplement « chaud » n'est pas rechargé de force :
+                    # sans assez de VRAM, deux modèles se délogeraient en boucle
+                    if key in self.preload:
+                        due.append(key)
+                elif now - self._last_ping.get(key, 0) >= self.keepalive_interval:
+                    due.append(key)
+            return due
+
+    def _loop(self):
+        if self.leader:
+            for key in self.preload:
+                self.warm(key)
+        while True:
+            try:
+                self.refresh()
+            except (requests.RequestException, ValueError):
+                pass    # Ollama indisponible : on réessaie au prochain tour
+            else:
+                if self.leader:
+                    for key in self._due():
+                        self.warm(key)
+            time.sleep(self.interval)
+
+    def states(self):
+        with self._lock:
+            return {key: dict(state) for key, state in self._state.items()}
+
+
+model_manager = ModelManager(
+    MODELS, MODEL_PRELOAD, MODEL_PS_INTERVAL, MODEL_KEEPALIVE_INTERVAL, MODEL_HOT_WINDOW
+)
+
+
+# ========================================
+# --- Registre des outils ---
+# ========================================
+
+class ToolSpec:
+    """Déclaration d'un outil : schéma exposé au modèle, timeout, durée de
+    cache et classe de concurrence. `handler` est une fonction (arguments) ->
+    dict, ou une chaîne "module:fonction" importée au premier appel.
+    `timeout_for(arguments)` ajuste le timeout à l'appel (audit multi-cibles)."""
+
+    def __init__(self, name, description, parameters=None, handler=None, summary=None,
+                 timeout=DEFAULT_TOOL_TIMEOUT, cache_ttl=None, concurrency="light",
+                 async_handler=None, timeout_for=None):
+        self.name = name
+        self.description = description
+        self.parameters = parameters or {"type": "object", "properties": {}, "required": []}
+        self.summary = summary or description
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.concurrency = concurrency
+        self._handler = handler
+        self._async_handler = async_handler
+        self._timeout_for = timeout_for
+
+    def timeout_s(self, arguments=None):
+        if self._timeout_for is None or arguments is None:
+            return self.timeout
+        return max(self.timeout, self._timeout_for(arguments))
+
+    @property
+    def loaded(self):
+        return not isinstance(self._handler, str)
+
+    @property
+    def background(self):
+        """Outil long : lancé en job quand /ask est appelé avec "async_tools": true."""
+        return self.concurrency == "scan"
+
+    def schema(self):
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": self.parameters,
+            },
+        }
+
+    @staticmethod
+    def _resolve(target):
+        module_name, _, attribute = target.partition(":")
+        return getattr(importlib.import_module(module_name), attribute)
+
+    def handler(self):
+        if isinstance(self._handler, str):
+            self._handler = self._resolve(self._handler)
+        return self._handler
+
+    def async_handler(self):
+        """Variante asyncio (chemin ASGI), ou None."""
+        if isinstance(self._async_handler, str):
+            self._async_handler = self._resolve(self._async_handler)
+        return self._async_handler
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "timeout_s": self.timeout,
+            "cache_ttl_s": self.cache_ttl,
+            "concurrency": self.concurrency,
+            "background": self.background,
+            "async": self._async_handler is not None,
+            "loaded": self.loaded,
+        }
+
+
+class ToolMetrics:
+    """Par outil : appels, échecs, timeouts et histogramme des durées d'exécution."""
+
+    BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tools = {}
+
+    def _entry(self, name):
+        entry = self._tools.get(name)
+        if entry is None:
+            entry = self._tools[name] = {
+                "calls": 0, "failures": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "buckets": [0] * (len(self.BUCKETS_MS) + 1),
+            }
+        return entry
+
+    def record(self, name, duration_s, failed):
+        tool_seconds.observe(duration_s, name)
+        if failed:
+            tool_errors.inc(name)
+        duration_ms = duration_s * 1000
+        index = bisect.bisect_left(self.BUCKETS_MS, duration_ms)
+        with self._lock:
+            entry = self._entry(name)
+            entry["calls"] += 1
+            entry["failures"] += int(failed)
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            entry["buckets"][index] += 1
+
+    def record_timeout(self, name):
+        tool_timeouts.inc(name)
+        with self._lock:
+            self._entry(name)["timeouts"] += 1
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name, entry in self._tools.items():
+                # Histogramme cumulé : nombre d'exécutions de durée <= borne (ms)
+                histogram, total = {}, 0
+                for bound, count in zip((*self.BUCKETS_MS, "+Inf"), entry["buckets"]):
+                    total += count
+                    histogram[str(bound)] = total
+                result[name] = {
+                    "calls": entry["calls"],
+                    "failures": entry["failures"],
+                    "timeouts": entry["timeouts"],
+                    "avg_ms": round(entry["total_ms"] / (entry["calls"] or 1), 1),
+                    "max_ms": round(entry["max_ms"], 1),
+                    "histogram_ms": histogram,
+                }
+            return result
+
+
+class ToolRegistry:
+    """Outils disponibles, indexés par nom (l'ordre d'enregistrement est celui
+    du prompt et de la liste "tools" envoyée à Ollama, stable d'un appel à l'autre)."""
+
+    INSTRUCTIONS_HEADER = "Tu disposes de plusieurs outils (appels de fonctions) :\n"
+    INSTRUCTIONS_FOOTER = (
+        "Utilise ces outils quand l'utilisateur te le demande explicitement ou quand c'est pertinent. "
+        "Pour les bundles, fournis une synthèse claire et structurée du rapport retourné."
+    )
+
+    def __init__(self, concurrency_limits):
+        self._tools = {}
+        self._limits = concurrency_limits
+        self._slots = {
+            name: threading.BoundedSemaphore(limit)
+            for name, limit in concurrency_limits.items() if limit
+        }
+        self._schemas = None
+        self._instructions = None
+        self.metrics = ToolMetrics()
+
+    def register(self, spec):
+        if spec.concurrency not in self._limits:
+            raise ValueError(f"Classe de concurrence inconnue pour {spec.name} : {spec.concurrency}")
+        self._tools[spec.name] = spec
+        self._schemas = None
+        self._instructions = None
+        return spec
+
+    def discover(self, directory):
+        """Enregistre les outils décrits par les manifestes JSON de `directory`.
+        Seul le manifeste est lu : le module de l'outil est importé au premier appel."""
+        if not os.path.isdir(directory):
+            return []
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+        found = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, filename), "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                found.append(self.register(ToolSpec(
+                    manifest["name"],
+                    manifest["description"],
+                    parameters=manifest.get("parameters"),
+                    handler=manifest["handler"],
+                    summary=manifest.get("summary"),
+                    timeout=manifest.get("timeout", DEFAULT_TOOL_TIMEOUT),
+                    cache_ttl=manifest.get("cache_ttl"),
+                    concurrency=manifest.get("concurrency", "light"),
+                    async_handler=manifest.get("async_handler"),
+                )).name)
+            except (OSError, ValueError, KeyError) as exc:
+                print(f"Manifeste d'outil ignoré ({filename}) : {exc}")
+        return found
+
+    def get(self, name):
+        return self._tools.get(name)
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def specs(self):
+        return list(self._tools.values())
+
+    def schemas(self):
+        if self._schemas is None:
+            self._schemas = [spec.schema() for spec in self._tools.values()]
+        return self._schemas
+
+    def instructions(self):
+        if self._instructions is None:
+            lines = "".join(f"- '{spec.name}' : {spec.summary}\n" for spec in self._tools.values())
+            self._instructions = self.INSTRUCTIONS_HEADER + lines + self.INSTRUCTIONS_FOOTER
+        return self._instructions
+
+    def timeout(self, name, arguments=None):
+        spec = self._tools.get(name)
+        return spec.timeout_s(arguments) if spec else DEFAULT_TOOL_TIMEOUT
+
+    def cache_ttl(self, name):
+        spec = self._tools.get(name)
+        return spec.cache_ttl if spec else None
+
+    def is_background(self, name):
+        spec = self._tools.get(name)
+        return spec is not None and spec.background
+
+    def has_async(self, name):
+        spec = self._tools.get(name)
+        return spec is not None and spec.async_handler() is not None
+
+    def _record(self, spec, start, result):
+        failed = not isinstance(result, dict) or bool(result.get("error"))
+        self.metrics.record(spec.name, time.monotonic() - start, failed)
+
+    def dispatch(self, name, args):
+        """Exécute l'outil `name` dans sa classe de concurrence. None si inconnu."""
+        spec = self._tools.get(name)
+        if spec is None:
+            print(f"Outil inconnu demandé: {name}")
+            return None
+        slot = self._slots.get(spec.concurrency)
+        if slot is not None and not slot.acquire(timeout=spec.timeout):
+            raise TimeoutError(f"Trop d'outils '{spec.concurrency}' en cours")
+        mark_tool_started()
+        start = time.monotonic()
+        result = None
+        try:
+            result = spec.handler()(args)
+            return result
+        finally:
+            self._record(spec, start, result)
+            if slot is not None:
+                slot.release()
+
+    async def dispatch_async(self, name, args):
+        """dispatch pour les outils ayant une variante asyncio (voir has_async)."""
+        spec = self._tools[name]
+        slot = self._slots.get(spec.concurrency)
+        if slot is not None and not await poll_acquire(slot, time.monotonic() + spec.timeout):
+            raise TimeoutError(f"Trop d'outils '{spec.concurrency}' en cours")
+        mark_tool_started()
+        start = time.monotonic()
+        result = None
+        try:
+            result = await spec.async_handler()(args)
+            return result
+        finally:
+            self._record(spec, start, result)
+            if slot is not None:
+                slot.release()
+
+    def stats(self):
+        metrics = self.metrics.stats()
+        return {
+            spec.name: {**spec.to_dict(), "metrics": metrics.get(spec.name)}
+            for spec in self._tools.values()
+        }
+
+
+tool_registry = ToolRegistry(TOOL_CONCURRENCY)
+
+tool_registry.register(ToolSpec(
+    "run_nmap",
+    "Lance un scan nmap limité et retourne stdout/stderr.",
+    summary="Scan réseau ciblé (ports, versions, etc.)",
+    parameters={
+        "type": "object",
+        "properties": {
+            "target": {
+                "type": "string",
+                "description": "Nom d'hôte ou IP à scanner (ex: 192.168.0.10 ou scanme.nmap.org).",
+            },
+            "ports": {
+                "type": "string",
+                "description": "Liste de ports optionnelle, ex: '22,80,443'.",
+            },
+            "fast_scan": {
+                "type": "boolean",
+                "description": "Activer le scan rapide (-F).",
+            },
+            "service_versions": {
+                "type": "boolean",
+                "description": "Détecter les versions des services (-sV).",
+            },
+            "skip_ping": {
+                "type": "boolean",
+                "description": "Ne pas ping avant le scan (-Pn).",
+            },
+            "backend": {
+                "type": "string",
+                "enum": ["auto", "native", "nmap"],
+                "description": "Moteur : auto (pré-passe native si -sV), native (sans nmap) ou nmap.",
+            },
+        },
+        "required": ["target"],
+    },
+    handler=run_nmap_tool,
+    timeout=45, cache_ttl=300, concurrency="scan",
+))
+
+tool_registry.register(ToolSpec(
+    "run_ping",
+    "Teste la connectivité vers une machine (Ping ICMP).",
+    summary="Test de connectivité ICMP vers une machine",
+    parameters={
+        "type": "object",
+        "properties": {
+            "target": {
+                "type": "string",
+                "description": "Adresse IP ou nom de domaine à pinger.",
+            }
+        },
+        "required": ["target"],
+    },
+    handler=run_ping_tool,
+    async_handler=run_ping_tool_async,
+    timeout=15, cache_ttl=30, concurrency="process",
+))
+
+tool_registry.register(ToolSpec(
+    "get_network_interfaces",
+    "Récupère les interfaces réseau de la machine locale avec leurs adresses IP. "
+    "Utile pour connaître l'IP locale et le sous-réseau.",
+    summary="Récupérer les interfaces réseau et l'IP locale de cette machine",
+    handler=get_network_interfaces_tool,
+    timeout=10,
+))
+
+tool_registry.register(ToolSpec(
+    "get_system_status",
+    "Récupère l'état du système local : OS, CPU, RAM, espace disque. "
+    "Utile pour diagnostiquer la machine.",
+    summary="État du système (OS, CPU, RAM, disque)",
+    parameters={
+        "type": "object",
+        "properties": {
+            "window_s": {
+                "type": "integer",
+                "description": "Ajoute min/moyenne/max sur les N dernières secondes (ex: 300).",
+            },
+        },
+        "required": [],
+    },
+    handler=get_system_status_tool,
+    timeout=10,
+))
+
+tool_registry.register(ToolSpec(
+    "run_reconnaissance_rapide",
+    "Bundle d'analyse complète : effectue un Ping, un scan Nmap rapide (-F), "
+    "et une vérification HTTP (headers serveur + titre de la page) sur une cible. "
+    "Renvoie une synthèse structurée en 3 étapes.",
+    summary="Bundle métier qui effectue Ping + Nmap rapide + vérification HTTP en une seule commande",
+    parameters={
+        "type": "object",
+        "properties": {
+            "target": {
+                "type": "string",
+                "description": "Adresse IP ou nom de domaine de la cible.",
+            },
+        },
+        "required": ["target"],
+    },
+    handler=run_reconnaissance_rapide_tool,
+    timeout=70, cache_ttl=300, concurrency="scan",
+))
+
+tool_registry.register(ToolSpec(
+    "run_local_discovery",
+    "Bundle de découverte réseau local : détecte automatiquement l'IP locale, "
+    "calcule le sous-réseau réel, et effectue un Ping Sweep (moteur natif, ou nmap -sn) "
+    "pour lister toutes les machines connectées au réseau local.",
+    summary="Bundle métier qui détecte l'IP locale, calcule le sous-réseau et découvre toutes les machines du réseau",
+    parameters={
+        "type": "object",
+        "properties": {
+            "backend": {
+                "type": "string",
+                "enum": ["native", "nmap"],
+                "description": "Moteur de découverte (défaut : native, sans nmap).",
+            },
+        },
+        "required": [],
+    },
+    handler=run_local_discovery_tool,
+    timeout=70, cache_ttl=120, concurrency="scan",
+))
+
+tool_registry.register(ToolSpec(
+    "run_port_audit",
+    "Bundle d'audit de sécurité : scanne les ports d'administration sensibles "
+    "(21 FTP, 22 SSH, 23 Telnet, 3389 RDP, 445 SMB, 3306 MySQL, 5432 PostgreSQL) "
+    "avec détection de versions (-sV). Signale les services dangereux exposés "
+    "avec des alertes de sécurité détaillées. Accepte plusieurs cibles ou un réseau "
+    "CIDR (ex: 192.168.1.0/24) en un seul appel : rapport agrégé par sévérité.",
+    summary="Bundle métier qui audite les ports d'administration sensibles (FTP, SSH, Telnet, RDP, SMB...) "
+            "et génère des alertes de sécurité",
+    parameters={
+        "type": "object",
+        "properties": {
+            "target": {
+                "type": "string",
+                "description": "Adresse IP, nom de domaine ou réseau CIDR de la cible à auditer.",
+            },
+            "targets": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "Liste de cibles (IP, noms, CIDR) à auditer en un seul appel.",
+            },
+            "backend": {
+                "type": "string",
+                "enum": ["auto", "native", "nmap"],
+                "description": "Moteur : auto (pré-passe native puis -sV sur les ports ouverts), native ou nmap.",
+            },
+        },
+        "required": [],
+    },
+    handler=run_port_audit_tool,
+    timeout=100, timeout_for=_port_audit_timeout, cache_ttl=600, concurrency="scan",
+))
+
+# Outils supplémentaires déclarés par manifeste (importés au premier appel)
+tool_registry.discover(TOOL_PLUGIN_DIR)
+
+
+def dispatch_tool(name, args):
+    """Exécute l'outil demandé. Retourne None si l'outil est inconnu."""
+    return tool_registry.dispatch(name, args)
+
+
+# --- Cache des résultats d'outils (TTL par outil + éviction LRU) ---
+class ToolResultCache:
+    """Mémorise les résultats d'outils par (nom, arguments normalisés)."""
+
+    def __init__(self, ttl_for, max_entries):
+        self._ttl_for = ttl_for   # nom d'outil -> TTL en secondes (None = pas de cache)
+        self._max_entries = max_entries
+        self._entries = OrderedDict()   # clé → (horodatage, cibles, résultat)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(args):
+        normalized = {}
+        for key, value in (args or {}).items():
+            if isinstance(value, str):
+                value = value.strip().lower()
+            if value in (None, ""):
+                continue
+            normalized[key] = value
+        return normalized
+
+    def _key(self, name, args):
+        return f"{name}:{json.dumps(self._normalize(args), sort_keys=True)}"
+
+    def get(self, name, args):
+        """Retourne une copie du résultat annotée {"cached", "age_s"} ou None."""
+        ttl = self._ttl_for(name)
+        if not ttl:
+            return None
+        key = self._key(name, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            stored_at, _, result = entry
+        cached = dict(result)
+        cached["cache"] = {
+            "cached": True,
+            "age_s": round(time.monotonic() - stored_at, 1),
+            "ttl_s": ttl,
+            "note": "Résultat mis en cache : les données peuvent ne plus être à jour.",
+        }
+        return cached
+
+    @classmethod
+    def _targets(cls, args):
+        """Cibles concernées par un appel : "target" et chaque entrée de "targets"."""
+        normalized = cls._normalize(args)
+        targets = normalized.get("targets") or []
+        if isinstance(targets, str):
+            targets = re.split(r"[\s,]+", targets)
+        targets = [normalized.get("target", ""), *targets]
+        return frozenset(str(t).strip().lower() for t in targets if str(t).strip())
+
+    def put(self, name, args, result):
+        # Les erreurs, y compris les échecs partiels des bundles ("failed"), ne sont pas mises en cache
+        if not self._ttl_for(name) or not isinstance(result, dict):
+            return
+        if result.get("error") or result.get("failed"):
+            return
+        key = self._key(name, args)
+        targets = self._targets(args)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), targets, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, target=None):
+        """Supprime les entrées d'une cible (toutes si target est None)."""
+        with self._lock:
+            if target is None:
+                count = len(self._entries)
+                self._entries.clear()
+                return count
+            target = target.strip().lower()
+            keys = [k for k, (_, targets, _) in self._entries.items() if target in targets]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+tool_cache = ToolResultCache(tool_registry.cache_ttl, TOOL_CACHE_MAX_ENTRIES)
+
+
+def cached_dispatch_tool(name, args):
+    """dispatch_tool précédé d'une consultation du cache de résultats."""
+    with span(f"tool.{name}"):
+        result = tool_cache.get(name, args)
+        if result is not None:
+            annotate(cache="hit")
+            return result
+        result = dispatch_tool(name, args)
+        tool_cache.put(name, args, result)
+        return result
+
+
+# --- Budget de tokens des résultats d'outils renvoyés au modèle ---
+def estimate_tokens(text):
+    """Estimation grossière (≈ 4 caractères par token), sans tokenizer."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class ToolResultBudgeter:
+    """Réduit chaque résultat d'outil à un budget de tokens avant l'appel de suivi.
+
+    Les champs bruts ou vides sont toujours retirés ; au-delà du budget, les
+    textes longs sont débarrassés du bruit puis raccourcis, les listes
+    d'hôtes/ports résumées, et en dernier recours le JSON est tronqué.
+    Les résultats d'origine (partagés avec le cache) ne sont jamais modifiés."""
+
+    RAW_FIELDS = {"raw_output", "stderr"}
+    NOISE_LINE = re.compile(
+        r"^(Starting Nmap|Nmap done|Service detection performed|Read data files|"
+        r"Not shown|Some closed ports|Host is up|\d+ bytes from|PING )"
+    )
+    TEXT_MAX_LINES = 12
+    LIST_KEEP = 15
+
+    def __init__(self, per_result, total):
+        self.per_result = per_result
+        self.total = total
+        self._lock = threading.Lock()
+        self.results = 0
+        self.truncated = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    def budget_for(self, count):
+        """Budget par résultat quand `count` outils ont tourné dans le même tour."""
+        return max(200, min(self.per_result, self.total // max(1, count)))
+
+    def fit(self, result, budget):
+        """Contenu JSON du message 'tool', réduit à `budget` tokens."""
+        original = estimate_tokens(json.dumps(result))
+        result = self._drop_raw(result)
+        text = json.dumps(result, ensure_ascii=False)
+        truncated = False
+        if estimate_tokens(text) > budget:
+            for step in (self._shorten_text, self._summarize_lists):
+                result = step(result)
+                text = json.dumps(result, ensure_ascii=False)
+                if estimate_tokens(text) <= budget:
+                    break
+            else:
+                limit = budget * CHARS_PER_TOKEN
+                omitted = estimate_tokens(text[limit:])
+                text = f"{text[:limit]} …[tronqué : ~{omitted} tokens omis]"
+                truncated = True
+        with self._lock:
+            self.results += 1
+            self.truncated += truncated
+            self.tokens_in += original
+            self.tokens_out += estimate_tokens(text)
+        return text
+
+    def _drop_raw(self, value):
+        if isinstance(value, dict):
+            # stderr n'est utile au modèle que si la commande a échoué
+            raw = self.RAW_FIELDS if value.get("returncode", 0) == 0 else self.RAW_FIELDS - {"stderr"}
+            return {
+                k: self._drop_raw(v) for k, v in value.items()
+                if k not in raw and v not in ("", None, [], {})
+            }
+        if isinstance(value, list):
+            return [self._drop_raw(v) for v in value]
+        return value
+
+    def _shorten_text(self, value):
+        if isinstance(value, dict):
+            return {k: self._shorten_text(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._shorten_text(v) for v in value]
+        if not isinstance(value, str) or "\n" not in value:
+            return value
+        lines = [l for l in value.splitlines() if l.strip() and not self.NOISE_LINE.match(l)]
+        if len(lines) > self.TEXT_MAX_LINES:
+            keep = self.TEXT_MAX_LINES // 2
+            lines = [*lines[:keep], f"[… {len(lines) - 2 * keep} lignes omises]", *lines[-keep:]]
+        return "\n".join(lines)
+
+    @staticmethod
+    def _compact_record(item):
+        """Hôte ou port nmap → une ligne de texte."""
+        if "port" in item and "state" in item:
+            detail = item.get("version") or item.get("banner") or ""
+            return f"{item['port']}/{item.get('protocol', 'tcp')} {item['state']} {item.get('service', '')} {detail}".strip()
+        parts = [item.get(k) for k in ("ip", "hostname", "mac", "vendor", "method") if item.get(k)]
+        ports = [str(p["port"]) for p in item.get("ports", []) if p.get("state") == "open"]
+        if ports:
+            parts.append("ports " + ",".join(ports))
+        return " ".join(parts)
+
+    def _summarize_lists(self, value):
+        if isinstance(value, dict):
+            return {k: self._summarize_lists(v) for k, v in value.items()}
+        if not isinstance(value, list):
+            return value
+        items = [
+            self._compact_record(v) if isinstance(v, dict) and ("ip" in v or "port" in v)
+            else self._summarize_lists(v)
+            for v in value
+        ]
+        if len(items) > self.LIST_KEEP:
+            items = [*items[:self.LIST_KEEP], f"… {len(items) - self.LIST_KEEP} autre(s)"]
+        return items
+
+    def stats(self):
+        with self._lock:
+            return {
+                "results": self.results,
+                "truncated": self.truncated,
+                "tokens_in": self.tokens_in,
+                "tokens_out": self.tokens_out,
+                "tokens_saved": self.tokens_in - self.tokens_out,
+                "budget_per_result": self.per_result,
+                "budget_total": self.total,
+            }
+
+
+tool_budgeter = ToolResultBudgeter(TOOL_RESULT_TOKEN_BUDGET, TOOL_RESULTS_TOTAL_BUDGET)
+
+
+def _timed_out_result(name, timeout):
+    return {"error": f"L'outil {name} a dépassé le délai autorisé ({timeout}s)."}
+
+
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+
+def run_tool_calls(tool_calls, on_progress=None):
+    """Exécute les tool_calls d'un tour assistant et retourne les messages 'tool'.
+
+    Les appels sont indépendants : ils tournent en parallèle dans le pool partagé
+    tool_executor (borné par TOOL_MAX_WORKERS et les classes de concurrence du
+    registre), chacun avec son propre timeout compté depuis son démarrage
+    effectif, et les résultats gardent l'ordre d'origine. L'attente d'une place
+    est bornée par ce même timeout. on_progress(événement) reçoit la progression
+    des outils."""
+    if not tool_calls:
+        return []
+
+    pending = []
+    for call in tool_calls:
+        function_data = call.get("function", {})
+        name = function_data.get("name")
+        args = safe_json_loads(function_data.get("arguments"))
+        timeout = tool_registry.timeout(name, args)
+        clock = ToolClock(timeout)
+        token = _tool_clock.set(clock)
+        try:
+            future = submit_with_context(
+                tool_executor, run_with_progress, name, on_progress, cached_dispatch_tool, name, args
+            )
+        finally:
+            _tool_clock.reset(token)
+        # Résultat en cache, outil inconnu ou place refusée : fin sans démarrage
+        future.add_done_callback(lambda _, clock=clock: clock.start())
+        pending.append((call, name, timeout, clock, future))
+
+    tool_results = []
+    budget = tool_budgeter.budget_for(len(pending))
+    try:
+        for call, name, timeout, clock, future in pending:
+            try:
+                started_at = clock.wait(timeout)
+                if started_at is None:
+                    # Pool ou classe de concurrence saturés pendant tout le délai
+                    raise FuturesTimeoutError()
+                result = future.result(timeout=max(0.0, started_at + timeout - time.monotonic()))
+            except FuturesTimeoutError:
+                print(f"⚠️ Outil {name} interrompu après {timeout}s")
+                tool_registry.metrics.record_timeout(name)
+                result = _timed_out_result(name, timeout)
+            except Exception as exc:
+                result = {"error": f"Erreur lors de l'exécution de {name}: {exc}"}
+
+            if result is None:
+                continue
+
+            tool_results.append(
+                {
+                    "role": "tool",
+                    "name": name,
+                    "tool_call_id": call.get("id"),
+                    "content": tool_budgeter.fit(result, budget),
+                }
+            )
+    finally:
+        # Appels encore en file (tour interrompu ou expiré) : inutile de les lancer.
+        # Les outils en cours sont bornés par leur échéance (voir bounded_timeout).
+        for _, _, _, _, future in pending:
+            future.cancel()
+    return tool_results
+
+
+def build_tool_messages(base_messages, assistant_message, tool_calls, tool_results):
+    """Construit la conversation à renvoyer au modèle après exécution des outils."""
     messages_with_tools = list(base_messages)
     messages_with_tools.append(
         {
@@ -826,52 +4755,24 @@ def handle_tool_calls(model_info, base_messages, assistant_message, tool_calls):
             "tool_calls": tool_calls,
         }
     )
+    messages_with_tools.extend(tool_results)
+    return messages_with_tools
 
-    tool_results = []
-    for call in tool_calls:
-        function_data = call.get("function", {})
-        name = function_data.get("name")
-        args = safe_json_loads(function_data.get("arguments"))
-        
-        # --- Dispatch des outils ---
-        result = {}
-
-        if name == "run_nmap":
-            result = run_nmap_tool(args)
-        elif name == "run_ping":
-            result = run_ping_tool(args)
-        elif name == "get_network_interfaces":
-            result = get_network_interfaces_tool()
-        elif name == "get_system_status":
-            result = get_system_status_tool()
-        elif name == "run_reconnaissance_rapide":
-            result = run_reconnaissance_rapide_tool(args)
-        elif name == "run_local_discovery":
-            result = run_local_discovery_tool()
-        elif name == "run_port_audit":
-            result = run_port_audit_tool(args)
-        else:
-            print(f"Outil inconnu demandé: {name}")
-            continue
-        # --- Fin dispatch ---
 
-        tool_results.append(
-            {
-                "role": "tool",
-                "name": name,
-                "tool_call_id": call.get("id"),
-                "content": json.dumps(result),
-            }
-        )
+def handle_tool_calls(model_info, base_messages, assistant_message, tool_calls):
+    with span("tools", count=len(tool_calls)):
+        tool_results = run_tool_calls(tool_calls)
 
     if not tool_results:
         return assistant_message.get("content", "")
 
-    messages_with_tools.extend(tool_results)
+    messages_with_tools = build_tool_messages(
+        base_messages, assistant_message, tool_calls, tool_results
+    )
 
     # Appel récursif (sans tools cette fois pour éviter une boucle infinie)
     follow_up_message = call_ollama_chat(
-        model_info, messages_with_tools, include_tools=False
+        model_info, messages_with_tools, include_tools=False, priority=PRIORITY_FOLLOW_UP
     )
     return follow_up_message.get("content", tool_results[0]["content"])
 
@@ -891,6 +4792,333 @@ def chat_with_tools(model_info, messages):
     return assistant_message.get("content", "Pas de réponse")
 
 
+def chat_or_launch_jobs(model_info, messages):
+    """Variante de chat_with_tools pour /ask avec "async_tools": true.
+
+    Si le modèle demande un outil long (classe "scan" du registre), tous les appels du
+    tour sont lancés en jobs et la fonction rend la main sans attendre.
+    Retourne (réponse, jobs) ; jobs est vide si la réponse est définitive."""
+    use_tools = model_info.get("supports_tools", True)
+    assistant_message = call_ollama_chat(model_info, messages, include_tools=use_tools)
+    tool_calls = (assistant_message.get("tool_calls") or []) if use_tools else []
+
+    names = [c.get("function", {}).get("name") for c in tool_calls]
+    if not any(tool_registry.is_background(name) for name in names):
+        if tool_calls:
+            return handle_tool_calls(model_info, messages, assistant_message, tool_calls), []
+        return assistant_message.get("content", "Pas de réponse"), []
+
+    jobs = []
+    for call in tool_calls:
+        function_data = call.get("function", {})
+        jobs.append(job_manager.submit(
+            function_data.get("name"), safe_json_loads(function_data.get("arguments"))
+        ))
+    launched = ", ".join(f"{job.tool} (job {job.id})" for job in jobs)
+    return f"Outils lancés en arrière-plan : {launched}.", jobs
+
+
+# ========================================
+# --- Jobs asynchrones (outils longs) ---
+# ========================================
+
+class Job:
+    """Exécution d'un outil en arrière-plan, suivie par son identifiant."""
+
+    def __init__(self, tool, arguments):
+        self.id = uuid.uuid4().hex[:12]
+        self.tool = tool
+        self.arguments = arguments
+        self.status = "queued"   # queued → running → done | failed | cancelled
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        self.future = None
+        self.progress = deque(maxlen=JOB_PROGRESS_KEEP)
+        self.progress_count = 0
+        self._procs = set()
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def attach(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self.cancel_requested
+        if cancelled:
+            kill_process(proc)
+
+    def detach(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def add_progress(self, event):
+        with self._lock:
+            self.progress.append(event)
+            self.progress_count += 1
+
+    def progress_since(self, count):
+        """Événements publiés après les `count` premiers, et le nouveau total."""
+        with self._lock:
+            missed = self.progress_count - count
+            events = list(self.progress)[-missed:] if missed > 0 else []
+            return events, self.progress_count
+
+    def cancel(self):
+        """Demande l'annulation et tue les processus enfants en cours."""
+        with self._lock:
+            self.cancel_requested = True
+            procs = list(self._procs)
+        for proc in procs:
+            kill_process(proc)
+
+    def to_dict(self, include_result=False):
+        data = {
+            "id": self.id,
+            "tool": self.tool,
+            "arguments": self.arguments,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.error:
+            data["error"] = self.error
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class JobManager:
+    """Pool de workers en mémoire pour les outils longs (pas de broker externe)."""
+
+    def __init__(self, max_workers, max_jobs):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._max_jobs = max_jobs
+        self._lock = threading.Lock()
+
+    def submit(self, tool, arguments):
+        job = Job(tool, arguments)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.finished:
+            return job
+        job.cancel()
+        # Un job encore en file est retiré sans jamais démarrer
+        if job.future is not None and job.future.cancel():
+            self._finish(job, "cancelled")
+        return job
+
+    def _run(self, job):
+        if job.cancel_requested:
+            self._finish(job, "cancelled")
+            return
+        job.status = "running"
+        job.started_at = datetime.now(timezone.utc).isoformat()
+        token = _current_job.set(job)
+        try:
+            result = run_with_progress(
+                job.tool, job.add_progress, dispatch_tool, job.tool, job.arguments
+            )
+            if job.cancel_requested:
+                self._finish(job, "cancelled")
+            elif result is None:
+                job.error = f"Outil inconnu : {job.tool}"
+                self._finish(job, "failed")
+            else:
+                job.result = result
+                self._finish(job, "done")
+        except Exception as exc:
+            job.error = str(exc)
+            self._finish(job, "cancelled" if job.cancel_requested else "failed")
+        finally:
+            _current_job.reset(token)
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished_at = datetime.now(timezone.utc).isoformat()
+
+    def _evict(self):
+        # Appelé sous self._lock : on oublie les plus anciens jobs terminés
+        excess = len(self._jobs) - self._max_jobs
+        if excess <= 0:
+            return
+        for job_id in [j.id for j in self._jobs.values() if j.finished][:excess]:
+            del self._jobs[job_id]
+
+
+job_manager = JobManager(JOB_MAX_WORKERS, MAX_JOBS_STORED)
+
+
+def _sse(event, data):
+    """Formate un événement Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _relay_tokens(model_info, messages, include_tools, parts, tool_calls, calls=None,
+                  priority=PRIORITY_INTERACTIVE, client=None):
+    """Relaie les tokens d'un appel streaming sous forme d'événements SSE.
+    Accumule le texte dans `parts`, les appels d'outils dans `tool_calls` et
+    les compteurs d'évaluation du dernier chunk dans `calls`."""
+    for chunk in stream_ollama_chat(model_info, messages, include_tools=include_tools,
+                                    priority=priority, client=client):
+        if chunk.get("done") and calls is not None:
+            calls.append(_eval_stats(chunk))
+        message = chunk.get("message", {})
+        if message.get("tool_calls"):
+            tool_calls.extend(message["tool_calls"])
+        token = message.get("content", "")
+        if token:
+            parts.append(token)
+            yield _sse("token", {"content": token})
+
+
+def _relay_tool_progress(tool_calls, results):
+    """Exécute les outils dans un thread et relaie leur progression en SSE
+    (tool_progress) pendant qu'ils tournent ; les messages 'tool' finaux sont
+    ajoutés à `results`."""
+    events = queue.Queue()
+
+    def work():
+        try:
+            with span("tools", count=len(tool_calls)):
+                tool_results = run_tool_calls(tool_calls, on_progress=lambda e: events.put(("progress", e)))
+            events.put(("results", tool_results))
+        except Exception as exc:  # noqa: BLE001 - relayée au générateur
+            events.put(("error", exc))
+
+    ctx = contextvars.copy_context()
+    threading.Thread(target=ctx.run, args=(work,), daemon=True, name="tool-stream").start()
+    while True:
+        try:
+            kind, payload = events.get(timeout=SSE_KEEPALIVE_INTERVAL)
+        except queue.Empty:
+            # Commentaire SSE : garde la connexion ouverte pendant les longs scans
+            yield ": keep-alive\n\n"
+            continue
+        if kind == "progress":
+            yield _sse("tool_progress", payload)
+        elif kind == "error":
+            raise payload
+        else:
+            results.extend(payload)
+            return
+
+
+def stream_chat_with_tools(model_info, model_key, question, messages,
+                           conversation_id=DEFAULT_CONVERSATION, client=None):
+    """Équivalent streaming de chat_with_tools + mise à jour de l'historique.
+    Événements émis : token, tool_calls, tool_progress, tool_results, done, error."""
+    use_tools = model_info.get("supports_tools", True)
+    parts = []
+    tool_calls = []
+    calls = []
+    try:
+        yield from _relay_tokens(
+            model_info, messages, use_tools, parts, tool_calls, calls, client=client
+        )
+
+        if use_tools and tool_calls:
+            yield _sse("tool_calls", {
+                "tools": [c.get("function", {}).get("name") for c in tool_calls],
+            })
+            tool_results = []
+            yield from _relay_tool_progress(tool_calls, tool_results)
+            if tool_results:
+                yield _sse("tool_results", {"tools": [r["name"] for r in tool_results]})
+                messages_with_tools = build_tool_messages(
+                    messages, {"content": "".join(parts)}, tool_calls, tool_results
+                )
+                # La réponse finale est celle du suivi, comme dans handle_tool_calls
+                parts = []
+                yield from _relay_tokens(
+                    model_info, messages_with_tools, False, parts, [], calls,
+                    priority=PRIORITY_FOLLOW_UP, client=client,
+                )
+                if not parts:
+                    parts.append(tool_results[0]["content"])
+
+        answer = "".join(parts) or "Pas de réponse"
+        history_length = record_exchange(model_key, question, answer, conversation_id)
+        yield _sse("done", {
+            "answer": answer,
+            "model_used": model_info["name"],
+            "history_length": history_length,
+            "conversation_id": conversation_id,
+            "ollama": calls,
+        })
+    except Exception as exc:
+        message, status = _error_payload(exc)
+        payload = {"error": message, "status": status}
+        if isinstance(exc, (OllamaOverloaded, OllamaUnavailable)):
+            payload["retry_after"] = exc.retry_after
+        yield _sse("error", payload)
+
+
+def record_exchange(model_key, question, answer, conversation_id=DEFAULT_CONVERSATION):
+    """Ajoute un échange à l'historique et le sauvegarde. Retourne sa longueur."""
+    start = time.monotonic()
+    with span("save_history"):
+        length = history_store.append(
+            model_key, {"question": question, "answer": answer}, conversation_id
+        )
+    history_save_seconds.observe(time.monotonic() - start, "append")
+    return length
+
+
+def _conversation_id(value):
+    """Valide un identifiant de conversation (None si invalide)."""
+    conversation_id = (value or DEFAULT_CONVERSATION).strip()
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", conversation_id):
+        return None
+    return conversation_id
+
+
+def _error_headers(exc):
+    """En-têtes HTTP associés à une erreur (Retry-After en cas de surcharge ou
+    d'Ollama indisponible)."""
+    if isinstance(exc, (OllamaOverloaded, OllamaUnavailable)):
+        return {"Retry-After": str(exc.retry_after)}
+    return {}
+
+
+def _error_payload(exc):
+    """Traduit une exception du pipeline en (message, code HTTP)."""
+    if isinstance(exc, OllamaOverloaded):
+        return str(exc), 429
+    if isinstance(exc, OllamaUnavailable):
+        return str(exc), 503
+    if isinstance(exc, requests.exceptions.Timeout):
+        return "Timeout - Le modèle met trop de temps à répondre", 504
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return "Impossible de se connecter à Ollama. Est-il lancé ?", 503
+    if isinstance(exc, ValueError):
+        return str(exc), 500
+    return f"Erreur: {exc}", 500
+
+
 @app.route("/models", methods=["GET"])
 def get_models():
     models_list = {}
@@ -901,9 +5129,53 @@ def get_models():
             "icon": info["icon"],
             "supports_tools": info["supports_tools"],
         }
+    # État de chargement dans Ollama (suivi par le gestionnaire de modèles)
+    for key, state in model_manager.states().items():
+        models_list[key]["runtime"] = state
     return jsonify(models_list)
 
 
+@app.route("/models/stats", methods=["GET"])
+def get_model_stats():
+    """Cumul par modèle des compteurs d'Ollama (prompt_eval, eval, chargement)."""
+    return jsonify(ollama_stats.stats())
+
+
+@app.route("/models/queue", methods=["GET"])
+def get_model_queue():
+    """Files d'attente de l'ordonnanceur : créneaux occupés, profondeur, refus."""
+    return jsonify(ollama_scheduler.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Métriques au format texte de Prometheus (tous les workers confondus)."""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/debug/traces", methods=["GET"])
+def get_traces():
+    """Les requêtes /ask les plus lentes (arbre de spans) et les dernières profilées."""
+    return jsonify(tracer.traces())
+
+
+@app.route("/debug/traces/<request_id>", methods=["GET"])
+def get_trace(request_id):
+    """Trace complète d'une requête, avec son rapport de profilage le cas échéant."""
+    trace = tracer.get(request_id)
+    if trace is None:
+        return jsonify({"error": f"Trace '{request_id}' introuvable."}), 404
+    return jsonify(trace)
+
+
+@app.route("/models/health", methods=["GET"])
+def get_ollama_health():
+    """État du client Ollama : disjoncteur, dernière sonde, nouvelles tentatives.
+    503 tant que le disjoncteur n'est pas refermé."""
+    stats = ollama_client.stats()
+    return jsonify(stats), 200 if stats["state"] == "closed" else 503
+
+
 @app.route("/", methods=["GET"])
 def index():
     return send_from_directory(
@@ -912,66 +5184,138 @@ def index():
     )
 
 
-@app.route("/ask", methods=["POST"])
-def ask():
-    data = request.get_json()
-    model_key = data.get("model", "llama3")
-    question = (data.get("question", "") or "").strip()
-    use_context = bool(data.get("use_context", True))
-    system_mode = data.get("system_mode", "general")
+def parse_ask_request(data, force_stream=False):
+    """Valide le corps d'une requête /ask (chemins WSGI et ASGI).
+    Retourne (paramètres, None) ou (None, message d'erreur 400)."""
+    data = data or {}
+    params = {
+        "model_key": data.get("model", "llama3"),
+        "question": (data.get("question", "") or "").strip(),
+        "use_context": bool(data.get("use_context", True)),
+        "system_mode": data.get("system_mode", "general"),
+        "stream": force_stream or bool(data.get("stream", False)),
+        "async_tools": bool(data.get("async_tools", False)),
+        "conversation_id": _conversation_id(data.get("conversation_id")),
+    }
 
-    if not question:
-        return jsonify({"error": "Aucune question fournie"}), 400
+    if not params["question"]:
+        return None, "Aucune question fournie"
 
-    if model_key not in MODELS:
-        return jsonify({"error": f"Modèle {model_key} inconnu"}), 400
+    if params["conversation_id"] is None:
+        return None, "Identifiant de conversation invalide"
+
+    if params["model_key"] not in MODELS:
+        return None, f"Modèle {params['model_key']} inconnu"
+
+    return params, None
 
-    model_info = MODELS[model_key]
-    messages = build_messages(model_key, question, system_mode, use_context)
 
+@app.route("/ask", methods=["POST"])
+@traced("ask")
+def ask(force_stream=False):
+    params, error = parse_ask_request(request.get_json(), force_stream)
+    if error:
+        return jsonify({"error": error}), 400
+    model_key = params["model_key"]
+    question = params["question"]
+    conversation_id = params["conversation_id"]
+    async_tools = params["async_tools"]
+
+    model_info = MODELS[model_key]
+    # Délestage avant tout travail si Ollama est tombé ou la file du modèle pleine
     try:
-        answer = chat_with_tools(model_info, messages)
+        ollama_client.breaker.raise_if_open()
+        ollama_scheduler.admit(model_info["model_id"])
+    except (OllamaOverloaded, OllamaUnavailable) as exc:
+        message, status = _error_payload(exc)
+        return jsonify({"error": message, "retry_after": exc.retry_after}), status, _error_headers(exc)
+
+    annotate(model=model_key, stream=params["stream"])
+    with span("build_messages"):
+        messages = build_messages(
+            model_key, question, params["system_mode"], params["use_context"], conversation_id
+        )
+    client = request.remote_addr or "local"
+
+    if params["stream"]:
+        return _stream_response(
+            stream_chat_with_tools(model_info, model_key, question, messages, conversation_id, client)
+        )
 
-        # Mise à jour de l'historique
-        conversation_history[model_key].append({"question": question, "answer": answer})
-        # On garde les X derniers en mémoire
-        if len(conversation_history[model_key]) > MAX_HISTORY_STORED:
-            conversation_history[model_key] = conversation_history[model_key][-MAX_HISTORY_STORED:]
-        
-        save_history(conversation_history)
+    calls = []
+    token = _ollama_calls.set(calls)
+    client_token = _scheduler_client.set(client)
+    try:
+        if async_tools:
+            answer, jobs = chat_or_launch_jobs(model_info, messages)
+            if jobs:
+                # Réponse anticipée : le résultat se consulte via /jobs/<id>
+                return jsonify({
+                    "answer": answer,
+                    "model_used": model_info["name"],
+                    "jobs": [job.to_dict() for job in jobs],
+                    "conversation_id": conversation_id,
+                    "ollama": calls,
+                }), 202
+        else:
+            answer = chat_with_tools(model_info, messages)
+        history_length = record_exchange(model_key, question, answer, conversation_id)
 
         return jsonify(
             {
                 "answer": answer,
                 "model_used": model_info["name"],
-                "history_length": len(conversation_history[model_key]),
+                "history_length": history_length,
+                "conversation_id": conversation_id,
+                "ollama": calls,
             }
         )
 
-    except requests.exceptions.Timeout:
-        return jsonify({"error": "Timeout - Le modèle met trop de temps à répondre"}), 504
-    except requests.exceptions.ConnectionError:
-        return jsonify({"error": "Impossible de se connecter à Ollama. Est-il lancé ?"}), 503
-    except ValueError as exc:
-        return jsonify({"error": str(exc)}), 500
     except Exception as exc:
-        return jsonify({"error": f"Erreur: {exc}"}), 500
+        message, status = _error_payload(exc)
+        return jsonify({"error": message}), status, _error_headers(exc)
+    finally:
+        _scheduler_client.reset(client_token)
+        _ollama_calls.reset(token)
+
+
+@app.route("/ask/stream", methods=["POST"])
+def ask_stream():
+    """Variante streaming de /ask (Server-Sent Events)."""
+    return ask(force_stream=True)
+
+
+def _stream_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Désactive le buffering des reverse proxies (nginx)
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 
 @app.route("/clear_history", methods=["POST"])
 def clear_history():
+    """Efface l'historique d'un modèle (ou de "all"). Avec conversation_id,
+    seule cette conversation est effacée."""
     data = request.get_json()
     model_key = data.get("model")
+    conversation_id = None
+    if data.get("conversation_id"):
+        conversation_id = _conversation_id(data["conversation_id"])
+        if conversation_id is None:
+            return jsonify({"error": "Identifiant de conversation invalide"}), 400
 
     if model_key == "all":
-        for key in conversation_history:
-            conversation_history[key] = []
-        save_history(conversation_history)
+        for key in MODELS:
+            history_store.clear(key, conversation_id)
         return jsonify({"message": "Tout l'historique a été effacé"})
 
-    if model_key in conversation_history:
-        conversation_history[model_key] = []
-        save_history(conversation_history)
+    if model_key in MODELS:
+        history_store.clear(model_key, conversation_id)
         return jsonify({"message": f"Historique de {MODELS[model_key]['name']} effacé"})
 
     return jsonify({"error": "Modèle inconnu"}), 400
@@ -979,10 +5323,155 @@ def clear_history():
 
 @app.route("/history/<model_key>", methods=["GET"])
 def get_history(model_key):
-    if model_key not in conversation_history:
+    if model_key not in MODELS:
         return jsonify({"error": "Modèle inconnu"}), 400
 
-    return jsonify({"model": MODELS[model_key]["name"], "history": conversation_history[model_key]})
+    conversation_id = _conversation_id(request.args.get("conversation_id"))
+    if conversation_id is None:
+        return jsonify({"error": "Identifiant de conversation invalide"}), 400
+
+    return jsonify({
+        "model": MODELS[model_key]["name"],
+        "conversation_id": conversation_id,
+        "history": history_store.get(model_key, conversation_id),
+    })
+
+
+@app.route("/conversations", methods=["POST"])
+def create_conversation():
+    """Attribue un nouvel identifiant de conversation (à renvoyer dans /ask)."""
+    return jsonify({"conversation_id": uuid.uuid4().hex}), 201
+
+
+@app.route("/conversations/<model_key>", methods=["GET"])
+def list_conversations(model_key):
+    if model_key not in MODELS:
+        return jsonify({"error": "Modèle inconnu"}), 400
+    return jsonify({"model": MODELS[model_key]["name"],
+                    "conversations": history_store.conversations(model_key)})
+
+
+# ========================================
+# --- API : Cache des outils ---
+# ========================================
+
+@app.route("/tools", methods=["GET"])
+def list_tools():
+    """Outils enregistrés : politique (timeout, cache, concurrence) et métriques d'exécution."""
+    return jsonify(tool_registry.stats())
+
+
+@app.route("/system/metrics", methods=["GET"])
+def get_system_metrics():
+    """Séries temporelles de l'échantillonneur système.
+    ?window=<s> limite aux dernières secondes, ?metrics=cpu_percent,load_1 filtre."""
+    window = request.args.get("window", type=float)
+    metrics = [m.strip() for m in request.args.get("metrics", "").split(",") if m.strip()]
+    result = system_sampler.series(window, metrics or None)
+    result["stats"] = system_sampler.window_stats(window, metrics or SystemSampler.METRICS)
+    return jsonify(result)
+
+
+@app.route("/tools/cache", methods=["GET"])
+def get_tool_cache_stats():
+    return jsonify(tool_cache.stats())
+
+
+@app.route("/tools/budget", methods=["GET"])
+def get_tool_budget_stats():
+    """Tokens économisés par le budget appliqué aux résultats d'outils."""
+    return jsonify(tool_budgeter.stats())
+
+
+@app.route("/tools/cache", methods=["DELETE"])
+def invalidate_tool_cache():
+    """Invalide le cache des outils pour ?target=<cible>, ou entièrement sans paramètre."""
+    target = request.args.get("target")
+    count = tool_cache.invalidate(target)
+    return jsonify({"invalidated": count, "target": target})
+
+
+# ========================================
+# --- API : Jobs asynchrones ---
+# ========================================
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    """Liste les jobs connus (sans leurs résultats)."""
+    return jsonify([job.to_dict() for job in job_manager.list()])
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Lance un outil en arrière-plan et retourne immédiatement son identifiant."""
+    data = request.get_json() or {}
+    tool = (data.get("tool") or "").strip()
+    arguments = data.get("arguments") or {}
+
+    if tool not in tool_registry:
+        return jsonify({"error": f"Outil '{tool}' inconnu."}), 400
+    if not isinstance(arguments, dict):
+        return jsonify({"error": "Les arguments doivent être un objet JSON."}), 400
+
+    job = job_manager.submit(tool, arguments)
+    return jsonify(job.to_dict()), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' introuvable."}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    """Résultat d'un job : 200 une fois terminé, 202 tant qu'il tourne."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' introuvable."}), 404
+    if not job.finished:
+        return jsonify(job.to_dict()), 202
+    return jsonify(job.to_dict(include_result=True))
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Progression d'un job en Server-Sent Events (tool_progress), puis done."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' introuvable."}), 404
+
+    def events():
+        seen = 0
+        idle = 0.0
+        while True:
+            finished = job.finished
+            progress, seen = job.progress_since(seen)
+            for event in progress:
+                yield _sse("tool_progress", event)
+            if finished:
+                yield _sse("done", job.to_dict())
+                return
+            if progress:
+                idle = 0.0
+            elif idle >= SSE_KEEPALIVE_INTERVAL:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            time.sleep(0.25)
+            idle += 0.25
+
+    return _stream_response(events())
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    """Annule un job (tue le processus enfant s'il est en cours)."""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' introuvable."}), 404
+    return jsonify(job.to_dict())
 
 
 # ========================================
@@ -992,7 +5481,7 @@ def get_history(model_key):
 @app.route("/prompts", methods=["GET"])
 def get_prompts():
     """Retourne tous les prompts systèmes avec leurs métadonnées."""
-    return jsonify(system_prompts)
+    return jsonify(prompt_store.all())
 
 
 @app.route("/prompts", methods=["POST"])
@@ -1016,32 +5505,12 @@ def create_or_update_prompt():
     if len(content) > 5000:
         return jsonify({"error": "Le contenu du prompt est trop long (max 5000 caractères)."}), 400
 
-    now = datetime.now(timezone.utc).isoformat()
-    is_update = prompt_id in system_prompts
-
-    if is_update:
-        # Mise à jour : on conserve created_at et is_default
-        system_prompts[prompt_id]["name"] = name
-        system_prompts[prompt_id]["content"] = content
-        system_prompts[prompt_id]["icon"] = icon
-        system_prompts[prompt_id]["updated_at"] = now
-    else:
-        # Création
-        system_prompts[prompt_id] = {
-            "name": name,
-            "icon": icon,
-            "content": content,
-            "is_default": False,
-            "created_at": now,
-            "updated_at": now,
-        }
-
     try:
-        save_prompts(system_prompts)
+        prompt, is_update = prompt_store.upsert(prompt_id, name, content, icon)
         action = "mis à jour" if is_update else "créé"
         return jsonify({
             "message": f"Prompt '{name}' {action} avec succès.",
-            "prompt": system_prompts[prompt_id],
+            "prompt": prompt,
             "id": prompt_id,
         })
     except Exception as e:
@@ -1051,19 +5520,13 @@ def create_or_update_prompt():
 @app.route("/prompts/<prompt_id>", methods=["DELETE"])
 def delete_prompt(prompt_id):
     """Supprime un prompt système (les prompts par défaut ne peuvent pas être supprimés)."""
-
-    if prompt_id not in system_prompts:
-        return jsonify({"error": f"Prompt '{prompt_id}' introuvable."}), 404
-
-    if system_prompts[prompt_id].get("is_default", False):
-        return jsonify({"error": "Les prompts par défaut ne peuvent pas être supprimés. Vous pouvez les modifier."}), 403
-
-    name = system_prompts[prompt_id].get("name", prompt_id)
-    del system_prompts[prompt_id]
-
     try:
-        save_prompts(system_prompts)
+        name = prompt_store.delete(prompt_id)
         return jsonify({"message": f"Prompt '{name}' supprimé avec succès."})
+    except KeyError:
+        return jsonify({"error": f"Prompt '{prompt_id}' introuvable."}), 404
+    except PermissionError:
+        return jsonify({"error": "Les prompts par défaut ne peuvent pas être supprimés. Vous pouvez les modifier."}), 403
     except Exception as e:
         return jsonify({"error": f"Erreur lors de la sauvegarde : {e}"}), 500
 
@@ -1071,54 +5534,130 @@ def delete_prompt(prompt_id):
 @app.route("/prompts/<prompt_id>/duplicate", methods=["POST"])
 def duplicate_prompt(prompt_id):
     """Duplique un prompt existant."""
-
-    if prompt_id not in system_prompts:
-        return jsonify({"error": f"Prompt '{prompt_id}' introuvable."}), 404
-
-    # Générer un nouvel ID
-    base_id = f"{prompt_id}-copy"
-    new_id = base_id
-    counter = 1
-    while new_id in system_prompts:
-        new_id = f"{base_id}-{counter}"
-        counter += 1
-
-    now = datetime.now(timezone.utc).isoformat()
-    original = system_prompts[prompt_id]
-
-    system_prompts[new_id] = {
-        "name": f"{original['name']} (copie)",
-        "icon": original.get("icon", "💬"),
-        "content": original["content"],
-        "is_default": False,
-        "created_at": now,
-        "updated_at": now,
-    }
-
     try:
-        save_prompts(system_prompts)
+        new_id, prompt = prompt_store.duplicate(prompt_id)
         return jsonify({
             "message": f"Prompt dupliqué sous l'ID '{new_id}'.",
-            "prompt": system_prompts[new_id],
+            "prompt": prompt,
             "id": new_id,
         })
+    except KeyError:
+        return jsonify({"error": f"Prompt '{prompt_id}' introuvable."}), 404
     except Exception as e:
         return jsonify({"error": f"Erreur lors de la sauvegarde : {e}"}), 500
 
 
-if __name__ == "__main__":
+# ========================================
+# --- Lancement ---
+# ========================================
+
+def create_app():
+    """Fabrique WSGI pour le mode production multi-processus
+    (ex : gunicorn -w 4 "app:create_app()").
+
+    L'historique et les prompts sont partagés via SQLite ; le cache mémoire de
+    l'historique est désactivé pour que chaque worker voie les écritures des
+    autres. Les jobs et le cache des outils restent propres à chaque worker ;
+    les métriques sont publiées dans METRICS_DIR pour que /metrics les agrège."""
+    history_store.cache_size = 0
+    metrics.enable_multiprocess(METRICS_DIR)
+    ollama_client.start()
+    if MODEL_MANAGER_ENABLED:
+        model_manager.start()
+    if TELEMETRY_ENABLED:
+        system_sampler.start()
+    network_topology.start()
+    return app
+
+
+def run_production(workers, threads, bind):
+    """Remplace le processus courant par gunicorn avec `workers` processus."""
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print("gunicorn est requis pour le mode multi-workers : pip install gunicorn (Linux/macOS).")
+        sys.exit(1)
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "--chdir", os.path.dirname(os.path.abspath(__file__)),
+        "--workers", str(workers),
+        "--worker-class", "gthread",
+        "--threads", str(threads),
+        "--bind", bind,
+        # Les outils peuvent durer jusqu'à ~100 s
+        "--timeout", "300",
+        "app:create_app()",
+    ]
+    # Nouvelles séries de métriques : on oublie les workers du lancement précédent
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    print(f"Mode production : {workers} worker(s) x {threads} thread(s) sur {bind}")
+    sys.stdout.flush()
+    os.execv(sys.executable, cmd)
+
+
+def run_asgi(workers, bind):
+    """Remplace le processus courant par uvicorn servant asgi:create_asgi_app
+    (/ask en asyncio : une conversation en attente n'occupe plus de thread)."""
+    try:
+        import uvicorn  # noqa: F401
+        import httpx  # noqa: F401
+        import asgiref  # noqa: F401
+    except ImportError:
+        print("uvicorn, httpx et asgiref sont requis pour le mode ASGI : pip install uvicorn httpx asgiref")
+        sys.exit(1)
+    host, _, port = bind.rpartition(":")
+    cmd = [
+        sys.executable, "-m", "uvicorn",
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+        "--factory", "asgi:create_asgi_app",
+        "--host", host or "0.0.0.0",
+        "--port", port,
+        "--workers", str(workers),
+    ]
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    print(f"Mode ASGI : {workers} worker(s) sur {bind}")
+    sys.stdout.flush()
+    os.execv(sys.executable, cmd)
+
+
+def _print_banner():
     print("Serveur Flask démarré sur http://localhost:5000")
     print("Modèles disponibles:")
     for key, info in MODELS.items():
         print(f"   {info['icon']} {info['name']} - {info['description']}")
-    print(f"Prompts systèmes chargés: {len(system_prompts)}")
-    for _, pinfo in system_prompts.items():
+    prompts = prompt_store.all()
+    print(f"Prompts systèmes chargés: {len(prompts)}")
+    for _, pinfo in prompts.items():
         default_tag = " [defaut]" if pinfo.get("is_default") else ""
         try:
             print(f"   {pinfo.get('icon', '')} {pinfo['name']}{default_tag}")
         except UnicodeEncodeError:
             print(f"   {pinfo['name']}{default_tag}")
-    
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serveur IALocalProject")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")),
+                        help="Nombre de processus workers (> 1 : mode production via gunicorn)")
+    parser.add_argument("--threads", type=int, default=8, help="Threads par worker (production)")
+    parser.add_argument("--bind", default="0.0.0.0:5000", help="Adresse d'écoute (production)")
+    parser.add_argument("--asgi", action="store_true",
+                        help="Servir /ask en asyncio via uvicorn (voir asgi.py)")
+    cli_args = parser.parse_args()
+
+    if cli_args.asgi:
+        run_asgi(cli_args.workers, cli_args.bind)
+    if cli_args.workers > 1:
+        run_production(cli_args.workers, cli_args.threads, cli_args.bind)
+
+    _print_banner()
+    ollama_client.start()
+    if MODEL_MANAGER_ENABLED:
+        model_manager.start()
+    if TELEMETRY_ENABLED:
+        system_sampler.start()
+    network_topology.start()
+
     # Gestion sécurisée du mode debug via variable d'environnement
     debug_mode = os.getenv("FLASK_DEBUG", "False").lower() in ("true", "1", "yes")
-    app.run(host="0.0.0.0", port=5000, debug=debug_mode)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000, debug=debug_mode, threaded=True)
\ No newline at end of file
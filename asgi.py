@@ -0,0 +1,607 @@
+"""Point d'entrée ASGI : chemin asynchrone pour /ask et /ask/stream.
+
+Une conversation qui attend Ollama ou un outil n'occupe plus de thread :
+- les appels à Ollama passent par un client httpx asynchrone (pool de connexions) ;
+- les outils à sous-processus disposant d'une variante asyncio (async_handler
+  dans le registre) tournent via asyncio.create_subprocess_exec ; les autres dans un pool de
+  threads borné, le temps de leur exécution seulement.
+
+Les autres routes restent servies par l'application Flask (adaptateur WSGI
+d'asgiref). Lancement : python app.py --asgi, ou
+uvicorn --factory asgi:create_asgi_app
+"""
+import asyncio
+import contextvars
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import httpx
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as exc:  # dépendances optionnelles du mode ASGI
+    raise ImportError(
+        "Le mode ASGI nécessite httpx et asgiref : pip install httpx asgiref uvicorn"
+    ) from exc
+
+import app as backend
+
+# Connexions simultanées vers Ollama (au-delà, les requêtes attendent une connexion libre)
+ASYNC_OLLAMA_MAX_CONNECTIONS = int(os.getenv("ASYNC_OLLAMA_MAX_CONNECTIONS", "64"))
+# Outils sans variante asyncio : pool de threads dédié
+ASYNC_TOOL_THREADS = int(os.getenv("ASYNC_TOOL_THREADS", "8"))
+
+ASK_ROUTES = {"/ask": False, "/ask/stream": True}
+
+
+class AsyncOllamaClient:
+    """Équivalent asynchrone de call_ollama_chat / stream_ollama_chat.
+
+    Le client httpx est créé à la première requête (il appartient à la boucle
+    du worker) et garde ses connexions ouvertes entre les requêtes. Timeouts,
+    nouvelles tentatives et disjoncteur sont ceux du client synchrone
+    (backend.ollama_client), dont la sonde de santé referme le disjoncteur."""
+
+    def __init__(self, base_url, max_connections):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self._client = None
+
+    def _http(self):
+        if self._client is None:
+            connect, read = backend.OLLAMA_TIMEOUTS["chat"]
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                # Comme avec requests : délai entre deux lectures, pas pour la réponse entière
+                timeout=httpx.Timeout(read, connect=connect),
+            )
+        return self._client
+
+    async def _send(self, request):
+        """Envoie `request` (réponse en streaming, à fermer par l'appelant) en
+        rejouant les requêtes qui n'ont pas atteint Ollama."""
+        client = backend.ollama_client
+        client.breaker.check()
+        for attempt in range(client.retries + 1):
+            try:
+                response = await self._http().send(request, stream=True)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt == client.retries:
+                    client.breaker.failure()
+                    raise
+                client.retried += 1
+                await asyncio.sleep(random.uniform(0, client.backoff * 2 ** attempt))
+                continue
+            except httpx.TimeoutException:
+                client.breaker.success()    # Joignable, seulement lent
+                raise
+            except httpx.TransportError:
+                client.breaker.failure()
+                raise
+            if response.status_code == 503 and attempt < client.retries:
+                await response.aclose()
+                client.retried += 1
+                await asyncio.sleep(random.uniform(0, client.backoff * 2 ** attempt))
+                continue
+            client.breaker.success()
+            return response
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def chat(self, model_info, messages, include_tools=True,
+                   priority=backend.PRIORITY_INTERACTIVE, client=None):
+        payload = backend._ollama_payload(model_info, messages, include_tools, stream=False)
+        backend.model_manager.touch(model_info["model_id"])
+
+        backend.ollama_client.breaker.raise_if_open()
+        with backend.span(f"ollama.{backend._call_kind(priority)}", model=model_info["model_id"]):
+            queued = time.perf_counter()
+            async with backend.ollama_scheduler.slot_async(model_info["model_id"], priority, client):
+                backend.record_span("queue", queued)
+                start = time.monotonic()
+                response = await self._send(self._http().build_request("POST", "/api/chat", json=payload))
+                try:
+                    await response.aread()
+                finally:
+                    await response.aclose()
+                backend.ollama_call_seconds.observe(
+                    time.monotonic() - start, model_info["model_id"], backend._call_kind(priority)
+                )
+            backend._check_ollama_response(model_info, response)
+
+            data = response.json()
+            backend.model_manager.mark_loaded(model_info["model_id"])
+            backend.record_eval_stats(model_info, data)
+        return data.get("message", {})
+
+    async def stream_chat(self, model_info, messages, include_tools=True,
+                          priority=backend.PRIORITY_INTERACTIVE, client=None):
+        payload = backend._ollama_payload(model_info, messages, include_tools, stream=True)
+        backend.model_manager.touch(model_info["model_id"])
+
+        backend.ollama_client.breaker.raise_if_open()
+        queued = time.perf_counter()
+        with backend.span(f"ollama.{backend._call_kind(priority)}", model=model_info["model_id"]):
+            async with backend.ollama_scheduler.slot_async(model_info["model_id"], priority, client):
+                backend.record_span("queue", queued)
+                start = time.monotonic()
+                response = await self._send(self._http().build_request("POST", "/api/chat", json=payload))
+                try:
+                    if response.status_code != 200:
+                        await response.aread()
+                    backend._check_ollama_response(model_info, response)
+                    # Le modèle est en mémoire dès que sa réponse arrive
+                    backend.model_manager.mark_loaded(model_info["model_id"])
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            raise ValueError(f"Erreur du modèle : {chunk['error']}")
+                        yield chunk
+                        if chunk.get("done"):
+                            backend.ollama_call_seconds.observe(
+                                time.monotonic() - start, model_info["model_id"], backend._call_kind(priority)
+                            )
+                            backend.record_eval_stats(model_info, chunk)
+                            break
+                finally:
+                    await response.aclose()
+
+
+ollama = AsyncOllamaClient(backend.OLLAMA_BASE_URL, ASYNC_OLLAMA_MAX_CONNECTIONS)
+_tool_executor = ThreadPoolExecutor(max_workers=ASYNC_TOOL_THREADS, thread_name_prefix="async-tool")
+
+
+# --- Outils ---
+async def _run_with_progress(name, callback, coro):
+    """run_with_progress pour une coroutine (la tâche asyncio a son propre contexte)."""
+    if callback is None:
+        return await coro
+    token = backend._progress.set((name, callback))
+    start = time.monotonic()
+    try:
+        return await coro
+    finally:
+        backend.emit_progress("done", duree_s=round(time.monotonic() - start, 2))
+        backend._progress.reset(token)
+
+
+async def _run_tool(name, args, on_progress):
+    if not backend.tool_registry.has_async(name):
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            _tool_executor, ctx.run, backend.run_with_progress,
+            name, on_progress, backend.cached_dispatch_tool, name, args,
+        )
+    with backend.span(f"tool.{name}"):
+        result = backend.tool_cache.get(name, args)
+        if result is None:
+            result = await _run_with_progress(
+                name, on_progress, backend.tool_registry.dispatch_async(name, args)
+            )
+            backend.tool_cache.put(name, args, result)
+        else:
+            backend.annotate(cache="hit")
+    return result
+
+
+async def run_tool_calls_async(tool_calls, on_progress=None):
+    """run_tool_calls pour le chemin ASGI : mêmes timeouts, cache et budget.
+    on_progress peut être appelé depuis un thread du pool."""
+    if not tool_calls:
+        return []
+
+    loop = asyncio.get_running_loop()
+
+    async def run_one(call):
+        function_data = call.get("function", {})
+        name = function_data.get("name")
+        args = backend.safe_json_loads(function_data.get("arguments"))
+        timeout = backend.tool_registry.timeout(name, args)
+        # Le timeout court depuis le démarrage effectif de l'outil (thread du pool
+        # obtenu, place de concurrence acquise), pas depuis la mise en file
+        started = loop.create_future()
+
+        def on_start(at):
+            loop.call_soon_threadsafe(lambda: started.done() or started.set_result(at))
+
+        clock = backend.ToolClock(timeout, on_start)
+        token = backend._tool_clock.set(clock)
+        try:
+            task = asyncio.ensure_future(_run_tool(name, args, on_progress))
+        finally:
+            backend._tool_clock.reset(token)
+        task.add_done_callback(lambda _: clock.start())
+        try:
+            started_at = await started
+            remaining = max(0.0, started_at + timeout - time.monotonic())
+            result = await asyncio.wait_for(task, remaining)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Outil {name} interrompu après {timeout}s")
+            backend.tool_registry.metrics.record_timeout(name)
+            result = backend._timed_out_result(name, timeout)
+        except Exception as exc:
+            result = {"error": f"Erreur lors de l'exécution de {name}: {exc}"}
+        finally:
+            if not task.done():
+                task.cancel()
+        return call, name, result
+
+    with backend.span("tools", count=len(tool_calls)):
+        outcomes = await asyncio.gather(*(run_one(call) for call in tool_calls))
+    budget = backend.tool_budgeter.budget_for(len(outcomes))
+    return [
+        {
+            "role": "tool",
+            "name": name,
+            "tool_call_id": call.get("id"),
+            "content": backend.tool_budgeter.fit(result, budget),
+        }
+        for call, name, result in outcomes
+        if result is not None
+    ]
+
+
+# --- Conversation ---
+async def handle_tool_calls_async(model_info, base_messages, assistant_message, tool_calls, client):
+    tool_results = await run_tool_calls_async(tool_calls)
+
+    if not tool_results:
+        return assistant_message.get("content", "")
+
+    messages_with_tools = backend.build_tool_messages(
+        base_messages, assistant_message, tool_calls, tool_results
+    )
+    follow_up_message = await ollama.chat(
+        model_info, messages_with_tools, include_tools=False,
+        priority=backend.PRIORITY_FOLLOW_UP, client=client,
+    )
+    return follow_up_message.get("content", tool_results[0]["content"])
+
+
+async def chat_or_launch_jobs_async(model_info, messages, client, async_tools=False):
+    """chat_with_tools (ou chat_or_launch_jobs si async_tools) en asynchrone.
+    Retourne (réponse, jobs)."""
+    use_tools = model_info.get("supports_tools", True)
+    assistant_message = await ollama.chat(model_info, messages, include_tools=use_tools, client=client)
+    tool_calls = (assistant_message.get("tool_calls") or []) if use_tools else []
+
+    names = [c.get("function", {}).get("name") for c in tool_calls]
+    if not async_tools or not any(backend.tool_registry.is_background(name) for name in names):
+        if tool_calls:
+            answer = await handle_tool_calls_async(
+                model_info, messages, assistant_message, tool_calls, client
+            )
+            return answer, []
+        return assistant_message.get("content", "Pas de réponse"), []
+
+    jobs = []
+    for call in tool_calls:
+        function_data = call.get("function", {})
+        jobs.append(backend.job_manager.submit(
+            function_data.get("name"), backend.safe_json_loads(function_data.get("arguments"))
+        ))
+    launched = ", ".join(f"{job.tool} (job {job.id})" for job in jobs)
+    return f"Outils lancés en arrière-plan : {launched}.", jobs
+
+
+async def _relay_tokens(model_info, messages, include_tools, parts, tool_calls, calls,
+                        priority=backend.PRIORITY_INTERACTIVE, client=None):
+    async for chunk in ollama.stream_chat(model_info, messages, include_tools=include_tools,
+                                          priority=priority, client=client):
+        if chunk.get("done"):
+            calls.append(backend._eval_stats(chunk))
+        message = chunk.get("message", {})
+        if message.get("tool_calls"):
+            tool_calls.extend(message["tool_calls"])
+        token = message.get("content", "")
+        if token:
+            parts.append(token)
+            yield backend._sse("token", {"content": token})
+
+
+async def _relay_tool_progress(tool_calls, results):
+    """Exécute les outils et relaie leur progression (tool_progress) en SSE."""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_progress(event):
+        loop.call_soon_threadsafe(events.put_nowait, ("progress", event))
+
+    task = asyncio.ensure_future(run_tool_calls_async(tool_calls, on_progress))
+    task.add_done_callback(lambda _: events.put_nowait(("finished", None)))
+    try:
+        while True:
+            try:
+                kind, payload = await asyncio.wait_for(events.get(), backend.SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if kind == "progress":
+                yield backend._sse("tool_progress", payload)
+            else:
+                results.extend(task.result())
+                return
+    finally:
+        task.cancel()
+
+
+async def stream_chat_with_tools_async(model_info, model_key, question, messages,
+                                       conversation_id, client):
+    """Équivalent asynchrone de stream_chat_with_tools (mêmes événements SSE)."""
+    use_tools = model_info.get("supports_tools", True)
+    parts = []
+    tool_calls = []
+    calls = []
+    try:
+        async for event in _relay_tokens(
+            model_info, messages, use_tools, parts, tool_calls, calls, client=client
+        ):
+            yield event
+
+        if use_tools and tool_calls:
+            yield backend._sse("tool_calls", {
+                "tools": [c.get("function", {}).get("name") for c in tool_calls],
+            })
+            tool_results = []
+            async for event in _relay_tool_progress(tool_calls, tool_results):
+                yield event
+            if tool_results:
+                yield backend._sse("tool_results", {"tools": [r["name"] for r in tool_results]})
+                messages_with_tools = backend.build_tool_messages(
+                    messages, {"content": "".join(parts)}, tool_calls, tool_results
+                )
+                parts = []
+                async for event in _relay_tokens(
+                    model_info, messages_with_tools, False, parts, [], calls,
+                    priority=backend.PRIORITY_FOLLOW_UP, client=client,
+                ):
+                    yield event
+                if not parts:
+                    parts.append(tool_results[0]["content"])
+
+        answer = "".join(parts) or "Pas de réponse"
+        history_length = await asyncio.to_thread(
+            backend.record_exchange, model_key, question, answer, conversation_id
+        )
+        yield backend._sse("done", {
+            "answer": answer,
+            "model_used": model_info["name"],
+            "history_length": history_length,
+            "conversation_id": conversation_id,
+            "ollama": calls,
+        })
+    except Exception as exc:
+        message, status = _error_payload(exc)
+        payload = {"error": message, "status": status}
+        if isinstance(exc, (backend.OllamaOverloaded, backend.OllamaUnavailable)):
+            payload["retry_after"] = exc.retry_after
+        yield backend._sse("error", payload)
+
+
+def _error_payload(exc):
+    """_error_payload étendu aux exceptions de httpx."""
+    if isinstance(exc, httpx.TimeoutException):
+        return "Timeout - Le modèle met trop de temps à répondre", 504
+    if isinstance(exc, httpx.TransportError):
+        return "Impossible de se connecter à Ollama. Est-il lancé ?", 503
+    return backend._error_payload(exc)
+
+
+# --- Plomberie ASGI ---
+def _headers(scope, extra):
+    """En-têtes de réponse, avec CORS pour les origines autorisées côté Flask."""
+    headers = [(k.lower().encode(), str(v).encode()) for k, v in extra.items()]
+    origin = dict(scope["headers"]).get(b"origin", b"").decode()
+    if origin in backend.CORS_ORIGINS:
+        headers += [(b"access-control-allow-origin", origin.encode()), (b"vary", b"Origin"),
+                    (b"access-control-expose-headers", b"X-Request-ID, Server-Timing")]
+    return headers
+
+
+async def _send_json(scope, send, status, payload, headers=None):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": _headers(scope, {
+            "Content-Type": "application/json",
+            "Content-Length": len(body),
+            **(headers or {}),
+        }),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_events(scope, send, events, headers=None):
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": _headers(scope, {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            **(headers or {}),
+        }),
+    })
+    try:
+        async for event in events:
+            await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await events.aclose()
+
+
+async def _read_body(receive):
+    """Corps complet de la requête, ou None si le client s'est déconnecté."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _until_disconnect(receive, coro):
+    """Exécute coro et l'annule si le client se déconnecte avant la fin : le
+    créneau Ollama et les sous-processus en cours sont alors libérés."""
+    task = asyncio.ensure_future(coro)
+
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, watcher, return_exceptions=True)
+    if not task.cancelled():
+        task.result()
+
+
+async def _ask(scope, receive, send, force_stream):
+    body = await _read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body or b"null")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        await _send_json(scope, send, 400, {"error": "Corps JSON invalide"})
+        return
+    params, error = backend.parse_ask_request(data, force_stream)
+    if error:
+        await _send_json(scope, send, 400, {"error": error})
+        return
+
+    model_key = params["model_key"]
+    conversation_id = params["conversation_id"]
+    model_info = backend.MODELS[model_key]
+    try:
+        backend.ollama_client.breaker.raise_if_open()
+        backend.ollama_scheduler.admit(model_info["model_id"])
+    except (backend.OllamaOverloaded, backend.OllamaUnavailable) as exc:
+        message, status = backend._error_payload(exc)
+        await _send_json(scope, send, status, {"error": message, "retry_after": exc.retry_after},
+                         backend._error_headers(exc))
+        return
+
+    # Chaque requête ASGI a sa propre tâche (et son contexte) : pas de reset nécessaire
+    root = backend.tracer.start("ask", dict(scope["headers"]).get(b"x-request-id", b"").decode())
+    if root is not None:
+        root.attrs.update(model=model_key, stream=params["stream"])
+        backend._current_span.set(root)
+    with backend.span("build_messages"):
+        messages = await asyncio.to_thread(
+            backend.build_messages, model_key, params["question"], params["system_mode"],
+            params["use_context"], conversation_id,
+        )
+    client = (scope.get("client") or ("local",))[0]
+
+    if params["stream"]:
+        events = stream_chat_with_tools_async(
+            model_info, model_key, params["question"], messages, conversation_id, client
+        )
+        try:
+            await _until_disconnect(receive, _send_events(scope, send, events, _trace_headers(root)))
+        finally:
+            if root is not None:
+                backend.tracer.finish(root)
+        return
+
+    calls = []
+    backend._ollama_calls.set(calls)
+    await _until_disconnect(receive, _answer(
+        scope, send, model_info, model_key, params, messages, client, calls
+    ))
+
+
+def _trace_headers(root, finish=False, **attrs):
+    """En-têtes X-Request-ID et Server-Timing de la requête tracée ; avec finish,
+    la trace est d'abord close (réponse non streamée)."""
+    if root is None:
+        return {}
+    if finish:
+        backend.tracer.finish(root, **attrs)
+    return backend.tracer.headers(root)
+
+
+async def _answer(scope, send, model_info, model_key, params, messages, client, calls):
+    conversation_id = params["conversation_id"]
+    root = backend._current_span.get()
+    try:
+        answer, jobs = await chat_or_launch_jobs_async(
+            model_info, messages, client, params["async_tools"]
+        )
+        if jobs:
+            # Réponse anticipée : le résultat se consulte via /jobs/<id>
+            await _send_json(scope, send, 202, {
+                "answer": answer,
+                "model_used": model_info["name"],
+                "jobs": [job.to_dict() for job in jobs],
+                "conversation_id": conversation_id,
+                "ollama": calls,
+            }, _trace_headers(root, finish=True, status=202))
+            return
+        history_length = await asyncio.to_thread(
+            backend.record_exchange, model_key, params["question"], answer, conversation_id
+        )
+        await _send_json(scope, send, 200, {
+            "answer": answer,
+            "model_used": model_info["name"],
+            "history_length": history_length,
+            "conversation_id": conversation_id,
+            "ollama": calls,
+        }, _trace_headers(root, finish=True, status=200))
+    except Exception as exc:
+        message, status = _error_payload(exc)
+        await _send_json(scope, send, status, {"error": message}, {
+            **backend._error_headers(exc), **_trace_headers(root, finish=True, status=status),
+        })
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await ollama.aclose()
+            _tool_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def create_asgi_app():
+    """Fabrique ASGI (uvicorn --factory asgi:create_asgi_app) : /ask et
+    /ask/stream en asyncio, le reste délégué à l'application Flask."""
+    flask_app = WsgiToAsgi(backend.create_app())
+
+    async def application(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await _lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in ASK_ROUTES:
+            await _ask(scope, receive, send, ASK_ROUTES[scope["path"]])
+            return
+        await flask_app(scope, receive, send)
+
+    return application
@@ -0,0 +1,176 @@
+"""Benchmark de bout en bout de /ask : latence p50/p95/p99, débit et time-to-first-token.
+
+Par défaut, démarre le stub Ollama et le backend Flask dans ce processus. Avec
+--url, cible un backend déjà lancé (branché sur le stub ou sur un vrai Ollama).
+
+Usage :
+    python bench/bench_ask.py --concurrency 8 --requests 200 --stream
+    PATH=bench/fakebin:$PATH python bench/bench_ask.py --model llama3.1 \\
+        --tool-call 'run_port_audit={"target": "10.0.0.1"}'
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from stub_ollama import add_stub_arguments, config_from_args, serve  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Percentile au rang le plus proche (values non vide)."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def ask_once(session, base_url, payload, stream):
+    """Envoie une question. Retourne (succès, latence, ttft) en secondes."""
+    start = time.monotonic()
+    if not stream:
+        resp = session.post(f"{base_url}/ask", json=payload, timeout=300)
+        elapsed = time.monotonic() - start
+        return resp.status_code == 200, elapsed, elapsed
+
+    ttft = None
+    ok = False
+    with session.post(f"{base_url}/ask/stream", json=payload, timeout=300, stream=True) as resp:
+        event = None
+        for line in resp.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+                if event == "token" and ttft is None:
+                    ttft = time.monotonic() - start
+            elif event in ("done", "error") and line.startswith("data: "):
+                ok = event == "done"
+                break
+    elapsed = time.monotonic() - start
+    return ok, elapsed, ttft if ttft is not None else elapsed
+
+
+def run_load(base_url, concurrency, payload_fn, total_requests=None, duration=None, stream=False):
+    """Envoie des /ask depuis `concurrency` clients, jusqu'à `total_requests`
+    requêtes ou pendant `duration` secondes. Retourne (échantillons, erreurs, durée)."""
+    samples = []
+    errors = [0]
+    counter = [0]
+    lock = threading.Lock()
+    start = time.monotonic()
+    stop_at = start + duration if duration else None
+
+    def next_index():
+        with lock:
+            if total_requests is not None and counter[0] >= total_requests:
+                return None
+            counter[0] += 1
+            return counter[0]
+
+    def client(worker_id):
+        session = requests.Session()
+        while stop_at is None or time.monotonic() < stop_at:
+            index = next_index()
+            if index is None:
+                return
+            try:
+                ok, latency, ttft = ask_once(session, base_url, payload_fn(worker_id, index), stream)
+            except requests.RequestException:
+                ok, latency, ttft = False, 0.0, 0.0
+            with lock:
+                if ok:
+                    samples.append((latency, ttft))
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, errors[0], time.monotonic() - start
+
+
+def report(samples, errors, elapsed, stream):
+    print(f"Requêtes réussies : {len(samples)}  erreurs : {errors}  durée : {elapsed:.1f}s")
+    if not samples:
+        return
+    print(f"Débit : {len(samples) / elapsed:.2f} req/s")
+    latencies = [s[0] * 1000 for s in samples]
+    ttfts = [s[1] * 1000 for s in samples]
+    print(f"{'':>10} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    rows = [("latence", latencies)]
+    if stream:
+        rows.append(("ttft", ttfts))
+    for label, values in rows:
+        print(f"{label:>10} " + " ".join(f"{percentile(values, p):>7.0f}ms" for p in (50, 95, 99))
+              + f" {max(values):>7.0f}ms")
+
+
+def start_backend(stub_url):
+    """Démarre le backend Flask (threadé) dans ce processus, branché sur le stub."""
+    os.environ["OLLAMA_URL"] = stub_url
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench-data-"))
+    sys.path.insert(0, ROOT)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app as backend
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    port = free_port()
+    server = make_server("127.0.0.1", port, backend.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de /ask (latence, débit, TTFT)")
+    parser.add_argument("--url", help="Backend déjà lancé (sinon stub + backend locaux)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--duration", type=float, help="Durée fixe (s) au lieu d'un nombre de requêtes")
+    parser.add_argument("--stream", action="store_true", help="Utiliser /ask/stream et mesurer le TTFT")
+    parser.add_argument("--model", default="llama3")
+    parser.add_argument("--question", default="Explique le protocole TCP en une phrase.")
+    parser.add_argument("--use-context", action="store_true")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    base_url = args.url
+    if base_url is None:
+        stub_port = free_port()
+        stub = serve(stub_port, config_from_args(args))
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        base_url = start_backend(f"http://127.0.0.1:{stub_port}")
+
+    def payload(worker_id, index):
+        return {
+            "model": args.model,
+            "question": f"{args.question} ({index})",
+            "use_context": args.use_context,
+            "conversation_id": f"bench-{worker_id}",
+        }
+
+    samples, errors, elapsed = run_load(
+        base_url, args.concurrency, payload,
+        total_requests=None if args.duration else args.requests,
+        duration=args.duration, stream=args.stream,
+    )
+    report(samples, errors, elapsed, args.stream)
+
+
+if __name__ == "__main__":
+    main()
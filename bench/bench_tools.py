@@ -0,0 +1,49 @@
+"""Benchmark hors ligne des bundles d'outils avec les faux binaires nmap/ping.
+
+Les délais se règlent via FAKE_NMAP_DELAY, FAKE_PING_DELAY, etc. (voir bench/fakebin).
+
+Usage : python bench/bench_tools.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--target", default="127.0.0.1")
+    args = parser.parse_args()
+
+    # Les faux binaires passent devant les vrais
+    os.environ["PATH"] = os.path.join(BENCH_DIR, "fakebin") + os.pathsep + os.environ.get("PATH", "")
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench-data-"))
+    sys.path.insert(0, ROOT)
+    import app as backend
+
+    bundles = {
+        "run_ping": {"target": args.target},
+        "run_nmap": {"target": args.target},
+        "run_reconnaissance_rapide": {"target": args.target},
+        "run_local_discovery": {},
+        "run_port_audit": {"target": args.target},
+    }
+    print(f"{'outil':<28} {'moy.':>8} {'min':>8} {'max':>8}")
+    for name, arguments in bundles.items():
+        durations = []
+        for _ in range(args.runs):
+            start = time.monotonic()
+            backend.dispatch_tool(name, dict(arguments))
+            durations.append(time.monotonic() - start)
+        print(f"{name:<28} {statistics.mean(durations):>7.2f}s "
+              f"{min(durations):>7.2f}s {max(durations):>7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Benchmark de montée en charge du mode multi-workers (gunicorn) contre le stub Ollama.
+
+Pour chaque nombre de workers, lance `gunicorn "app:create_app()"` (1 thread par
+worker pour isoler l'effet du nombre de processus), envoie des /ask en parallèle
+pendant une durée fixe et mesure le débit obtenu.
+
+Usage : python bench/bench_workers.py --workers 1 2 4 --concurrency 16 --duration 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_ask import ROOT, free_port, run_load  # noqa: E402
+from stub_ollama import StubConfig, serve  # noqa: E402
+
+
+def wait_ready(url, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Le serveur {url} n'a pas démarré")
+
+
+def run_for_workers(workers, stub_url, concurrency, duration):
+    port = free_port()
+    env = dict(os.environ, OLLAMA_URL=stub_url, DATA_DIR=tempfile.mkdtemp(prefix="bench-data-"))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--chdir", ROOT,
+         "--workers", str(workers), "--threads", "1",
+         "--bind", f"127.0.0.1:{port}", "app:create_app()"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        wait_ready(f"{base_url}/models")
+        samples, errors, _ = run_load(base_url, concurrency, lambda worker_id, n: {
+            "model": "llama3",
+            "question": f"question {n}",
+            "conversation_id": f"bench-{worker_id}",
+        }, duration=duration)
+        latencies = [latency for latency, _ in samples]
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / duration,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Débit de /ask selon le nombre de workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--latency", type=float, default=0.1, help="Latence simulée d'Ollama (s)")
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = serve(stub_port, StubConfig(prompt_delay=args.latency, token_rate=0))
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+
+    print(f"{'workers':>8} {'requêtes':>9} {'erreurs':>8} {'req/s':>8} {'moy. ms':>8}")
+    baseline = None
+    for workers in args.workers:
+        r = run_for_workers(workers, stub_url, args.concurrency, args.duration)
+        baseline = baseline or r["throughput"]
+        print(f"{r['workers']:>8} {r['requests']:>9} {r['errors']:>8} "
+              f"{r['throughput']:>8.1f} {r['mean_ms']:>8.1f}"
+              f"   (x{r['throughput'] / baseline:.2f})")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
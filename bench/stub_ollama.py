@@ -0,0 +1,211 @@
+"""Faux serveur Ollama (/api/chat) pour mesurer le backend sans GPU.
+
+Simule le temps d'évaluation du prompt, un débit de tokens configurable, le
+streaming NDJSON, des réponses avec tool_calls et le chargement des modèles
+(--load-delay, /api/generate, /api/ps, keep_alive).
+
+Usage : python bench/stub_ollama.py --port 11500 --token-rate 40 --tokens 60 \\
+            --tool-call 'run_ping={"target": "127.0.0.1"}'
+puis lancer le backend avec OLLAMA_URL=http://127.0.0.1:11500
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    """Paramètres du faux modèle (partagés par toutes les requêtes)."""
+
+    def __init__(self, prompt_delay=0.1, tokens=20, token_rate=50.0, tool_calls=None, load_delay=0.0):
+        self.prompt_delay = prompt_delay   # Évaluation du prompt, avant le 1er token (s)
+        self.tokens = tokens               # Nombre de tokens par réponse
+        self.token_rate = token_rate       # Tokens générés par seconde (0 = instantané)
+        self.tool_calls = tool_calls or [] # Appels d'outils renvoyés si "tools" est fourni
+        self.load_delay = load_delay       # Chargement d'un modèle froid (s)
+
+
+def _keep_alive_seconds(value):
+    """keep_alive Ollama ("30m", "10s", 300, -1...) → secondes (défaut 5 min)."""
+    if value is None:
+        return 300
+    if isinstance(value, (int, float)):
+        return float(value) if value >= 0 else float("inf")
+    match = re.fullmatch(r"(-?\d+(?:\.\d+)?)([smh]?)", str(value))
+    if not match:
+        return 300
+    amount = float(match.group(1))
+    return float("inf") if amount < 0 else amount * {"": 1, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+
+
+class LoadedModels:
+    """Modèles « en mémoire » du stub, avec leur expiration (keep_alive)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expires = {}
+
+    def use(self, model, keep_alive, load_delay):
+        """Charge le modèle s'il est froid ; retourne la durée de chargement (s)."""
+        with self._lock:
+            now = time.monotonic()
+            cold = self._expires.get(model, 0) <= now
+            self._expires[model] = now + load_delay + _keep_alive_seconds(keep_alive)
+        if cold and load_delay:
+            time.sleep(load_delay)
+        return load_delay if cold else 0.0
+
+    def running(self):
+        with self._lock:
+            now = time.monotonic()
+            return {m: exp - now for m, exp in self._expires.items() if exp > now}
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = StubConfig()
+    models = LoadedModels()
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        # Transfer-Encoding: chunked, une ligne NDJSON par chunk
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self._send_json({"version": "0.0.0-stub"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": []})
+        elif self.path == "/api/ps":
+            now = datetime.now(timezone.utc)
+            self._send_json({"models": [
+                {"name": model, "model": model, "size_vram": 4_000_000_000,
+                 "expires_at": (now + timedelta(seconds=min(ttl, 10 ** 7))).isoformat()}
+                for model, ttl in self.models.running().items()
+            ]})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        config = self.config
+        if self.path == "/api/generate" and not payload.get("prompt"):
+            # Prompt vide : Ollama se contente de charger le modèle
+            load = self.models.use(payload.get("model"), payload.get("keep_alive"), config.load_delay)
+            self._send_json({"model": payload.get("model"), "response": "", "done": True,
+                             "load_duration": int(load * 1e9)})
+            return
+        if self.path != "/api/chat":
+            self._send_json({"error": "not found"}, status=404)
+            return
+
+        load = self.models.use(payload.get("model"), payload.get("keep_alive"), config.load_delay)
+        messages = payload.get("messages", [])
+        last = messages[-1] if messages else {}
+        wants_tools = bool(payload.get("tools")) and last.get("role") == "user" and config.tool_calls
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        words = [f"mot{i}" for i in range(config.tokens)]
+        stats = {
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(config.prompt_delay * 1e9),
+            "eval_count": 0 if wants_tools else len(words),
+            "eval_duration": int(len(words) / config.token_rate * 1e9) if config.token_rate else 0,
+            "load_duration": int(load * 1e9),
+        }
+
+        time.sleep(config.prompt_delay)
+        if not payload.get("stream", True):
+            if wants_tools:
+                message = {"role": "assistant", "content": "", "tool_calls": config.tool_calls}
+            else:
+                if config.token_rate:
+                    time.sleep(len(words) / config.token_rate)
+                message = {"role": "assistant", "content": " ".join(words)}
+            self._send_json({"model": payload.get("model"), "message": message, "done": True, **stats})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if wants_tools:
+            self._write_chunk({"message": {"role": "assistant", "content": "",
+                                           "tool_calls": config.tool_calls}, "done": False})
+        else:
+            for word in words:
+                if config.token_rate:
+                    time.sleep(1 / config.token_rate)
+                self._write_chunk({"message": {"role": "assistant", "content": word + " "}, "done": False})
+        self._write_chunk({"message": {"role": "assistant", "content": ""}, "done": True, **stats})
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def parse_tool_call(spec):
+    """'nom={"arg": "valeur"}' → tool_call au format Ollama."""
+    name, _, raw_args = spec.partition("=")
+    return {"function": {"name": name, "arguments": json.loads(raw_args or "{}")}}
+
+
+class StubServer(ThreadingHTTPServer):
+    # File d'acceptation large : des centaines de connexions arrivent en rafale
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Les clients du benchmark coupent les connexions keep-alive à la fin : bruit inutile
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(port, config=None):
+    StubOllamaHandler.config = config or StubConfig()
+    server = StubServer(("127.0.0.1", port), StubOllamaHandler)
+    server.daemon_threads = True
+    return server
+
+
+def add_stub_arguments(parser):
+    parser.add_argument("--prompt-delay", type=float, default=0.1,
+                        help="Délai avant le premier token (s)")
+    parser.add_argument("--tokens", type=int, default=20, help="Tokens par réponse")
+    parser.add_argument("--token-rate", type=float, default=50.0,
+                        help="Tokens par seconde (0 = instantané)")
+    parser.add_argument("--tool-call", action="append", default=[], metavar="NOM=JSON",
+                        help="Appel d'outil renvoyé quand le backend fournit des tools (répétable)")
+    parser.add_argument("--load-delay", type=float, default=0.0,
+                        help="Chargement d'un modèle froid (s), évité tant que keep_alive court")
+
+
+def config_from_args(args):
+    return StubConfig(
+        prompt_delay=args.prompt_delay,
+        tokens=args.tokens,
+        token_rate=args.token_rate,
+        tool_calls=[parse_tool_call(spec) for spec in args.tool_call],
+        load_delay=args.load_delay,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=11500)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    print(f"Stub Ollama sur http://127.0.0.1:{args.port}")
+    serve(args.port, config_from_args(args)).serve_forever()